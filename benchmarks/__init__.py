@@ -0,0 +1,53 @@
+"""
+Benchmarks for pybars
+
+Each module can be run on its own, for instance:
+
+    python -m benchmarks.parser
+"""
+
+from __future__ import print_function
+
+import timeit
+
+
+def best_of(func, repeat=5, number=1):
+    """
+    Times a callable
+
+    :param func:
+        A callable taking no arguments
+
+    :param repeat:
+        How many timing runs to make
+
+    :param number:
+        How many times to call func in each run
+
+    :return:
+        The fastest time for a single call, in seconds
+    """
+
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(title, rows, headers):
+    """
+    Prints a simple table of results
+
+    :param title:
+        A unicode string to print above the table
+
+    :param rows:
+        A list of tuples, one per row
+
+    :param headers:
+        A tuple of column names
+    """
+
+    print(title)
+    print('-' * len(title))
+    widths = [max(len(str(row[i])) for row in [headers] + rows) for i in range(len(headers))]
+    for row in [headers] + rows:
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
+    print('')
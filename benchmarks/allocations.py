@@ -0,0 +1,91 @@
+"""
+Counts the memory blocks allocated for the options of each block helper
+call, keeping every options object alive so that tracemalloc sees them, and
+compares them with the dict, functools.partial and lambda objects the
+generated code used to create
+"""
+
+from __future__ import print_function
+
+import tracemalloc
+from functools import partial
+
+from pybars._compiler import Compiler
+
+from benchmarks import best_of, report
+
+
+SOURCE = u'{{#each rows}}{{#row this}}<b>{{name}}</b>{{else}}-{{/row}}{{#row this}}{{name}}{{/row}}{{/each}}'
+
+COUNT = 10000
+
+
+def legacy_options(fn, inverse, helpers, partials, root):
+    options = {'fn': partial(fn, helpers=helpers, partials=partials, root=root)}
+    options['helpers'] = helpers
+    options['partials'] = partials
+    options['root'] = root
+    if inverse is not None:
+        options['inverse'] = partial(inverse, helpers=helpers, partials=partials, root=root)
+    else:
+        options['inverse'] = lambda this: None
+    return options
+
+
+def count_blocks(func):
+    """
+    :return:
+        The number of memory blocks allocated by func that are still alive
+        when it returns
+    """
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    func()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+
+def main():
+    template = Compiler().compile(SOURCE)
+    context = {'rows': [{'name': u'row %d' % i} for i in range(COUNT)]}
+    kept = []
+
+    def row(this, options, value):
+        kept.append(options)
+        return options['fn'](this)
+
+    def block(this, helpers, partials, root):
+        return u''
+
+    def render():
+        del kept[:]
+        template(context, helpers={'row': row})
+
+    def legacy():
+        del kept[:]
+        helpers = {}
+        partials = {}
+        for i in range(COUNT):
+            kept.append(legacy_options(block, block, helpers, partials, context))
+            kept.append(legacy_options(block, None, helpers, partials, context))
+
+    rows = []
+    for name, func in (('dict, partial, lambda', legacy), ('Options', render)):
+        blocks = count_blocks(func)
+        kept_count = len(kept)
+        rows.append((name, '%d' % kept_count, '%.2f' % (blocks / float(kept_count))))
+    report(
+        'Memory blocks allocated per block helper call',
+        rows,
+        ('options', 'calls', 'blocks/call')
+    )
+
+    del kept[:]
+    elapsed = best_of(lambda: template(context, helpers={'row': lambda this, options, value: options['fn'](this)}))
+    print('Rendering %d rows with two block helper calls each: %.1f ms' % (COUNT, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Times {{#each}} over a list and a dict of 100k rows, with bodies that do
+and do not use the data variables, both as the loop the compiler generates
+and through the _each() helper, and measures the peak memory of rendering
+rows from a generator compared with a list made of it
+"""
+
+from __future__ import print_function
+
+import tracemalloc
+
+from pybars._compiler import Compiler, _pybars_
+
+from benchmarks import best_of, report
+
+
+COUNT = 100000
+
+BODIES = (
+    ('name', u'{{name}}'),
+    ('@index name', u'{{@index}}{{name}}'),
+    ('@key name', u'{{@key}}{{name}}'),
+)
+
+
+def main():
+    compiler = Compiler()
+    rows = [{'name': u'row %d' % i} for i in range(COUNT)]
+    contexts = (
+        ('list', {'rows': rows}),
+        ('dict', {'rows': dict(('key %d' % i, row) for i, row in enumerate(rows))}),
+    )
+    # A helper other than the built-in one is called rather than inlined
+    helpers = {'each': lambda *args: _pybars_['helpers']['each'](*args)}
+
+    results = []
+    for body_name, body in BODIES:
+        template = compiler.compile(u'{{#each rows}}' + body + u'{{/each}}')
+        for context_name, context in contexts:
+            inline = best_of(lambda: template(context))
+            helper = best_of(lambda: template(context, helpers=helpers))
+            results.append((
+                context_name,
+                body_name,
+                '%.0f' % (inline * 1e9 / COUNT),
+                '%.0f' % (helper * 1e9 / COUNT),
+            ))
+    report(
+        '{{#each}} over %d rows' % COUNT,
+        results,
+        ('rows', 'body', 'inline ns/row', '_each() ns/row')
+    )
+
+    def generate():
+        for i in range(COUNT):
+            yield {'name': u'row %d' % i, 'value': i}
+
+    template = compiler.compile(u'{{#each rows}}{{name}}{{#if @last}}.{{/if}}{{/each}}')
+    results = []
+    for name, make_rows in (('list(generator)', lambda: list(generate())), ('generator', generate)):
+        tracemalloc.start()
+        output = template({'rows': make_rows()})
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((name, '%.1f' % (peak / 1e6)))
+        del output
+    # Most of the peak with the generator is the output itself
+    report('Peak memory rendering %d rows' % COUNT, results, ('rows', 'peak MB'))
+
+
+if __name__ == '__main__':
+    main()
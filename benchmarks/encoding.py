@@ -0,0 +1,46 @@
+"""
+Compares the time and peak memory of rendering a 1000 row page to UTF-8
+bytes by encoding the output of a template returning text, and with a
+template compiled with an encoding, for mostly ASCII and mostly non-ASCII
+text
+"""
+
+from __future__ import print_function
+
+import tracemalloc
+
+from pybars._compiler import Compiler
+
+from benchmarks import best_of, report
+
+
+COUNT = 1000
+
+SOURCES = (
+    ('ASCII', u'<table>{{#each rows}}<tr><td class="name">{{name}}</td><td>{{value}}</td></tr>{{/each}}</table>'),
+    ('non-ASCII', u'<table>{{#each rows}}<tr><td>名前 {{name}}</td><td>値 {{value}}</td></tr>{{/each}}'
+                  u'</table>'),
+)
+
+
+def main():
+    context = {'rows': [{'name': u'row %d' % i, 'value': i} for i in range(COUNT)]}
+
+    results = []
+    for name, source in SOURCES:
+        template = Compiler().compile(source)
+        encoded = Compiler().compile(source, encoding='utf-8')
+        assert template(context).encode('utf-8') == encoded(context)
+        for label, func in (('encode()', lambda: template(context).encode('utf-8')),
+                            ("encoding='utf-8'", lambda: encoded(context))):
+            elapsed = best_of(func, repeat=20)
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((name, label, '%.2f' % (elapsed * 1000), '%.0f' % (peak / 1e3)))
+    report('Rendering %d rows to UTF-8' % COUNT, results, ('', '', 'ms', 'peak kB'))
+
+
+if __name__ == '__main__':
+    main()
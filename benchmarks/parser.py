@@ -0,0 +1,43 @@
+"""
+Shows that parsing and code generation grow linearly with template size
+"""
+
+from __future__ import print_function
+
+from pybars._compiler import Compiler, Parser
+
+from benchmarks import best_of, report
+
+
+UNIT = (
+    u'<div class="row">\n'
+    u'  <span>{{name}}</span> {{#if active}}<b>{{title}}</b>{{else}}-{{/if}}\n'
+    u'  {{> footer}} {{link url text=(upper title)}}\n'
+    u'</div>\n'
+)
+
+
+def main():
+    compiler = Compiler()
+    rows = []
+    for count in (250, 500, 1000, 2000, 4000):
+        source = UNIT * count
+        parse = best_of(lambda: Parser(source).parse(), repeat=3)
+        generate = best_of(lambda: compiler._generate_code(source), repeat=3)
+        kb = len(source) / 1024.0
+        rows.append((
+            '%.0f' % kb,
+            '%.1f' % (parse * 1000),
+            '%.3f' % (parse * 1000 / kb),
+            '%.1f' % (generate * 1000),
+            '%.3f' % (generate * 1000 / kb),
+        ))
+    report(
+        'Parser and code generation time by template size',
+        rows,
+        ('KB', 'parse ms', 'parse ms/KB', 'generate ms', 'generate ms/KB')
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Measures what a partial call costs on top of rendering the same markup
+inline, calling compiled partials directly and through their public
+render() function, which merges the helpers on every call
+"""
+
+from __future__ import print_function
+
+from pybars._compiler import Compiler
+
+from benchmarks import best_of, report
+
+
+ROW = u'<tr><td>{{name}}</td><td>{{value}}</td></tr>'
+
+
+def main():
+    compiler = Compiler()
+    row = compiler.compile(ROW)
+    inline = compiler.compile(u'{{#each rows}}' + ROW + u'{{/each}}')
+    partial = compiler.compile(u'{{#each rows}}{{> row}}{{/each}}')
+
+    # A plain function hides the internal entry point, so each call goes
+    # through render() as it did before partials used it
+    def public_row(context, helpers=None, partials=None, root=None):
+        return row(context, helpers=helpers, partials=partials, root=root)
+
+    helpers = dict(('helper_%d' % i, lambda this: u'') for i in range(20))
+    rows = []
+    for count in (1000, 10000):
+        context = {'rows': [{'name': u'row %d' % i, 'value': i} for i in range(count)]}
+        inline_time = best_of(lambda: inline(context, helpers=helpers), repeat=5)
+        for name, partials in (('_render()', {'row': row}), ('render()', {'row': public_row})):
+            elapsed = best_of(lambda: partial(context, helpers=helpers, partials=partials), repeat=5)
+            rows.append((
+                '%d' % count,
+                name,
+                '%.1f' % (inline_time * 1000),
+                '%.1f' % (elapsed * 1000),
+                '%.2f' % ((elapsed - inline_time) * 1e6 / count),
+            ))
+    report(
+        'Partial call overhead, with 20 helpers passed in',
+        rows,
+        ('rows', 'partial via', 'inline ms', 'partial ms', 'us/call')
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Times looking names up on 100k dataclass rows, with pick() as it used to
+handle a TypeError on every lookup and with the per-type cache that goes
+straight to the attributes of types without item access
+"""
+
+from __future__ import print_function
+
+from pybars._compiler import Compiler, pick
+
+from benchmarks import best_of, report
+
+try:
+    from dataclasses import dataclass
+except ImportError:
+    dataclass = None
+
+
+COUNT = 100000
+
+
+if dataclass is not None:
+    @dataclass
+    class Row:
+        name: str
+        value: int
+else:
+    class Row(object):
+        def __init__(self, name, value):
+            self.name = name
+            self.value = value
+
+
+def legacy_pick(context, name, default=None):
+    try:
+        return context[name]
+    except (KeyError, TypeError, AttributeError):
+        if isinstance(name, str):
+            if hasattr(context, name):
+                return getattr(context, name)
+        if hasattr(context, 'get'):
+            return context.get(name)
+        return default
+
+
+def main():
+    rows = [Row(u'row %d' % i, i) for i in range(COUNT)]
+
+    lookups = []
+    for name, func in (('legacy', legacy_pick), ('cached', pick)):
+        elapsed = best_of(lambda: [(func(row, 'name'), func(row, 'value')) for row in rows])
+        lookups.append((name, '%.1f' % (elapsed * 1000)))
+    report('Two lookups on each of %d dataclass rows' % COUNT, lookups, ('pick()', 'ms'))
+
+    template = Compiler().compile(u'{{#each rows}}<td>{{name}}</td><td>{{value}}</td>{{/each}}')
+    elapsed = best_of(lambda: template({'rows': rows}))
+    print('Rendering %d dataclass rows: %.1f ms' % (COUNT, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Times render_async() on 1000 rows whose helper waits 1 ms for I/O, with the
+items of {{#each}} awaited one at a time as they used to be and with the
+default number at once, and compares render() and render_async() on rows
+that need no awaiting
+"""
+
+from __future__ import print_function
+
+import asyncio
+
+import pybars._async
+from pybars._compiler import Compiler
+
+from benchmarks import best_of, report
+
+
+COUNT = 1000
+
+SOURCE = u'{{#each rows}}<tr><td>{{avatar id}}</td><td>{{name}}</td></tr>{{/each}}'
+
+
+def run(awaitable):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable)
+    finally:
+        loop.close()
+
+
+def avatar(this, id):
+    return asyncio.sleep(0.001, result=u'<img %d>' % id)
+
+
+def main():
+    template = Compiler().compile(SOURCE)
+    context = {'rows': [{'id': i, 'name': u'row %d' % i} for i in range(COUNT)]}
+    limit = pybars._async._limit
+
+    results = []
+    for name, concurrency in (('one at a time', 1), ('default', limit)):
+        pybars._async._limit = concurrency
+        elapsed = best_of(lambda: run(template.render_async(context, helpers={'avatar': avatar})), repeat=3)
+        results.append((name, concurrency, '%.0f' % (elapsed * 1000)))
+    pybars._async._limit = limit
+    report('%d rows with a helper waiting 1 ms' % COUNT, results, ('items', 'at once', 'ms'))
+
+    helpers = {'avatar': lambda this, id: u'<img %d>' % id}
+    results = [
+        ('render()', '%.2f' % (best_of(lambda: template(context, helpers=helpers)) * 1000)),
+        ('render_async()', '%.2f' % (best_of(lambda: run(template.render_async(context, helpers=helpers))) * 1000)),
+    ]
+    report('%d rows with a synchronous helper' % COUNT, results, ('', 'ms'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the peak memory and time of writing a 100k row page to a file,
+rendering the whole page and then writing it, and with render_to() at a few
+buffer sizes
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import tempfile
+import tracemalloc
+
+from pybars._compiler import Compiler
+
+from benchmarks import best_of, report
+
+
+COUNT = 100000
+
+SOURCE = (
+    u'<table>{{#each rows}}<tr><td>{{@index}}</td><td>{{name}}</td><td>{{value}}</td></tr>{{/each}}</table>'
+)
+
+
+def rows():
+    for i in range(COUNT):
+        yield {'name': u'row %d' % i, 'value': i}
+
+
+def main():
+    template = Compiler().compile(SOURCE)
+    # Compiles the variant for streaming
+    template.render_to(io.StringIO(), {'rows': []})
+
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+
+    def write():
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(template({'rows': rows()}))
+
+    def render_to(buffer_size):
+        with io.open(path, 'w', encoding='utf-8') as f:
+            template.render_to(f, {'rows': rows()}, buffer_size=buffer_size)
+
+    cases = [('f.write(template())', write)]
+    for buffer_size in (0, 8192, 65536):
+        cases.append(('render_to(), %d' % buffer_size, lambda buffer_size=buffer_size: render_to(buffer_size)))
+
+    results = []
+    try:
+        for name, func in cases:
+            elapsed = best_of(func, repeat=3)
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((name, '%.0f' % (elapsed * 1000), '%.1f' % (peak / 1e6)))
+    finally:
+        os.remove(path)
+    report('Writing %d rows to a file' % COUNT, results, ('', 'ms', 'peak MB'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Measures the Scope created for each item of an #each block over a list of
+1M items: the memory a Scope takes, with slots and with the __dict__ it used
+to have, and the time per item of creating them and of rendering the loop
+"""
+
+from __future__ import print_function
+
+import tracemalloc
+
+from pybars._compiler import Compiler, Scope
+
+from benchmarks import best_of, report
+
+
+COUNT = 1000000
+
+
+class LegacyScope(object):
+
+    def __init__(self, context, parent, root, overrides=None, index=None, key=None, first=None, last=None):
+        self.context = context
+        self.parent = parent
+        self.root = root
+        self.overrides = overrides
+        self.index = index
+        self.key = key
+        self.first = first
+        self.last = last
+
+
+def legacy_scopes(items, parent, root):
+    last_index = len(items) - 1
+    index = 0
+    for value in items:
+        kwargs = {
+            'index': index,
+            'first': index == 0,
+            'last': index == last_index
+        }
+        yield LegacyScope(value, parent, root, **kwargs)
+        index += 1
+
+
+def scopes(items, parent, root):
+    last_index = len(items) - 1
+    index = 0
+    for value in items:
+        yield Scope(value, parent, root, None, index, None, index == 0, index == last_index)
+        index += 1
+
+
+def measure_bytes(func):
+    """
+    :return:
+        The bytes allocated per item by func for objects that are alive when
+        it returns
+    """
+
+    tracemalloc.start()
+    kept = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / float(len(kept))
+
+
+def main():
+    items = list(range(COUNT))
+    parent = Scope({}, None, {})
+
+    rows = []
+    for name, func in (('__dict__, keywords', legacy_scopes), ('__slots__, positional', scopes)):
+        size = measure_bytes(lambda: list(func(items, parent, {})))
+        elapsed = best_of(lambda: [scope for scope in func(items, parent, {})], repeat=3)
+        rows.append((name, '%.0f' % size, '%.0f' % (elapsed * 1e9 / COUNT)))
+    report('Scopes for %d items' % COUNT, rows, ('Scope', 'bytes/item', 'ns/item'))
+
+    template = Compiler().compile(u'{{#each items}}{{@index}}{{/each}}')
+    context = {'items': items}
+    elapsed = best_of(lambda: template(context), repeat=3)
+    print('Rendering {{#each}} over %d items: %.0f ns/item' % (COUNT, elapsed * 1e9 / COUNT))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares render() with template.stream() on a large page: the time until
+the first chunk of output is available, the total time and the peak memory
+when each chunk is discarded once written, as a WSGI server would
+"""
+
+from __future__ import print_function
+
+import time
+import tracemalloc
+
+from pybars._compiler import Compiler
+
+from benchmarks import best_of, report
+
+
+COUNT = 100000
+
+SOURCE = (
+    u'<html><body><h1>{{title}}</h1>{{#with report}}<table>'
+    u'{{#each rows}}<tr><td>{{@index}}</td><td>{{name}}</td><td>{{value}}</td></tr>{{/each}}'
+    u'</table>{{/with}}</body></html>'
+)
+
+
+def rows():
+    for i in range(COUNT):
+        yield {'name': u'row %d' % i, 'value': i}
+
+
+def first_chunk(func):
+    """
+    :return:
+        The seconds until func's iterable of chunks gives the first one
+    """
+
+    start = time.time()
+    next(iter(func()))
+    return time.time() - start
+
+
+def peak_memory(func):
+    """
+    :return:
+        The peak memory in bytes while writing each chunk of func's iterable
+        to nowhere
+    """
+
+    tracemalloc.start()
+    for _ in func():
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    template = Compiler().compile(SOURCE)
+    # Compiles the variant for streaming
+    list(template.stream({'title': u'', 'report': {'rows': []}}))
+
+    def render():
+        return [template({'title': u'Report', 'report': {'rows': rows()}})]
+
+    def stream():
+        return template.stream({'title': u'Report', 'report': {'rows': rows()}}, chunk_size=16384)
+
+    results = []
+    for name, func in (('render()', render), ('stream()', stream)):
+        results.append((
+            name,
+            '%.2f' % (best_of(lambda: first_chunk(func), repeat=3) * 1000),
+            '%.0f' % (best_of(lambda: list(func()), repeat=3) * 1000),
+            '%.1f' % (peak_memory(func) / 1e6),
+        ))
+    report(
+        'A page of %d rows from a generator' % COUNT,
+        results,
+        ('', 'first chunk ms', 'total ms', 'peak MB')
+    )
+
+
+if __name__ == '__main__':
+    main()
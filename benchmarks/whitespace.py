@@ -0,0 +1,72 @@
+"""
+Compares the whitespace control scanner with the regular expressions it
+replaced, on ordinary templates and on inputs that made the regular
+expressions slow
+"""
+
+from __future__ import print_function
+
+import re
+
+from pybars._compiler import _whitespace_control
+
+from benchmarks import best_of, report
+
+
+_legacy_cleanup_sub = re.compile(r'(?<={{)~|~(?=}})|(?<=}})[ \t]+(?={{)').sub
+
+_legacy_re = re.compile(
+    r'~}}\s*|\s*{{~|'
+    r'(?<=\n)([ \t]*{{(#[^{}]+|/[^{}]+|![^{}]+|else|else if [^{}]+)}}[ \t]*)+\r?\n|'
+    r'^([ \t]*{{(#[^{}]+|![^{}]+)}}[ \t]*)+\r?\n|'
+    r'\r?\n([ \t]*{{(/[^{}]+|![^{}]+)}}[ \t]*)+$')
+
+
+def legacy(source):
+    return _legacy_re.sub(lambda match: _legacy_cleanup_sub('', match.group(0).strip()), source)
+
+
+UNIT = (
+    u'<ul>\n'
+    u'  {{#each items}}\n'
+    u'    <li class="{{cls}}">{{~name~}}</li>\n'
+    u'  {{else}}\n'
+    u'    <li>{{! nothing }}none</li>\n'
+    u'  {{/each}}\n'
+    u'</ul>\n'
+)
+
+# The regular expressions take quadratic time on runs of whitespace, so
+# those inputs are kept small
+INPUTS = [
+    ('templates', lambda n: UNIT * (n // len(UNIT)), (10000, 40000, 160000)),
+    ('long line', lambda n: u'x {{y}} ' * (n // 8), (10000, 40000, 160000)),
+    ('spaces', lambda n: u' ' * n + u'x', (2000, 8000, 32000)),
+    ('blank lines', lambda n: u' \n' * (n // 2), (2000, 8000, 32000)),
+]
+
+
+def main():
+    rows = []
+    for name, make, sizes in INPUTS:
+        for size in sizes:
+            source = make(size)
+            assert legacy(source) == _whitespace_control(source)[0]
+            old = best_of(lambda: legacy(source), repeat=3)
+            new = best_of(lambda: _whitespace_control(source), repeat=3)
+            rows.append((
+                name,
+                '%d' % (len(source) // 1000),
+                '%.2f' % (old * 1000),
+                '%.2f' % (new * 1000),
+                '%.1fx' % (old / new),
+            ))
+    report(
+        'Whitespace control time by input',
+        rows,
+        ('input', 'KB', 'regex ms', 'scanner ms', 'speedup')
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,11 @@ from pybars._compiler import (
     Scope,
     PybarsError
     )
+from pybars._cache import TemplateCache
+from pybars._build import build, TemplateIndex
+from pybars._importer import install_import_hook, uninstall_import_hook
+from pybars._profiler import Profiler, source_location
+from pybars._reloader import TemplateReloader
 
 __version__ = '0.9.7'
 __version_info__ = (0, 9, 7, 'final', 0)
@@ -42,7 +47,15 @@ __all__ = [
     'log',
     'strlist',
     'Scope',
-    'PybarsError'
+    'PybarsError',
+    'TemplateCache',
+    'build',
+    'TemplateIndex',
+    'TemplateReloader',
+    'Profiler',
+    'source_location',
+    'install_import_hook',
+    'uninstall_import_hook'
     ]
 
 
@@ -0,0 +1,59 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Command line interface, run as python -m pybars."""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from pybars._build import build
+from pybars._compiler import PybarsError
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pybars')
+    commands = parser.add_subparsers(dest='command')
+
+    build_parser = commands.add_parser(
+        'build', help='compile a directory of templates into a Python package')
+    build_parser.add_argument('source', help='the directory containing the templates')
+    build_parser.add_argument(
+        '-o', '--output', required=True, help='the directory to write the package to')
+    build_parser.add_argument(
+        '-e', '--extension', action='append', dest='extensions',
+        help='a template file extension, may be repeated (default: .hbs and .handlebars)')
+
+    args = parser.parse_args(argv)
+    if args.command != 'build':
+        parser.print_usage()
+        return 2
+
+    extensions = args.extensions or ('.hbs', '.handlebars')
+    try:
+        result = build(args.source, args.output, extensions)
+    except PybarsError as e:
+        print('Error: %s' % e, file=sys.stderr)
+        return 1
+
+    print('%d built, %d unchanged, %d removed' % (
+        len(result['built']), len(result['unchanged']), len(result['removed'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Rendering templates with asyncio, on Python 3.5 and newer.
+
+The compiler imports this module only when a template renders
+asynchronously, as the rest of pybars also runs on Python 2.
+"""
+
+import asyncio
+import collections
+import itertools
+
+from pybars._compiler import _block_output, _pybars_, Options, PybarsError, Scope, strlist, str_class, template_variant
+
+__all__ = [
+    'AsyncOptions',
+    'BlockOutput',
+    'render_template',
+    'await_value',
+    'resolve_output',
+    'each_async',
+    ]
+
+
+# The number of items of an each block, or of blocks rendered by a block
+# helper, that wait for I/O at the same time
+_limit = 64
+
+
+class AsyncOptions(Options):
+
+    """The options passed to block helpers by templates rendering
+    asynchronously.
+
+    The functions of the blocks are coroutines there, so fn and inverse
+    return a BlockOutput holding the coroutine. Helpers can return it, or add
+    it to a list they return, as they would the output of any block, and the
+    template awaits it once the helper returns. Helpers that need the text
+    of a block waiting for an awaitable must be async and await it.
+    """
+
+    __slots__ = ()
+
+    def _render_fn(self, this):
+        return _pending(self._fn(this, self.helpers, self.partials, self.root))
+
+    def _render_inverse(self, this):
+        return _pending(self._inverse(this, self.helpers, self.partials, self.root))
+
+
+def _pending(output):
+    # The functions of blocks returning constants are not coroutines
+    if type(output) is str_class:
+        return _block_output(output)
+    return BlockOutput((output,))
+
+
+class BlockOutput(strlist):
+
+    """The output of a block of a template rendering asynchronously,
+    which is rendered when it is awaited."""
+
+    __slots__ = ()
+
+    def __await__(self):
+        return resolve_output(list(self)).__await__()
+
+    def __str__(self):
+        # Synchronous helpers formatting the output get it when the block
+        # renders without waiting
+        for index, part in enumerate(self):
+            if type(part) is not str_class:
+                self[index] = str_class(_render_now(part))
+        return u''.join(self)
+
+
+def _render_now(coroutine):
+    """
+    Runs the coroutine of a block in the current task, as await would,
+    for as long as it does not wait
+
+    :return:
+        The output of the block
+    """
+
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise PybarsError(
+        u"The output of a block that waits for an awaitable can only be turned into a string by an async helper "
+        u"awaiting it, as the template renders asynchronously")
+
+
+async def render_template(template, context, helpers=None, partials=None):
+    """
+    Implements template.render_async() for compiled templates
+
+    :param template:
+        The render() function of the template
+
+    :return:
+        A unicode string, or a byte string if the template was compiled
+        with an encoding
+    """
+
+    render = template_variant(template, 'async')
+    merged = dict(_pybars_['helpers'])
+    if helpers is not None:
+        merged.update(helpers)
+    if partials is None:
+        partials = {}
+    output = str_class(await render(context, merged, partials, context))
+    encoding = getattr(template, '_pybars_encoding', None)
+    return output if encoding is None else output.encode(encoding)
+
+
+async def await_value(value):
+    """
+    Awaits a value the template uses, such as the result of a helper or a
+    value from the context, if it is awaitable
+
+    :param value:
+        Any value
+
+    :return:
+        The value, or what it resolves to. The items of an async iterable
+        are collected into a list.
+    """
+
+    if hasattr(value, '__await__'):
+        value = await value
+    if hasattr(value, '__aiter__'):
+        items = []
+        async for item in value:
+            items.append(item)
+        value = items
+    return value
+
+
+async def resolve_output(value):
+    """
+    Awaits the result of a block helper, along with the output of the blocks
+    it rendered with options['fn'] and options['inverse'], which are
+    coroutines when the template renders asynchronously
+
+    :param value:
+        The return value of the helper
+
+    :return:
+        A unicode string or a strlist with nothing left to await, or the
+        value as it is if it is neither awaitable nor a list
+    """
+
+    if hasattr(value, '__await__'):
+        value = await value
+    if not isinstance(value, (list, tuple)):
+        return value
+
+    output = strlist()
+    _flatten(value, output)
+    pending = [index for index, part in enumerate(output) if type(part) is not str_class]
+    if not pending:
+        return output
+    parts = await _gather([resolve_output(output[index]) for index in pending])
+    for index, part in zip(pending, parts):
+        output[index] = part or u''
+    result = strlist()
+    result.grow(output)
+    return result
+
+
+def _flatten(value, output):
+    """
+    Adds the strings and awaitables in a list, and the lists in it, to
+    output - unlike strlist.grow(), this does not iterate over futures
+    """
+
+    for part in value:
+        if type(part) is str_class or hasattr(part, '__await__'):
+            output.append(part)
+        else:
+            _flatten(part, output)
+
+
+async def each_async(block, items, data, parent, helpers, partials, root):
+    """
+    Renders the items of an each block that the template compiled to a loop
+
+    The items render in the current task, as if their blocks were awaited
+    directly, until one waits for an awaitable. The items after it then
+    render in tasks of their own while it waits, so that the helpers waiting
+    for I/O wait at the same time and run in a task as they would when
+    awaited directly. At most _limit of the items render at once.
+
+    :param block:
+        The function generated for the block
+
+    :param items:
+        The iterator from each_items()
+
+    :param data:
+        If the items are tuples with the values of the data variables
+
+    :param parent:
+        The Scope of the block
+
+    :return:
+        A strlist
+    """
+
+    result = strlist()
+    items = iter(items)
+    # The tasks of the items whose output is not in the result yet, in order
+    tasks = collections.deque()
+
+    def render(item):
+        if data:
+            index, key, value, last = item
+            scope = Scope(value, parent, root, None, index, key, index == 0, last)
+        else:
+            scope = Scope(item, parent, root)
+        return block(scope, helpers, partials, root)
+
+    def start():
+        for item in itertools.islice(items, _limit - 1):
+            tasks.append(asyncio.ensure_future(_render_item(render(item))))
+
+    try:
+        for item in items:
+            result.extend(await _InlineItem(render(item), start))
+            if tasks:
+                break
+        for item in items:
+            while tasks and tasks[0].done():
+                result.extend(tasks.popleft().result())
+            if len(tasks) >= _limit:
+                result.extend(await tasks.popleft())
+            tasks.append(asyncio.ensure_future(_render_item(render(item))))
+        while tasks:
+            result.extend(await tasks.popleft())
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return result
+
+
+class _InlineItem(object):
+
+    """Awaits the coroutine of an item of an each block in the current task,
+    calling suspended() the first time it waits, before the task does.
+
+    An item raising TypeError renders nothing, as in _each().
+    """
+
+    __slots__ = ('coroutine', 'suspended')
+
+    def __init__(self, coroutine, suspended):
+        self.coroutine = coroutine
+        self.suspended = suspended
+
+    def __await__(self):
+        coroutine = self.coroutine
+        try:
+            value = coroutine.send(None)
+        except StopIteration as stop:
+            return stop.value
+        except TypeError:
+            return ()
+        try:
+            self.suspended()
+        except BaseException:
+            coroutine.close()
+            raise
+        # Passes on what the task sends and throws, as await does
+        while True:
+            try:
+                sent = yield value
+            except GeneratorExit:
+                coroutine.close()
+                raise
+            except BaseException as e:
+                send, sent = coroutine.throw, e
+            else:
+                send = coroutine.send
+            try:
+                value = send(sent)
+            except StopIteration as stop:
+                return stop.value
+            except TypeError:
+                return ()
+
+
+async def _render_item(coroutine):
+    # An item raising TypeError renders nothing, as in _each()
+    try:
+        return await coroutine
+    except TypeError:
+        return ()
+
+
+async def _gather(awaitables):
+    """
+    Awaits coroutines concurrently, _limit at a time
+
+    :return:
+        A list of their results
+    """
+
+    results = []
+    for start in range(0, len(awaitables), _limit):
+        results.extend(await asyncio.gather(*awaitables[start:start + _limit]))
+    return results
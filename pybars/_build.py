@@ -0,0 +1,258 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Ahead-of-time compilation of a directory of templates into a package."""
+
+import hashlib
+import io
+import json
+import os
+import py_compile
+import re
+from importlib import import_module
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import pybars
+from pybars._compiler import Compiler, PybarsError
+
+__all__ = [
+    'build',
+    'TemplateIndex',
+    ]
+
+__metaclass__ = type
+
+
+_MANIFEST = '_pybars_build.json'
+
+_INDEX_TEMPLATE = u'''\
+# Generated by pybars %(version)s, do not edit
+
+from pybars._build import TemplateIndex
+
+templates = TemplateIndex(__name__, {
+%(entries)s})
+'''
+
+
+class TemplateIndex(Mapping):
+
+    """Maps template names to the render functions of a built package.
+
+    Modules are imported the first time a name is looked up, so importing
+    the package stays cheap no matter how many templates it holds. As names
+    are also the partial names, an index can be passed as partials.
+    """
+
+    def __init__(self, package, modules):
+        """
+        :param package:
+            The name of the built package
+
+        :param modules:
+            A dict of template names to module names within the package
+        """
+
+        self._package = package
+        self._modules = modules
+        self._loaded = {}
+
+    def __getitem__(self, name):
+        render = self._loaded.get(name)
+        if render is None:
+            render = import_module('%s.%s' % (self._package, self._modules[name])).render
+            self._loaded[name] = render
+        return render
+
+    def __contains__(self, name):
+        return name in self._modules
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def __len__(self):
+        return len(self._modules)
+
+
+def _module_name(name):
+    """
+    Derives a module name for a template that is a valid identifier and
+    never collides with that of another template
+
+    :param name:
+        The template name, a relative path without extension
+
+    :return:
+        A native string
+    """
+
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+    return 't_%s_%s' % (re.sub(r'[^0-9A-Za-z]+', '_', name).strip('_'), digest)
+
+
+def _find_templates(source_dir, extensions):
+    """
+    Walks a directory looking for templates, raising a PybarsError if two
+    files, such as a.hbs and a.handlebars, give the same template name
+
+    :param source_dir:
+        The directory to search
+
+    :param extensions:
+        A tuple of file extensions that are templates
+
+    :return:
+        A dict of template names, using / as the separator, to paths
+    """
+
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            base, extension = os.path.splitext(filename)
+            if extension not in extensions:
+                continue
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(os.path.join(dirpath, base), source_dir).replace(os.sep, '/')
+            if name in found:
+                raise PybarsError(u'%s and %s are both the template %s' % (found[name], path, name))
+            found[name] = path
+    return found
+
+
+def _cached_path(path):
+    try:
+        import importlib.util
+        return importlib.util.cache_from_source(path)
+    except (ImportError, AttributeError, NotImplementedError):
+        return path + 'c'
+
+
+def _byte_compile(path):
+    # Hash based .pyc files stay valid when an image or checkout changes
+    # the mtimes of the generated modules
+    mode = getattr(py_compile, 'PycInvalidationMode', None)
+    if mode is not None:
+        py_compile.compile(path, doraise=True, invalidation_mode=mode.CHECKED_HASH)
+    else:
+        py_compile.compile(path, doraise=True)
+
+
+def _remove(path):
+    for filename in (path, _cached_path(path)):
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+def build(source_dir, output_dir, extensions=('.hbs', '.handlebars'), compiler=None):
+    """
+    Compiles every template in a directory tree into a Python package
+
+    Each template becomes a module with a render() function, and the
+    package's __init__ holds a TemplateIndex named templates that maps
+    template names, such as email/welcome, to those functions. Only
+    templates whose source or pybars version changed since the last build
+    are regenerated, and modules of deleted templates are removed.
+
+    :param source_dir:
+        The directory containing the templates
+
+    :param output_dir:
+        The directory to write the package to
+
+    :param extensions:
+        An iterable of file extensions to treat as templates
+
+    :param compiler:
+        The pybars.Compiler to precompile templates with
+
+    :return:
+        A dict with the keys "built", "unchanged" and "removed", each a
+        sorted list of template names
+    """
+
+    compiler = compiler or Compiler()
+    templates = _find_templates(source_dir, tuple(extensions))
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    manifest_path = os.path.join(output_dir, _MANIFEST)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    if manifest.get('version') != pybars.__version__:
+        manifest = {}
+    previous = manifest.get('templates', {})
+
+    result = {'built': [], 'unchanged': [], 'removed': []}
+    entries = {}
+
+    for name in sorted(templates):
+        with open(templates[name], 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        module = _module_name(name)
+        module_path = os.path.join(output_dir, module + '.py')
+        entries[name] = {'module': module, 'hash': digest}
+
+        if previous.get(name) == entries[name] and os.path.exists(module_path):
+            if not os.path.exists(_cached_path(module_path)):
+                _byte_compile(module_path)
+            result['unchanged'].append(name)
+            continue
+
+        try:
+            code = compiler.precompile(data.decode('utf-8'))
+        except PybarsError as e:
+            raise PybarsError(u'%s: %s' % (templates[name], e))
+        with io.open(module_path, 'w', encoding='utf-8') as f:
+            f.write(code)
+        _byte_compile(module_path)
+        result['built'].append(name)
+
+    for name in sorted(set(previous) - set(entries)):
+        _remove(os.path.join(output_dir, previous[name]['module'] + '.py'))
+        result['removed'].append(name)
+
+    index = _INDEX_TEMPLATE % {
+        'version': pybars.__version__,
+        'entries': u''.join(
+            u'    %r: %r,\n' % (name, entries[name]['module'])
+            for name in sorted(entries)),
+        }
+    index_path = os.path.join(output_dir, '__init__.py')
+    try:
+        with io.open(index_path, 'r', encoding='utf-8') as f:
+            index_changed = f.read() != index
+    except (IOError, OSError):
+        index_changed = True
+    if index_changed or not os.path.exists(_cached_path(index_path)):
+        with io.open(index_path, 'w', encoding='utf-8') as f:
+            f.write(index)
+        _byte_compile(index_path)
+
+    # The manifest is written last so that an interrupted build is redone
+    with open(manifest_path, 'w') as f:
+        json.dump({'version': pybars.__version__, 'templates': entries}, f, indent=1, sort_keys=True)
+
+    return result
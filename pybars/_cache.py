@@ -0,0 +1,221 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""An in-memory cache of compiled templates."""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from pybars._compiler import _known_helpers, _release_module
+
+__all__ = [
+    'TemplateCache',
+    ]
+
+__metaclass__ = type
+
+
+class TemplateCache:
+
+    """A bounded LRU cache of compiled templates, keyed by a source digest.
+
+    Pass an instance to Compiler(cache=...) and Compiler.compile() will
+    return the already-built template when it sees the same source again.
+    A cache may be shared between compilers and threads.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None):
+        """
+        :param max_entries:
+            The maximum number of templates to keep, or None for no limit
+
+        :param max_bytes:
+            The maximum combined size of the generated code of the cached
+            templates, or None for no limit
+
+        :param ttl:
+            The number of seconds after which an entry expires, or None for
+            entries to live until they are evicted
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._time = time.time
+
+    @staticmethod
+    def digest(source, *options):
+        """
+        Computes the cache key for a template
+
+        :param source:
+            The template source as a unicode string
+
+        :param options:
+            Any compile options that change the generated code
+
+        :return:
+            A hex digest as a native string
+        """
+
+        hasher = hashlib.sha1(source.encode('utf-8'))
+        for option in options:
+            hasher.update(b'\0' + repr(option).encode('utf-8'))
+        return hasher.hexdigest()
+
+    @classmethod
+    def key(cls, source, knownHelpers=None, knownHelpersOnly=False, encoding=None):
+        """
+        Computes the cache key for a template compiled with the options of
+        Compiler.compile()
+
+        :param source:
+            The template source as a unicode string
+
+        :param knownHelpers:
+            See Compiler.compile()
+
+        :param knownHelpersOnly:
+            See Compiler.compile()
+
+        :param encoding:
+            See Compiler.compile()
+
+        :return:
+            A hex digest as a native string
+        """
+
+        if knownHelpers is None and not knownHelpersOnly and encoding is None:
+            return cls.digest(source)
+        # The names are expanded as the compiler expands them, so that
+        # options naming the same helpers share an entry
+        known = sorted(_known_helpers(knownHelpers))
+        if encoding is None:
+            return cls.digest(source, known, knownHelpersOnly)
+        return cls.digest(source, known, knownHelpersOnly, encoding)
+
+    def get(self, key):
+        """
+        Looks up a template, marking it as the most recently used
+
+        :param key:
+            A digest from TemplateCache.digest()
+
+        :return:
+            The template, or None if it is not cached
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None and self._time() - entry[2] > self.ttl:
+                self._discard(entry)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, template, size):
+        """
+        Adds a template, evicting the least recently used ones if the cache
+        is over budget
+
+        :param key:
+            A digest from TemplateCache.digest()
+
+        :param template:
+            The compiled template
+
+        :param size:
+            The size of the template's generated code
+        """
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (template, size, self._time())
+            self.nbytes += size
+
+            while self._entries and (
+                    (self.max_entries is not None and len(self._entries) > self.max_entries)
+                    or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                oldest = next(iter(self._entries))
+                self._discard(self._entries.pop(oldest))
+                self.evictions += 1
+
+    def invalidate(self, source, knownHelpers=None, knownHelpersOnly=False, encoding=None):
+        """
+        Removes a template from the cache
+
+        :param source:
+            The template source as a unicode string
+
+        :param knownHelpers:
+            The knownHelpers the template was compiled with
+
+        :param knownHelpersOnly:
+            The knownHelpersOnly the template was compiled with
+
+        :param encoding:
+            The encoding the template was compiled with
+
+        :return:
+            A bool - if the template was cached
+        """
+
+        key = self.key(source, knownHelpers, knownHelpersOnly, encoding)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self._discard(entry)
+            return True
+
+    def clear(self):
+        """
+        Removes every template from the cache
+        """
+
+        with self._lock:
+            while self._entries:
+                self._discard(self._entries.popitem()[1])
+
+    def _discard(self, entry):
+        template, size, _ = entry
+        self.nbytes -= size
+
+        # The compiled module is only referenced by the template now
+        _release_module(template)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
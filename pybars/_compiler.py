@@ -16,14 +16,30 @@
 
 """The compiler for pybars."""
 
+import ast
+import bisect
+import marshal
+import multiprocessing
 import re
 import sys
+import threading
+from itertools import chain, count, repeat
 from types import ModuleType
 import linecache
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+# Python 2: iterate lazily
+try:
+    from itertools import izip as zip
+except ImportError:
+    pass
+
 import pybars
 import pybars._templates
-from pymeta.grammar import OMeta
 
 __all__ = [
     'Compiler',
@@ -55,120 +71,480 @@ debug = False
 
 # Note that unless we presume handlebars is only generating valid html, we have
 # to accept anything - so a broken template won't be all that visible - it will
-# just render literally (because the anything rule matches it).
-
-# this grammar generates a tokenised tree
-handlebars_grammar = r"""
-
-template ::= (<text> | <templatecommand>)*:body => ['template'] + body
-text ::= <newline_text> | <whitespace_text> | <other_text>
-newline_text ::= (~(<start>) ('\r'?'\n'):char) => ('newline', u'' + char)
-whitespace_text ::= (~(<start>) (' '|'\t'))+:text => ('whitespace', u''.join(text))
-other_text ::= (~(<start>) <anything>)+:text => ('literal', u''.join(text))
-other ::= <anything>:char => ('literal', u'' + char)
-templatecommand ::= <blockrule>
-    | <comment>
-    | <escapedexpression>
-    | <expression>
-    | <partial>
-    | <rawblock>
-start ::= '{' '{'
-finish ::= '}' '}'
-comment ::= <start> '!' (~(<finish>) <anything>)* <finish> => ('comment', )
-space ::= ' '|'\t'|'\r'|'\n'
-arguments ::= (<space>+ (<kwliteral>|<literal>|<path>|<subexpression>))*:arguments => arguments
-subexpression ::= '(' <spaces> <path>:p (<space>+ (<kwliteral>|<literal>|<path>|<subexpression>))*:arguments <spaces> ')' => ('subexpr', p, arguments)
-expression_inner ::= <spaces> <path>:p <arguments>:arguments <spaces> <finish> => (p, arguments)
-expression ::= <start> '{' <expression_inner>:e '}' => ('expand', ) + e
-    | <start> '&' <expression_inner>:e => ('expand', ) + e
-escapedexpression ::= <start> <expression_inner>:e => ('escapedexpand', ) + e
-block_inner ::= <spaces> <symbol>:s <arguments>:args <spaces> <finish>
-    => (u''.join(s), args)
-partial_inner ::= <spaces> <partialname>:s <arguments>:args <spaces> <finish>
-    => (s, args)
-alt_inner ::= <spaces> ('^' | 'e' 'l' 's' 'e') <spaces> <finish>
-partial ::= <start> '>' <partial_inner>:i => ('partial',) + i
-path ::= ~('/') <pathseg>+:segments => ('path', segments)
-kwliteral ::= <safesymbol>:s '=' (<literal>|<path>|<subexpression>):v => ('kwparam', s, v)
-literal ::= (<string>|<integer>|<boolean>|<null>|<undefined>):thing => ('literalparam', thing)
-string ::= '"' <notdquote>*:ls '"' => u'"' + u''.join(ls) + u'"'
-    | "'" <notsquote>*:ls "'" => u"'" + u''.join(ls) + u"'"
-integer ::= '-'?:sign <digit>+:ds => int((sign if sign else '') + ''.join(ds))
-boolean ::= <false>|<true>
-false ::= 'f' 'a' 'l' 's' 'e' => False
-true ::= 't' 'r' 'u' 'e' => True
-null ::= ('n' 'u' 'l' 'l') => None
-undefined ::= ('u' 'n' 'd' 'e' 'f' 'i' 'n' 'e' 'd') => None
-notdquote ::= <escapedquote>
-    | '\n' => '\\n'
-    | '\r' => '\\r'
-    | '\\' => '\\\\'
-    | (~('"') <anything>)
-notsquote ::= <escapedquote>
-    | '\n' => '\\n'
-    | '\r' => '\\r'
-    | '\\' => '\\\\'
-    | (~("'") <anything>)
-escapedquote ::= '\\' '"' => '\\"'
-    | "\\" "'" => "\\'"
-notclosebracket ::= (~(']') <anything>)
-safesymbol ::=  ~<alt_inner> '['? (<letter>|'_'):start (<letterOrDigit>|'_')+:symbol ']'? => start + u''.join(symbol)
-symbol ::=  ~<alt_inner> '['? (<letterOrDigit>|'-'|'@')+:symbol ']'? => u''.join(symbol)
-partialname ::= <subexpression>:s => s
-    | ~<alt_inner> ('['|'"')? (~(<space>|<finish>|']'|'"' ) <anything>)+:symbol (']'|'"')? => ('literalparam', '"' + u''.join(symbol) + '"')
-pathseg ::= '[' <notclosebracket>+:symbol ']' => u''.join(symbol)
-    | ('@' '.' '.' '/') => u'@@_parent'
-    | <symbol>
-    | '/' => u''
-    | ('.' '.' '/') => u'@_parent'
-    | '.' => u''
-pathfinish :expected ::= <start> '/' <path>:found ?(found == expected) <finish>
-symbolfinish :expected ::= <start> '/' <symbol>:found ?(found == expected) <finish>
-blockrule ::= <start> '#' <block_inner>:i
-      <template>:t <alttemplate>:alt_t <symbolfinish i[0]> => ('block',) + i + (t, alt_t)
-    | <start> '^' <block_inner>:i
-      <template>:t <alttemplate>:alt_t <symbolfinish i[0]> => ('invertedblock',) + i + (t, alt_t)
-alttemplate ::= (<start> <alt_inner> <template>)?:alt_t => alt_t or []
-rawblockstart ::= <start> <start> <block_inner>:i <finish> => i
-rawblockfinish :expected ::= <start> <symbolfinish expected> <finish>
-rawblock ::= <rawblockstart>:i (~(<rawblockfinish i[0]>) <anything>)*:r <rawblockfinish i[0]>
-    => ('rawblock',) + i + (''.join(r),)
-"""
+# just render literally (because literal text matches anything up to "{{").
+
+_whitespace_text_re = re.compile(r'[ \t]+')
+_spaces_re = re.compile(r'\s*', re.UNICODE)
+_symbol_re = re.compile(r'[\w@-]*', re.UNICODE)
+_safesymbol_re = re.compile(r'\w*', re.UNICODE)
+
+
+class _Body(list):
+
+    """A template body, holding where each of its nodes starts in the source
+    in the positions attribute, which is parallel to the list."""
+
+
+class Parser:
+
+    """A hand-written scanner and recursive descent parser for templates.
+
+    Literal text is located with str.find('{{') and sliced out of the source
+    in a single step, so parsing is linear in the size of the template. The
+    output is a tokenised tree of tuples, for instance:
+
+        ['template', ('literal', u'Hi '), ('escapedexpand', ('path', [u'name']), [])]
+
+    Every rule takes a position in the source and returns a (value, position)
+    tuple on success or None on failure. The furthest position at which a
+    rule failed is tracked for error reporting.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.length = len(source)
+        self.furthest = 0
+
+    def parse(self):
+        """
+        Parses the whole source
+
+        :return:
+            A tuple of (tree, position) - if position is less than the length
+            of the source, it is where the error that stopped the parser was
+            encountered
+        """
+
+        tree, position = self.template(0)
+        if position < self.length:
+            # For compatibility with the original PyMeta grammar, a construct
+            # left open at the end of the source is not reported as an error
+            position = max(position, self.furthest)
+        return tree, position
+
+    def _fail(self, position):
+        if position > self.furthest:
+            self.furthest = min(position, self.length - 1)
+        return None
+
+    def _eof(self):
+        # A rule that runs off the end of the source moves the error position
+        # past the end, so it is not reported
+        self.furthest = self.length
+        return None
+
+    def _spaces(self, position):
+        return _spaces_re.match(self.source, position).end()
+
+    def _finish(self, position):
+        if self.source.startswith(u'}}', position):
+            return position + 2
+        return self._fail(position)
+
+    def template(self, position):
+        source = self.source
+        length = self.length
+        find = source.find
+        startswith = source.startswith
+        match_whitespace = _whitespace_text_re.match
+
+        body = _Body(['template'])
+        append = body.append
+        positions = body.positions = [None]
+        mark = positions.append
+        while position < length:
+            mark(position)
+            if startswith(u'{{', position):
+                result = self.templatecommand(position)
+                if result is None:
+                    positions.pop()
+                    break
+                node, position = result
+                append(node)
+                continue
+
+            char = source[position]
+            if char == u'\n':
+                append(('newline', u'\n'))
+                position += 1
+            elif char == u'\r' and startswith(u'\n', position + 1):
+                append(('newline', u'\n'))
+                position += 2
+            elif char == u' ' or char == u'\t':
+                end = match_whitespace(source, position).end()
+                append(('whitespace', source[position:end]))
+                position = end
+            else:
+                end = find(u'{{', position)
+                if end == -1:
+                    end = length
+                append(('literal', source[position:end]))
+                position = end
+        if position >= length:
+            self._eof()
+        return body, position
+
+    def templatecommand(self, position):
+        char = self.source[position + 2:position + 3]
+        if char == u'#':
+            return self.blockrule(position, 'block')
+        if char == u'^':
+            return self.blockrule(position, 'invertedblock') or self.escapedexpression(position)
+        if char == u'!':
+            return self.comment(position)
+        if char == u'{':
+            return self.expression(position, u'}') or self.rawblock(position)
+        if char == u'&':
+            return self.expression(position, u'')
+        if char == u'>':
+            return self.partial(position)
+        return self.escapedexpression(position)
+
+    def comment(self, position):
+        end = self.source.find(u'}}', position + 3)
+        if end == -1:
+            return self._eof()
+        return ('comment', ), end + 2
+
+    def expression_inner(self, position):
+        position = self._spaces(position)
+        result = self.path(position)
+        if result is None:
+            return None
+        path, position = result
+        arguments, position = self.arguments(position)
+        position = self._finish(self._spaces(position))
+        if position is None:
+            return None
+        return (path, arguments), position
 
-# this grammar compiles the template to python
-compile_grammar = """
-compile ::= <prolog> <rule>* => builder.finish()
-prolog ::= "template" => builder.start()
-rule ::= <literal>
-    | <expand>
-    | <escapedexpand>
-    | <comment>
-    | <block>
-    | <invertedblock>
-    | <rawblock>
-    | <partial>
-block ::= [ "block" <anything>:symbol [<arg>*:arguments] [<compile>:t] [<compile>?:alt_t] ] => builder.add_block(symbol, arguments, t, alt_t)
-comment ::= [ "comment" ]
-literal ::= [ ( "literal" | "newline" | "whitespace" ) :value ] => builder.add_literal(value)
-expand ::= [ "expand" <path>:value [<arg>*:arguments]] => builder.add_expand(value, arguments)
-escapedexpand ::= [ "escapedexpand" <path>:value [<arg>*:arguments]] => builder.add_escaped_expand(value, arguments)
-invertedblock ::= [ "invertedblock" <anything>:symbol [<arg>*:arguments] [<compile>:t] [<compile>?:alt_t] ] => builder.add_invertedblock(symbol, arguments, t, alt_t)
-rawblock ::= [ "rawblock" <anything>:symbol [<arg>*:arguments] <anything>:raw ] => builder.add_rawblock(symbol, arguments, raw)
-partial ::= ["partial" <complexarg>:symbol [<arg>*:arguments]] => builder.add_partial(symbol, arguments)
-path ::= [ "path" [<pathseg>:segment]] => ("simple", segment)
- | [ "path" [<pathseg>+:segments] ] => ("complex", u"resolve(context, u'" + u"', u'".join(segments) + u"')" )
-complexarg ::= [ "path" [<pathseg>+:segments] ] => u"resolve(context, u'" + u"', u'".join(segments) + u"')"
-    | [ "subexpr" ["path" <pathseg>:name] [<arg>*:arguments] ] => u'resolve_subexpr(helpers, "' + name + '", context' + (u', ' + u', '.join(arguments) if arguments else u'') + u')'
-    | [ "literalparam" <anything>:value ] => {str_class}(value)
-arg ::= [ "kwparam" <anything>:symbol <complexarg>:a ] => {str_class}(symbol) + '=' + a
-    | <complexarg>
-pathseg ::= "/" => ''
-    | "." => ''
-    | "" => ''
-    | "this" => ''
-pathseg ::= <anything>:symbol => u''.join(symbol)
-"""  # noqa: E501
-compile_grammar = compile_grammar.format(str_class=str_class.__name__)
+    def escapedexpression(self, position):
+        result = self.expression_inner(position + 2)
+        if result is None:
+            return None
+        inner, position = result
+        return ('escapedexpand', ) + inner, position
+
+    def expression(self, position, closing):
+        result = self.expression_inner(position + 3)
+        if result is None:
+            return None
+        inner, position = result
+        if closing:
+            if not self.source.startswith(closing, position):
+                return self._fail(position - 1)
+            position += 1
+        return ('expand', ) + inner, position
+
+    def block_inner(self, position):
+        result = self.symbol(self._spaces(position))
+        if result is None:
+            return None
+        symbol, position = result
+        arguments, position = self.arguments(position)
+        position = self._finish(self._spaces(position))
+        if position is None:
+            return None
+        return (symbol, arguments), position
+
+    def alt_inner(self, position):
+        char = self.source[position:position + 1]
+        if char != u'^' and char != u'e' and not char.isspace():
+            return self._fail(position)
+        position = self._spaces(position)
+        if self.source.startswith(u'^', position):
+            position += 1
+        elif self.source.startswith(u'else', position):
+            position += 4
+        else:
+            return self._fail(position)
+        return self._finish(self._spaces(position))
+
+    def blockrule(self, position, kind):
+        result = self.block_inner(position + 3)
+        if result is None:
+            return None
+        (symbol, arguments), position = result
+        nested, position = self.template(position)
+
+        alt_nested = []
+        if self.source.startswith(u'{{', position):
+            alt_position = self.alt_inner(position + 2)
+            if alt_position is not None:
+                alt_nested, position = self.template(alt_position)
+
+        position = self.symbolfinish(position, symbol)
+        if position is None:
+            return None
+        return (kind, symbol, arguments, nested, alt_nested), position
+
+    def symbolfinish(self, position, expected):
+        if not self.source.startswith(u'{{/', position):
+            return self._fail(position)
+        result = self.symbol(position + 3)
+        if result is None:
+            return None
+        found, position = result
+        if found != expected:
+            return self._fail(position)
+        return self._finish(position)
+
+    def partial(self, position):
+        position = self._spaces(position + 3)
+        result = self.partialname(position)
+        if result is None:
+            return None
+        name, position = result
+        arguments, position = self.arguments(position)
+        position = self._finish(self._spaces(position))
+        if position is None:
+            return None
+        return ('partial', name, arguments), position
+
+    def partialname(self, position):
+        if position >= self.length:
+            return self._eof()
+        result = self.subexpression(position)
+        if result is not None:
+            return result
+        end = self.alt_inner(position)
+        if end is not None:
+            return self._fail(end - 1)
+
+        source = self.source
+        length = self.length
+        if position < length and source[position] in u'["':
+            position += 1
+        start = position
+        while position < length:
+            char = source[position]
+            if char in u' \t\r\n]"' or source.startswith(u'}}', position):
+                break
+            position += 1
+        if position == start:
+            return self._fail(position)
+        symbol = source[start:position]
+        if position >= length:
+            self._eof()
+        elif source[position] in u']"':
+            position += 1
+        return ('literalparam', u'"' + symbol + u'"'), position
+
+    def rawblock(self, position):
+        if not self.source.startswith(u'{{{{', position):
+            return self._fail(position + 2)
+        result = self.block_inner(position + 4)
+        if result is None:
+            return None
+        (symbol, arguments), position = result
+        if not self.source.startswith(u'}}', position):
+            return self._fail(position - 1)
+        position += 2
+
+        find = self.source.find
+        start = position
+        end = find(u'{{{{/', position)
+        while end != -1:
+            finish = self.symbolfinish(end + 2, symbol)
+            if finish is not None:
+                finish = self._finish(finish)
+                if finish is not None:
+                    return ('rawblock', symbol, arguments, self.source[start:end]), finish
+            end = find(u'{{{{/', end + 1)
+        return self._eof()
+
+    def arguments(self, position):
+        source = self.source
+        length = self.length
+        arguments = []
+        while position < length and source[position] in u' \t\r\n':
+            start = position
+            while position < length and source[position] in u' \t\r\n':
+                position += 1
+            result = self.argument(position)
+            if result is None:
+                return arguments, start
+            argument, position = result
+            arguments.append(argument)
+        return arguments, position
+
+    def argument(self, position):
+        return (
+            self.kwliteral(position)
+            or self.literal(position)
+            or self.path(position)
+            or self.subexpression(position)
+        )
+
+    def subexpression(self, position):
+        if not self.source.startswith(u'(', position):
+            return self._fail(position)
+        result = self.path(self._spaces(position + 1))
+        if result is None:
+            return None
+        path, position = result
+        arguments, position = self.arguments(position)
+        position = self._spaces(position)
+        if not self.source.startswith(u')', position):
+            return self._fail(position)
+        return ('subexpr', path, arguments), position + 1
+
+    def kwliteral(self, position):
+        result = self.safesymbol(position)
+        if result is None:
+            return None
+        symbol, position = result
+        if not self.source.startswith(u'=', position):
+            return self._fail(position)
+        result = (
+            self.literal(position + 1)
+            or self.path(position + 1)
+            or self.subexpression(position + 1)
+        )
+        if result is None:
+            return None
+        value, position = result
+        return ('kwparam', symbol, value), position
+
+    def safesymbol(self, position):
+        if position >= self.length:
+            return self._eof()
+        end = self.alt_inner(position)
+        if end is not None:
+            return self._fail(end - 1)
+        source = self.source
+        length = self.length
+        if source.startswith(u'[', position):
+            position += 1
+        start = position
+        if position < length and (source[position].isalpha() or source[position] == u'_'):
+            position = _safesymbol_re.match(source, position + 1).end()
+        else:
+            return self._fail(position)
+        if position == start + 1:
+            return self._fail(position)
+        symbol = source[start:position]
+        if source.startswith(u']', position):
+            position += 1
+        elif position >= length:
+            self._eof()
+        return symbol, position
+
+    def symbol(self, position):
+        source = self.source
+        length = self.length
+        if position >= length:
+            return self._eof()
+        char = source[position]
+        if char == u'e' or char == u'^' or char.isspace():
+            end = self.alt_inner(position)
+            if end is not None:
+                return self._fail(end - 1)
+        if source.startswith(u'[', position):
+            position += 1
+        start = position
+        position = _symbol_re.match(source, position).end()
+        if position == start:
+            return self._fail(position)
+        symbol = source[start:position]
+        if source.startswith(u']', position):
+            position += 1
+        elif position >= length:
+            self._eof()
+        return symbol, position
+
+    def literal(self, position):
+        if position >= self.length:
+            return self._eof()
+        source = self.source
+        char = source[position:position + 1]
+        if char == u'"' or char == u"'":
+            return self.string(position, char)
+        if char == u'-' or char.isdigit():
+            return self.integer(position)
+        for word, value in _literal_words:
+            if source.startswith(word, position):
+                return ('literalparam', value), position + len(word)
+        return self._fail(position)
+
+    def string(self, position, quote):
+        source = self.source
+        length = self.length
+        position += 1
+        chars = []
+        append = chars.append
+        while position < length:
+            char = source[position]
+            if char == u'\\' and source[position + 1:position + 2] in (u'"', u"'"):
+                append(source[position:position + 2])
+                position += 2
+                continue
+            if char == quote:
+                return ('literalparam', quote + u''.join(chars) + quote), position + 1
+            append(_string_escapes.get(char, char))
+            position += 1
+        return self._eof()
+
+    def integer(self, position):
+        source = self.source
+        length = self.length
+        start = position
+        if source[position] == u'-':
+            position += 1
+        digits = position
+        while position < length and source[position].isdigit():
+            position += 1
+        if position == digits:
+            return self._fail(position)
+        return ('literalparam', int(source[start:position])), position
+
+    def path(self, position):
+        if position >= self.length:
+            return self._eof()
+        if self.source.startswith(u'/', position):
+            return self._fail(position)
+        segments = []
+        while True:
+            result = self.pathseg(position)
+            if result is None:
+                break
+            segment, position = result
+            segments.append(segment)
+        if not segments:
+            return None
+        return ('path', segments), position
+
+    def pathseg(self, position):
+        source = self.source
+        char = source[position:position + 1]
+        if char == u'.':
+            if source.startswith(u'../', position):
+                return u'@_parent', position + 3
+            return u'', position + 1
+        if char == u'/':
+            return u'', position + 1
+        if char == u'[' and not source.startswith(u']', position + 1):
+            end = source.find(u']', position + 1)
+            if end != -1:
+                return source[position + 1:end], end + 1
+            self._eof()
+        elif char == u'@' and source.startswith(u'@../', position):
+            return u'@@_parent', position + 4
+        return self.symbol(position)
+
+
+_literal_words = (
+    (u'false', False),
+    (u'true', True),
+    (u'null', None),
+    (u'undefined', None),
+)
+
+_string_escapes = {
+    u'\n': u'\\n',
+    u'\r': u'\\r',
+    u'\\': u'\\\\',
+}
 
 
 class PybarsError(Exception):
@@ -199,10 +575,107 @@ class strlist(list):
         else:
             # Recursively expand to a flat list; may deserve a C accelerator at
             # some point.
+            try:
+                for element in thing:
+                    self.grow(element)
+            except TypeError:
+                # The output of a block of a template rendering
+                # asynchronously is a coroutine, which the template awaits
+                # once the block helper returns
+                if not hasattr(thing, '__await__'):
+                    raise
+                self.append(thing)
+
+
+class byteslist(list):
+
+    """The strlist of templates compiled with an encoding, holding the
+    output encoded.
+
+    Templates use the subclass for their encoding from byteslist_class(),
+    so that making one is as cheap as making a strlist.
+    """
+
+    __slots__ = ()
+
+    encoding = None
+
+    def __bytes__(self):  # Python 3
+        return b''.join(self)
+
+    def __str__(self):  # Python 3
+        return b''.join(self).decode(self.encoding)
+
+    def __unicode__(self):  # Python 2
+        return b''.join(self).decode(self.encoding)
+
+    def grow(self, thing):
+        """Make the list longer, encoding unicode, appending bytes and extending otherwise."""
+        # The text is appended encoded already, so what grows the list is
+        # mostly values
+        type_ = type(thing)
+        if type_ is str_class:
+            self.append(thing.encode(self.encoding))
+        elif type_ is bytes:
+            self.append(thing)
+        else:
             for element in thing:
                 self.grow(element)
 
 
+_byteslist_classes = {}
+
+
+def byteslist_class(encoding):
+    """
+    :param encoding:
+        The name of an encoding
+
+    :return:
+        The subclass of byteslist encoding unicode strings in it
+    """
+
+    cls = _byteslist_classes.get(encoding)
+    if cls is None:
+        cls = _byteslist_classes[encoding] = type('byteslist', (byteslist,), {'__slots__': (), 'encoding': encoding})
+    return cls
+
+
+def join_bytes(output):
+    """
+    :param output:
+        The output of the _render() function of a template compiled with an
+        encoding
+
+    :return:
+        A byte string
+    """
+
+    if type(output) is bytes:
+        return output
+    return b''.join(output)
+
+
+def decode_output(output, encoding):
+    """
+    :param output:
+        The output of the _render() function of a template compiled with an
+        encoding, or of a block of one
+
+    :param encoding:
+        The encoding the template was compiled with
+
+    :return:
+        A unicode string
+    """
+
+    if type(output) is bytes:
+        return output.decode(encoding)
+    if type(output) is str_class:
+        return output
+    return b''.join(output).decode(encoding)
+
+
 _map = {
     '&': '&amp;',
     '"': '&quot;',
@@ -224,29 +697,60 @@ def escape(something, _escape_re=_escape_re, substitute=substitute):
     return _escape_re.sub(substitute, something)
 
 
-def pick(context, name, default=None):
-    try:
-        return context[name]
-    except (KeyError, TypeError, AttributeError):
-        if isinstance(name, basestring):
-            try:
-                exists = hasattr(context, name)
-            except UnicodeEncodeError:
-                # Python 2 raises UnicodeEncodeError on non-ASCII strings
-                pass
-            else:
-                if exists:
-                    return getattr(context, name)
-        if hasattr(context, 'get'):
-            return context.get(name)
-        return default
+# How pick() looks names up in the instances of each type: _ITEMS tries item
+# access first, _ATTRIBUTES goes straight to attributes, for types such as
+# dataclasses and ORM models, and _NUMBERED tries item access for integer
+# names only, for sequences such as namedtuples, whose item access rejects
+# strings with TypeError. This saves handling an exception on every lookup.
+# Other types may reject only some names or instances, so they keep trying.
+_item_access = {}
 
+_ATTRIBUTES = 0
+_ITEMS = 1
+_NUMBERED = 2
 
 sentinel = object()
 
 
+def pick(context, name, default=None):
+    type_ = type(context)
+    item_access = _item_access.get(type_)
+    if item_access is None:
+        # Types created at runtime must not make the cache grow forever
+        if len(_item_access) > 1000:
+            _item_access.clear()
+        item_access = _item_access[type_] = _ITEMS if hasattr(type_, '__getitem__') else _ATTRIBUTES
+    if item_access == _ITEMS or (item_access == _NUMBERED and not isinstance(name, basestring)):
+        try:
+            return context[name]
+        except (KeyError, AttributeError):
+            pass
+        except TypeError:
+            if isinstance(name, basestring) and issubclass(type_, (tuple, list)):
+                _item_access[type_] = _NUMBERED
+    if isinstance(name, basestring):
+        try:
+            value = getattr(context, name, sentinel)
+        except UnicodeEncodeError:
+            # Python 2 raises UnicodeEncodeError on non-ASCII strings
+            value = sentinel
+        if value is not sentinel:
+            return value
+    if hasattr(context, 'get'):
+        return context.get(name)
+    return default
+
+
 class Scope:
 
+    """The context of a template or block, with the data variables of it.
+
+    An #each block creates one for every item, so the fields are slots
+    rather than a __dict__, making each of them a single small allocation.
+    """
+
+    __slots__ = ('context', 'parent', 'root', 'overrides', 'index', 'key', 'first', 'last')
+
     def __init__(self, context, parent, root, overrides=None, index=None, key=None, first=None, last=None):
         self.context = context
         self.parent = parent
@@ -326,6 +830,57 @@ def resolve(context, *segments):
     return context
 
 
+def resolve_name(scope, name):
+    """
+    Looks up a name in a Scope the way Scope.get() does, for the code
+    generated for names that the compiler knows are neither data variables
+    nor "this"
+
+    :param scope:
+        The Scope of the generated function
+
+    :param name:
+        A name not starting with @
+
+    :return:
+        The value of the name
+    """
+
+    overrides = scope.overrides
+    if overrides and name in overrides:
+        return overrides[name]
+    context = scope.context
+    if type(context) is dict and name in context:
+        return context[name]
+    return pick(context, name)
+
+
+def resolve_segment(context, segment):
+    """
+    Looks up one segment of a path the way resolve() does, for the code
+    generated for paths
+
+    :param context:
+        The value the previous segments resolved to
+
+    :param segment:
+        A path segment, other than an empty one or "length" on a list or
+        tuple, which the generated code handles
+
+    :return:
+        The value of the segment
+    """
+
+    if context is None:
+        return None
+    if type(context) in (list, tuple):
+        offset = int(segment)
+        return context[offset] if offset < len(context) else {}
+    if isinstance(context, Scope):
+        return context.get(segment)
+    return pick(context, segment)
+
+
 def resolve_subexpr(helpers, name, context, *args, **kwargs):
     if name not in helpers:
         raise PybarsError(u"Could not find property %s" % (name,))
@@ -360,212 +915,984 @@ def prepare(value, should_escape):
     return value
 
 
+def encode_value(value, should_escape, encoding):
+    """
+    Prepares a value to be added to the result of a template compiled with
+    an encoding, as prepare() does, in one call
+
+    :param value:
+        The value to add to the result
+
+    :param should_escape:
+        If the string should be HTML-escaped
+
+    :param encoding:
+        The encoding of the template
+
+    :return:
+        A byte string
+    """
+
+    if value is None:
+        return b''
+    type_ = type(value)
+    if type_ is strlist:
+        return u''.join(value).encode(encoding)
+    if type_ is not str_class:
+        if type_ is bool:
+            value = u'true' if value else u'false'
+        else:
+            value = str_class(value)
+    if should_escape:
+        value = escape(value)
+    return value.encode(encoding)
+
+
 def ensure_scope(context, root):
     return context if isinstance(context, Scope) else Scope(context, context, root)
 
 
-def _each(this, options, context):
-    result = strlist()
+def _no_block(this):
+    return None
 
-    # All sequences in python have a length
-    try:
-        last_index = len(context) - 1
 
-        # If there are no items, we want to trigger the else clause
-        if last_index < 0:
-            raise IndexError()
+class Options(MutableMapping):
 
-    except (TypeError, IndexError):
-        return options['inverse'](this)
+    """The options passed to block helpers.
 
-    # We use the presence of a keys method to determine if the
-    # key attribute should be passed to the block handler
-    has_keys = hasattr(context, 'keys')
+    A mapping with the keys fn, inverse, helpers, partials and root, holding
+    the generated functions of the block as they are: fn and inverse are
+    bound methods passing the helpers, partials and root along, so a block
+    helper call allocates nothing besides this object. Helpers may set and
+    delete keys as they could when the options were a dict, which are kept
+    in a dict created on the first change.
+    """
 
-    index = 0
-    for value in context:
-        kwargs = {
-            'index': index,
-            'first': index == 0,
-            'last': index == last_index
-        }
+    __slots__ = ('_fn', '_inverse', 'helpers', 'partials', 'root', '_changes')
 
-        if has_keys:
-            kwargs['key'] = value
-            value = context[value]
+    _keys = ('fn', 'inverse', 'helpers', 'partials', 'root')
 
-        scope = Scope(value, this, options['root'], **kwargs)
+    def __init__(self, fn, inverse, helpers, partials, root):
+        """
+        :param fn:
+            The function rendering the block, or None
 
-        # Necessary because of cases such as {{^each things}}test{{/each}}.
-        try:
-            result.grow(options['fn'](scope))
-        except TypeError:
-            pass
-        index += 1
+        :param inverse:
+            The function rendering the else part of the block, or None
+        """
 
-    return result
+        self._fn = fn
+        self._inverse = inverse
+        self.helpers = helpers
+        self.partials = partials
+        self.root = root
+        # The keys set or deleted by helpers, the deleted ones mapped to
+        # _deleted
+        self._changes = None
+
+    def __getitem__(self, name):
+        changes = self._changes
+        if changes is not None and name in changes:
+            value = changes[name]
+            if value is _deleted:
+                raise KeyError(name)
+            return value
+        if name == 'fn':
+            return _no_block if self._fn is None else self._render_fn
+        if name == 'inverse':
+            return _no_block if self._inverse is None else self._render_inverse
+        if name in ('helpers', 'partials', 'root'):
+            return getattr(self, name)
+        raise KeyError(name)
+
+    def _render_fn(self, this):
+        output = self._fn(this, self.helpers, self.partials, self.root)
+        return _block_output(output) if type(output) is str_class else output
+
+    def _render_inverse(self, this):
+        output = self._inverse(this, self.helpers, self.partials, self.root)
+        return _block_output(output) if type(output) is str_class else output
+
+    def __setitem__(self, name, value):
+        if self._changes is None:
+            self._changes = {}
+        self._changes[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        if self._changes is None:
+            self._changes = {}
+        if name in self._keys:
+            self._changes[name] = _deleted
+        else:
+            del self._changes[name]
 
+    def __iter__(self):
+        changes = self._changes
+        if changes is None:
+            return iter(self._keys)
+        keys = [key for key in self._keys if changes.get(key) is not _deleted]
+        keys.extend(key for key, value in changes.items() if key not in self._keys and value is not _deleted)
+        return iter(keys)
 
-def _if(this, options, context):
-    if hasattr(context, '__call__'):
-        context = context(this)
-    if context:
-        return options['fn'](this)
-    else:
-        return options['inverse'](this)
+    def __len__(self):
+        if self._changes is None:
+            return len(self._keys)
+        return len(list(iter(self)))
 
+    def copy(self):
+        """
+        :return:
+            A dict of the options, as dict.copy() gave when they were a dict
+        """
 
-def _log(this, context):
-    pybars.log(context)
+        return dict(self.items())
 
 
-def _unless(this, options, context):
-    if not context:
-        return options['fn'](this)
-    else:
-        return options['inverse'](this)
+# Marks the keys of Options deleted by helpers
+_deleted = object()
 
 
-def _lookup(this, context, key):
-    try:
-        return context[key]
-    except (KeyError, IndexError, TypeError):
-        return
+class StreamOptions(Options):
 
+    """The options passed to block helpers by streaming templates.
 
-def _blockHelperMissing(this, options, context):
-    if hasattr(context, '__call__'):
-        context = context(this)
-    if context != u"" and not context:
-        return options['inverse'](this)
-    if type(context) in (list, strlist, tuple):
-        return _each(this, options, context)
-    if context is True:
-        callwith = this
-    else:
-        callwith = context
-    return options['fn'](callwith)
+    The functions of the blocks are generators there, so fn and inverse
+    collect their output into a strlist as block helpers expect.
+    """
 
+    __slots__ = ()
 
-def _helperMissing(scope, name, *args):
-    if not args:
-        return None
-    raise PybarsError(u"Could not find property %s" % (name,))
+    def _render_fn(self, this):
+        return _collect(self._fn(this, self.helpers, self.partials, self.root))
 
+    def _render_inverse(self, this):
+        return _collect(self._inverse(this, self.helpers, self.partials, self.root))
 
-def _with(this, options, context):
-    return options['fn'](context)
 
+class BytesOptions(Options):
 
-# scope for the compiled code to reuse globals
-_pybars_ = {
-    'helpers': {
-        'blockHelperMissing': _blockHelperMissing,
-        'each': _each,
-        'if': _if,
-        'helperMissing': _helperMissing,
-        'log': _log,
-        'unless': _unless,
-        'with': _with,
-        'lookup': _lookup,
-    },
-}
+    """The options passed to block helpers by templates compiled with an
+    encoding.
 
+    The functions of the blocks return encoded output there, so fn and
+    inverse decode it, and block helpers get text as they do from other
+    templates.
+    """
 
-class FunctionContainer:
+    __slots__ = ()
 
+    def _render_fn(self, this):
+        return _decode(self._fn(this, self.helpers, self.partials, self.root))
+
+    def _render_inverse(self, this):
+        return _decode(self._inverse(this, self.helpers, self.partials, self.root))
+
+
+def _decode(output):
     """
-    Used as a container for functions by the CodeBuidler
+    :param output:
+        The output of a block of a template compiled with an encoding
+
+    :return:
+        The output as a strlist
     """
 
-    def __init__(self, name, code):
-        self.name = name
-        self.code = code
+    if type(output) is str_class:
+        return _block_output(output)
+    if not isinstance(output, byteslist):
+        return output
+    result = strlist()
+    result.append(str_class(output))
+    return result
 
-    @property
-    def full_code(self):
-        headers = (
-            u'import pybars\n'
-            u'\n'
-            u'if pybars.__version__ != %s:\n'
-            u'    raise pybars.PybarsError("This template was precompiled with pybars3 version %s, running version %%s" %% pybars.__version__)\n'
-            u'\n'
-            u'from pybars import strlist, Scope, PybarsError\n'
-            u'from pybars._compiler import _pybars_, escape, resolve, resolve_subexpr, prepare, ensure_scope\n'
-            u'\n'
-            u'from functools import partial\n'
-            u'\n'
-            u'\n'
-        ) % (repr(pybars.__version__), pybars.__version__)
 
-        return headers + self.code
+def _block_output(text):
+    """
+    :param text:
+        The text a block without expressions returns
 
+    :return:
+        The text in a strlist, which block helpers expect from every block
+    """
 
-class CodeBuilder:
+    result = strlist()
+    result.append(text)
+    return result
 
-    """Builds code for a template."""
 
-    def __init__(self):
-        self._reset()
+def _collect(pieces):
+    # The functions of blocks returning constants are not generators
+    if type(pieces) is str_class:
+        return _block_output(pieces)
+    result = strlist()
+    append = result.append
+    for piece in pieces:
+        if type(piece) is str_class:
+            append(piece)
+        else:
+            result.grow(piece)
+    return result
+
+
+def bind_template(render, helpers=None, partials=None, encoding=None):
+    """
+    Implements template.bind() for compiled templates
+
+    :param render:
+        The _render() function of the template
+
+    :param helpers:
+        A dict of helpers, merged with the built-in ones now rather than on
+        every render
+
+    :param partials:
+        A dict of partials, or another mapping such as a TemplateIndex,
+        which is used as it is
+
+    :param encoding:
+        The encoding the template was compiled with, if any
+
+    :return:
+        A function taking only the context and returning a unicode string,
+        or a byte string if the template was compiled with an encoding
+    """
+
+    merged = dict(_pybars_['helpers'])
+    if helpers is not None:
+        merged.update(helpers)
+    if partials is None:
+        partials = {}
+    elif isinstance(partials, dict):
+        partials = dict(partials)
+
+    if encoding is not None:
+        def bound(context):
+            return join_bytes(render(context, merged, partials, context))
+    else:
+        def bound(context):
+            return str_class(render(context, merged, partials, context))
+
+    bound.helpers = merged
+    bound.partials = partials
+    return bound
+
+
+def template_variant(template, mode):
+    """
+    Finds the _render() function generated for another mode of CodeBuilder,
+    compiling the template in that mode the first time
+
+    :param template:
+        A template function, or anything else that may be a partial
+
+    :param mode:
+        One of the modes of CodeBuilder
+
+    :return:
+        The function, or None if template is not a compiled template. The
+        functions of other modes produce unicode strings, even for templates
+        compiled with an encoding.
+    """
+
+    render = getattr(template, '_pybars_render', None)
+    if render is None:
+        render = getattr(template, '_pybars_bytes', None)
+        if render is None:
+            return None
+    elif mode == 'render':
+        return render
+    namespace = render.__globals__
+    variants = namespace['_pybars_variants']
+    variant = variants.get(mode)
+    if variant is None:
+        known_helpers, known_helpers_only = namespace['_pybars_options']
+        variant = variants[mode] = Compiler()._compile_variant(
+            namespace['_pybars_source'], known_helpers, known_helpers_only, mode)
+    return variant
+
+
+def stream_template(template, context, helpers=None, partials=None, chunk_size=8192):
+    """
+    Implements template.stream() for compiled templates
+
+    :param template:
+        The render() function of the template
+
+    :param chunk_size:
+        The length a chunk reaches before it is yielded, or 0 to yield the
+        output of each construct as it renders
+
+    :return:
+        A generator of unicode strings, or of byte strings if the template
+        was compiled with an encoding
+    """
+
+    render = template_variant(template, 'stream')
+    encoding = getattr(template, '_pybars_encoding', None)
+    merged = dict(_pybars_['helpers'])
+    if helpers is not None:
+        merged.update(helpers)
+    if partials is None:
+        partials = {}
+
+    buffer = strlist()
+    size = 0
+    for piece in render(context, merged, partials, context):
+        if type(piece) is str_class:
+            buffer.append(piece)
+            size += len(piece)
+        else:
+            start = len(buffer)
+            buffer.grow(piece)
+            size += sum(len(part) for part in buffer[start:])
+        if size >= chunk_size and size:
+            chunk = u''.join(buffer)
+            yield chunk if encoding is None else chunk.encode(encoding)
+            del buffer[:]
+            size = 0
+    if size:
+        chunk = u''.join(buffer)
+        yield chunk if encoding is None else chunk.encode(encoding)
+
+
+def render_to_template(template, sink, context, helpers=None, partials=None, buffer_size=8192):
+    """
+    Implements template.render_to() for compiled templates, writing the
+    output as it renders rather than building the whole string
+
+    :param template:
+        The render() function of the template
+
+    :param sink:
+        An object with a write() method taking unicode strings, such as a
+        file opened in text mode. For templates compiled with an encoding,
+        an object with a write() method taking byte strings, a bytearray
+        to extend or a writable memoryview to fill from its start.
+
+    :param buffer_size:
+        The length the output reaches before it is written, or 0 to write
+        the output of each construct as it renders
+
+    :return:
+        The number of characters written, or of bytes for templates
+        compiled with an encoding
+    """
+
+    chunks = stream_template(template, context, helpers, partials, buffer_size)
+    written = 0
+    if isinstance(sink, memoryview):
+        capacity = len(sink)
+        for chunk in chunks:
+            end = written + len(chunk)
+            if end > capacity:
+                raise PybarsError(u"The output does not fit in the %d bytes of the memoryview" % capacity)
+            sink[written:end] = chunk
+            written = end
+        return written
+
+    write = sink.extend if isinstance(sink, bytearray) else sink.write
+    for chunk in chunks:
+        write(chunk)
+        written += len(chunk)
+    return written
+
+
+def render_async_template(template, context, helpers=None, partials=None):
+    """
+    Implements template.render_async() for compiled templates, on Python
+    3.5 and newer
+
+    :param template:
+        The render() function of the template
+
+    :return:
+        A coroutine returning a unicode string
+    """
+
+    # The module uses syntax that Python 2 cannot parse
+    from pybars._async import render_template
+    return render_template(template, context, helpers, partials)
+
+
+def _lasts(length):
+    """
+    :return:
+        An iterator of the @last values of as many items as the length, and
+        False for any more items
+    """
+
+    return chain(repeat(False, length - 1), (True,), repeat(False))
+
+
+def _keyed_items(context, length):
+    last_index = length - 1
+    for index, key in enumerate(context):
+        yield index, key, context[key], index == last_index
+
+
+def _lookahead_items(first, iterator, keyed, context):
+    """
+    Finds out which item of an iterable without a length is the last one
+    by fetching each next one before the current one renders
+    """
+
+    index = 0
+    for following in iterator:
+        yield index, first if keyed else None, context[first] if keyed else first, False
+        first = following
+        index += 1
+    yield index, first if keyed else None, context[first] if keyed else first, True
+
+
+def each_items(context, data):
+    """
+    Prepares the value of an each block for iterating over it
+
+    Iterables without a length, such as generators and database cursors,
+    are iterated lazily, with one item fetched ahead to tell if there are
+    any and which is the last.
+
+    :param context:
+        The value of the block
+
+    :param data:
+        If the items are needed with the values of the data variables
+
+    :return:
+        None if there are no items, otherwise an iterator of the items or,
+        if data is True, of (index, key, item, last) tuples
+    """
+
+    type_ = type(context)
+    if type_ is list or type_ is tuple:
+        if not context:
+            return None
+        if not data:
+            return iter(context)
+        return zip(count(), repeat(None), context, _lasts(len(context)))
+
+    # We use the presence of a keys method to determine if the
+    # key attribute should be passed to the block handler
+    keyed = hasattr(context, 'keys')
+    try:
+        length = len(context)
+    except TypeError:
+        try:
+            iterator = iter(context)
+        except TypeError:
+            return None
+        for first in iterator:
+            break
+        else:
+            return None
+        if data:
+            return _lookahead_items(first, iterator, keyed, context)
+        if keyed:
+            return (context[key] for key in chain((first,), iterator))
+        return chain((first,), iterator)
+
+    if length <= 0:
+        return None
+    if type_ is dict:
+        if not data:
+            return iter(context.values())
+        return zip(count(), context.keys(), context.values(), _lasts(length))
+    if keyed:
+        if not data:
+            return (context[key] for key in context)
+        return _keyed_items(context, length)
+    if not data:
+        return iter(context)
+    return zip(count(), repeat(None), context, _lasts(length))
+
+
+def _each(this, options, context):
+    items = each_items(context, True)
+
+    # If there are no items, we want to trigger the else clause
+    if items is None:
+        return options['inverse'](this)
+
+    result = strlist()
+    fn = options['fn']
+    # Necessary because of cases such as {{^each things}}test{{/each}}.
+    if fn is _no_block:
+        return result
+
+    root = options['root']
+    # The fields are passed by position, which is faster than keywords
+    for index, key, value, last in items:
+        # An item raising TypeError renders nothing
+        try:
+            result.grow(fn(Scope(value, this, root, None, index, key, index == 0, last)))
+        except TypeError:
+            pass
+
+    return result
+
+
+def _if(this, options, context):
+    if hasattr(context, '__call__'):
+        context = context(this)
+    if context:
+        return options['fn'](this)
+    else:
+        return options['inverse'](this)
+
+
+def _log(this, context):
+    pybars.log(context)
+
+
+def _unless(this, options, context):
+    if not context:
+        return options['fn'](this)
+    else:
+        return options['inverse'](this)
+
+
+def _lookup(this, context, key):
+    try:
+        return context[key]
+    except (KeyError, IndexError, TypeError):
+        return
+
+
+def _blockHelperMissing(this, options, context):
+    if hasattr(context, '__call__'):
+        context = context(this)
+    if context != u"" and not context:
+        return options['inverse'](this)
+    if type(context) in (list, strlist, tuple):
+        return _each(this, options, context)
+    if context is True:
+        callwith = this
+    else:
+        callwith = context
+    return options['fn'](callwith)
+
+
+def _helperMissing(scope, name, *args):
+    if not args:
+        return None
+    raise PybarsError(u"Could not find property %s" % (name,))
+
+
+def _with(this, options, context):
+    return options['fn'](context)
+
+
+# scope for the compiled code to reuse globals
+_pybars_ = {
+    'helpers': {
+        'blockHelperMissing': _blockHelperMissing,
+        'each': _each,
+        'if': _if,
+        'helperMissing': _helperMissing,
+        'log': _log,
+        'unless': _unless,
+        'with': _with,
+        'lookup': _lookup,
+    },
+}
+
+
+def _known_helpers(known_helpers):
+    """
+    :param known_helpers:
+        None, an iterable of helper names or a dict of names to booleans
+
+    :return:
+        A frozenset of the names of the built-in helpers and the known ones
+    """
+
+    known = set(_pybars_['helpers'])
+    if isinstance(known_helpers, dict):
+        for name, enabled in known_helpers.items():
+            if enabled:
+                known.add(name)
+            else:
+                known.discard(name)
+    elif known_helpers is not None:
+        known.update(known_helpers)
+    return frozenset(known)
+
+
+class FunctionContainer:
+
+    """
+    Used as a container for functions by the CodeBuidler
+    """
+
+    def __init__(self, name, code, partials=frozenset(), marks=(), constructs=(), profile=False, constant=None,
+                 mode='render'):
+        self.name = name
+        self.code = code
+        # The mode of the CodeBuilder that generated the code
+        self.mode = mode
+        # The text the function returns, if it returns nothing else
+        self.constant = constant
+        self.partials = partials
+        # A list of (line within code, construct index or None) giving the
+        # construct each line from there on was generated for
+        self.marks = marks
+        # A list of (kind, line, column, text) - the compiler replaces the
+        # positions CodeBuilder records with lines and columns
+        self.constructs = constructs
+        self.profile = profile
+        # The original source and the options it was compiled with, set by
+        # the compiler so that the template can be compiled again in
+        # another mode - see template_variant()
+        self.source = None
+        self.options = None
+
+    @property
+    def full_code(self):
+        headers = (
+            u'import pybars\n'
+            u'\n'
+            u'if pybars.__version__ != %s:\n'
+            u'    raise pybars.PybarsError("This template was precompiled with pybars3 version %s, running version %%s" %% pybars.__version__)\n'
+            u'\n'
+            u'from pybars import strlist, Scope, PybarsError\n'
+            u'from pybars._compiler import _pybars_, escape, resolve, resolve_name, resolve_segment, resolve_subexpr, prepare, ensure_scope\n'
+            u'from pybars._compiler import bind_template, template_variant, stream_template, render_to_template\n'
+            u'from pybars._compiler import render_async_template\n'
+            u'from pybars._compiler import _each, _if, _unless, _with, Options, StreamOptions, each_items, _collect\n'
+            u'from pybars._compiler import byteslist_class, join_bytes, decode_output, encode_value, BytesOptions\n'
+            u'%s'
+            u'\n'
+            u'from functools import partial\n'
+            u'\n'
+            u'\n'
+        ) % (
+            repr(pybars.__version__),
+            pybars.__version__,
+            u'from pybars._async import AsyncOptions, await_value, resolve_output, each_async\n' if self.mode == 'async' else u'')
+
+        offset = headers.count(u'\n') + 1
+        source_map = []
+        for line, construct in self.marks:
+            if construct is None:
+                location = None
+            else:
+                location = tuple(self.constructs[construct][1:3])
+            if source_map and source_map[-1][0] == line + offset:
+                source_map.pop()
+            if not source_map or source_map[-1][1] != location:
+                source_map.append((line + offset, location))
+
+        footers = [
+            u'\n\n',
+            u'_pybars_constructs = %r\n' % (self.constructs,),
+            u'_pybars_source_map = %r\n' % (tuple(source_map),),
+            ]
+        if self.source is not None:
+            footers.append(
+                u'_pybars_source = %r\n'
+                u'_pybars_options = %r\n'
+                u'_pybars_variants = {}\n' % (self.source, self.options))
+        if self.profile:
+            footers.append(
+                u'\n'
+                u'from pybars._profiler import clock as _pybars_clock, record as _pybars_record\n'
+                u'_pybars_profile = [[0, 0.0] for _ in _pybars_constructs]\n')
+
+        return headers + self.code + u''.join(footers)
+
+
+# The public entry point of a template, which merges the helpers and, when
+# called by the user rather than as a partial, ensures the result is a string
+# and not a strlist. Templates compiled with an encoding return a byte
+# string, and text to the templates using them as partials.
+_RENDER_WRAPPER = u"""
+
+def render(context, helpers=None, partials=None, root=None):
+    _helpers = dict(_pybars_['helpers'])
+    if helpers is not None:
+        _helpers.update(helpers)
+    if partials is None:
+        partials = {}
+    if root is None:
+        return %(output)s(_render(context, _helpers, partials, context))
+    return %(partial_output)s
+
+
+render.%(attribute)s = _render
+render.bind = partial(bind_template, _render%(bind)s)
+render.stream = partial(stream_template, render)
+render.render_to = partial(render_to_template, render)
+render.render_async = partial(render_async_template, render)
+"""
+
+# A path segment that indexes lists
+_digits_re = re.compile(r'[0-9]+$')
+
+# The data variables that are fields of Scope
+_scope_fields = {
+    u'@_parent': 'parent',
+    u'@root': 'root',
+    u'@index': 'index',
+    u'@key': 'key',
+    u'@first': 'first',
+    u'@last': 'last',
+}
+
+# The built-in block helpers compiled into Python statements
+_native_blocks = ('if', 'unless', 'each', 'with')
+
+# The tree nodes that are plain text
+_literal_kinds = ('literal', 'newline', 'whitespace')
+
+# The kinds of code CodeBuilder generates, and the class of the options of
+# block helpers in each
+_modes = ('render', 'stream', 'async')
+_options_classes = {'render': u'Options', 'stream': u'StreamOptions', 'async': u'AsyncOptions'}
+
+# Whether generated generators can delegate with yield from
+_yield_from = sys.version_info >= (3, 3)
+
+_yield_re = re.compile(r'^\s*yield\b', re.M)
+
+
+def _arguments_use_data(arguments):
+    """
+    :param arguments:
+        A list of argument nodes, or paths, of a tree produced by Parser
+
+    :return:
+        True if any of the arguments may read a data variable other than
+        @root and @_parent, including string literals naming one for the
+        lookup helper
+    """
+
+    for argument in arguments:
+        kind = argument[0]
+        if kind == 'path':
+            for segment in argument[1]:
+                if segment[0:1] == u'@' and segment not in (u'@root', u'@_parent'):
+                    return True
+        elif kind == 'subexpr':
+            if _arguments_use_data([argument[1]] + argument[2]):
+                return True
+        elif kind == 'kwparam':
+            if _arguments_use_data([argument[2]]):
+                return True
+        elif kind == 'literalparam':
+            if isinstance(argument[1], basestring) and u'@' in argument[1]:
+                return True
+    return False
+
+
+def _uses_data(tree, known_helpers):
+    """
+    Finds out if the items of an each block need @index, @key, @first and
+    @last, so that the scopes of the items can be created without them
+
+    Helpers, partials and callables from the context get the scope and may
+    read the data variables from it, so only blocks that can call none of
+    them go without.
+
+    :param tree:
+        The tree of the block, as produced by Parser
+
+    :param known_helpers:
+        The names of the helpers that can be called if only the known
+        helpers can be, otherwise None
+
+    :return:
+        True if the tree may read one of the data variables
+    """
+
+    if known_helpers is None:
+        return True
+    for node in tree[1:]:
+        kind = node[0]
+        if kind in ('escapedexpand', 'expand'):
+            path = node[1]
+            if node[2] or path[0] != 'path' or _arguments_use_data([path]):
+                return True
+            if len(path[1]) == 1 and path[1][0] in known_helpers:
+                return True
+        elif kind != 'comment' and kind not in _literal_kinds:
+            # Blocks may call a helper, even the built-in ones when they are
+            # replaced
+            return True
+    return False
+
+
+class CodeBuilder:
+
+    """Builds code for a template."""
+
+    def __init__(self, profile=False, known_helpers=None, known_helpers_only=False, mode='render', encoding=None):
+        """
+        :param profile:
+            If the generated code should time each construct of the template
+            for pybars.Profiler
+
+        :param known_helpers:
+            An iterable of the names of helpers that will be passed when the
+            template renders, or a dict of names to booleans - these and the
+            built-in helpers are called without looking them up in the
+            context or checking that they are callable
+
+        :param known_helpers_only:
+            If only the known helpers can be called, so that every other
+            name is looked up in the context without checking for helpers or
+            callables
+
+        :param mode:
+            "render" for the functions of a template, which return strlists,
+            "stream" for generators yielding the output as it renders or
+            "async" for coroutines awaiting the values that are awaitable,
+            the last two without the public render() wrapper
+
+        :param encoding:
+            In render mode, the encoding of the byte string the template
+            returns, with the text of the template encoded as it compiles,
+            or None to return a unicode string
+        """
+
+        if mode not in _modes:
+            raise PybarsError("Unknown mode %s" % mode)
+        if encoding is not None:
+            if mode != 'render':
+                raise PybarsError("Only the render mode has an encoding")
+            # The output is encoded a piece at a time, so encodings starting
+            # their output with a byte order mark would repeat it
+            if (u'a' * 2).encode(encoding) != u'a'.encode(encoding) * 2:
+                raise PybarsError("The encoding %s adds a byte order mark, use one for a byte order such as "
+                                  "utf-16-le" % encoding)
+        self.mode = mode
+        self.encoding = encoding
+        self._options_class = u'BytesOptions' if encoding is not None else _options_classes[mode]
+        self.profile = profile
+        # Helpers may be any value, so without the options nothing is
+        # assumed, not even about the built-in ones
+        if known_helpers is None and not known_helpers_only:
+            self.known_helpers = frozenset()
+        else:
+            self.known_helpers = _known_helpers(known_helpers)
+        self.known_helpers_only = known_helpers_only
+        self._reset()
 
     def _reset(self):
         self.stack = []
         self.var_counter = 1
         self.render_counter = 0
+        self.partial_names = set()
+        self.constructs = []
+        # Maps the segments of each path longer than one segment to the
+        # name of the function generated for it
+        self.paths = {}
+
+    def start(self, static=False):
+        """
+        :param static:
+            If the function only returns a constant, and so needs none of
+            the setup of the context, helpers and result
+        """
 
-    def start(self):
         function_name = 'render' if self.render_counter == 0 else 'block_%s' % self.render_counter
         self.render_counter += 1
 
-        self.stack.append((strlist(), {}, function_name))
-        self._result, self._locals, _ = self.stack[-1]
+        self.stack.append((strlist(), {}, function_name, []))
+        self._result, self._locals, _, self._marks = self.stack[-1]
+
+        # The template itself is _render(), which takes the helpers already
+        # merged with the built-in ones, so that partials can call it
+        # directly. The render() wrapper added by finish() does the merge.
+        if len(self.stack) == 1:
+            function_name = '_render'
+        # As in stream mode, blocks returning constants stay plain functions
+        if self.mode == 'async' and (not static or len(self.stack) == 1):
+            self._result.grow(u"async def %s(context, helpers, partials, root):\n" % function_name)
+        else:
+            self._result.grow(u"def %s(context, helpers, partials, root):\n" % function_name)
+        if static:
+            return
+        if self.mode == 'stream':
+            self._result.grow(u"    context = ensure_scope(context, root)\n")
+            return
         # Context may be a user hash or a Scope (which injects '@_parent' to
         # implement .. lookups). The JS implementation uses a vector of scopes
         # and then interprets a linear walk-up, which is why there is a
         # disabled test showing arbitrary complex path manipulation: the scope
         # approach used here will probably DTRT but may be slower: reevaluate
         # when profiling.
-        if len(self.stack) == 1:
-            self._result.grow([
-                u"def render(context, helpers=None, partials=None, root=None):\n"
-                u"    _helpers = dict(_pybars_['helpers'])\n"
-                u"    if helpers is not None:\n"
-                u"        _helpers.update(helpers)\n"
-                u"    helpers = _helpers\n"
-                u"    if partials is None:\n"
-                u"        partials = {}\n"
-                u"    called = root is None\n"
-                u"    if called:\n"
-                u"        root = context\n"
-            ])
+        if self.encoding is not None:
+            self._result.grow(u"    result = _byteslist()\n")
         else:
-            self._result.grow(u"def %s(context, helpers, partials, root):\n" % function_name)
-        self._result.grow(u"    result = strlist()\n")
+            self._result.grow(u"    result = strlist()\n")
         self._result.grow(u"    context = ensure_scope(context, root)\n")
 
-    def finish(self):
-        lines, ns, function_name = self.stack.pop(-1)
+    def finish(self, constant=None):
+        """
+        :param constant:
+            The text the function returns, if it was started as static
+        """
 
-        # Ensure the result is a string and not a strlist
-        if len(self.stack) == 0:
-            self._result.grow(u"    if called:\n")
-            self._result.grow(u"        result = %s(result)\n" % str_class.__name__)
-        self._result.grow(u"    return result\n")
+        lines, ns, function_name, marks = self.stack.pop(-1)
+
+        self._mark(None)
+        if self.mode == 'stream' and constant is None:
+            # A function that happens to yield nothing must still be a
+            # generator
+            if not _yield_re.search(u''.join(lines)):
+                self._result.grow(u"    return\n    yield\n")
+        elif constant is None:
+            self._result.grow(u"    return result\n")
+        if len(self.stack) == 0 and self.mode == 'render':
+            if self.encoding is not None:
+                self._result.grow(u"\n\n_byteslist = byteslist_class(%r)\n" % str(self.encoding))
+                self._result.grow(_RENDER_WRAPPER % {
+                    'output': u'join_bytes',
+                    'partial_output': u'decode_output(_render(context, _helpers, partials, root), %r)' % str(
+                        self.encoding),
+                    'attribute': u'_pybars_bytes',
+                    'bind': u', encoding=%r' % str(self.encoding),
+                })
+                self._result.grow(u"render._pybars_encoding = %r\n" % str(self.encoding))
+            else:
+                self._result.grow(_RENDER_WRAPPER % {
+                    'output': str_class.__name__,
+                    'partial_output': u'_render(context, _helpers, partials, root)',
+                    'attribute': u'_pybars_render',
+                    'bind': u'',
+                })
 
         source = str_class(u"".join(lines))
 
-        self._result = self.stack and self.stack[-1][0]
-        self._locals = self.stack and self.stack[-1][1]
+        if self.stack:
+            self._result, self._locals, _, self._marks = self.stack[-1]
 
-        code = ''
+        code = []
+        line_marks = []
+        line = 0
         for key in ns:
             if isinstance(ns[key], FunctionContainer):
-                code += ns[key].code + '\n'
+                line_marks.extend((line + offset, construct) for offset, construct in ns[key].marks)
+                code.append(ns[key].code + '\n')
+                line += code[-1].count('\n')
             else:
-                code += '%s = %s\n' % (key, repr(ns[key]))
-        code += source
-
-        result = FunctionContainer(function_name, code)
+                code.append('%s = %s\n' % (key, repr(ns[key])))
+                line += 1
+        piece = 0
+        for index, construct in marks:
+            line += sum(part.count('\n') for part in lines[piece:index])
+            piece = index
+            line_marks.append((line, construct))
+        code.append(source)
+
+        if self.stack:
+            result = FunctionContainer(function_name, ''.join(code), marks=line_marks, constant=constant)
+        else:
+            result = FunctionContainer(
+                function_name, ''.join(code), frozenset(self.partial_names), line_marks, self.constructs, self.profile,
+                constant, self.mode)
         if debug and len(self.stack) == 0:
             print('Compiled Python')
             print('---------------')
@@ -573,8 +1900,279 @@ class CodeBuilder:
 
         return result
 
-    def _wrap_nested(self, name):
-        return u"partial(%s, helpers=helpers, partials=partials, root=root)" % name
+    def compile(self, tree):
+        """
+        Walks a tree produced by Parser and generates the code for it
+
+        :param tree:
+            A list starting with 'template' followed by node tuples
+
+        :return:
+            A FunctionContainer
+        """
+
+        positions = getattr(tree, 'positions', None)
+        nodes = []
+        for index, node in enumerate(tree[1:], 1):
+            if node[0] != 'comment':
+                nodes.append((node[0], node, positions[index] if positions else None))
+
+        # A template or block made of text alone returns it as a constant
+        if all(kind in _literal_kinds for kind, _, _ in nodes):
+            constant = str_class(u''.join(node[1] for _, node, _ in nodes))
+            self.start(static=True)
+            self._mark(nodes[0][0] if nodes else None, nodes[0][2] if nodes else None)
+            self._return_constant(constant)
+            return self.finish(constant)
+
+        self.start()
+        literal = []
+        for kind, node, position in nodes:
+            # Runs of text, newlines and whitespace are appended as one
+            # string, marked as the first of them
+            if kind in _literal_kinds:
+                if not literal:
+                    self._mark(kind, position)
+                literal.append(node[1])
+                continue
+            if literal:
+                self.add_literal(u''.join(literal))
+                literal = []
+            construct = self._mark(kind, position)
+            if self.profile:
+                self._result.grow(u"    _pybars_start = _pybars_clock()\n")
+            if kind == 'escapedexpand':
+                self.add_escaped_expand(self._compile_path(node[1]), self._compile_args(node[2]))
+            elif kind == 'expand':
+                self.add_expand(self._compile_path(node[1]), self._compile_args(node[2]))
+            elif kind in ('block', 'invertedblock'):
+                _, symbol, arguments, nested, alt_nested = node
+                native = (
+                    kind == 'block' and symbol in _native_blocks and len(arguments) == 1
+                    and arguments[0][0] != 'kwparam')
+                arguments = self._compile_args(arguments)
+                data = native and symbol == 'each' and _uses_data(
+                    nested, self.known_helpers if self.known_helpers_only else None)
+                nested = self.compile(nested)
+                alt_nested = self.compile(alt_nested) if alt_nested else None
+                if native:
+                    self.add_native_block(symbol, arguments[0], nested, alt_nested, data)
+                elif kind == 'block':
+                    self.add_block(symbol, arguments, nested, alt_nested)
+                else:
+                    self.add_invertedblock(symbol, arguments, nested, alt_nested)
+            elif kind == 'rawblock':
+                self.add_rawblock(node[1], self._compile_args(node[2]), node[3])
+            elif kind == 'partial':
+                if node[1][0] == 'literalparam':
+                    name = ast.literal_eval(node[1][1])
+                    if isinstance(name, (str, str_class)):
+                        self.partial_names.add(str_class(name))
+                self.add_partial(self._compile_complexarg(node[1]), self._compile_args(node[2]))
+            if self.profile:
+                self._result.grow(u"    _pybars_record(_pybars_profile, %d, _pybars_start)\n" % construct)
+        if literal:
+            self.add_literal(u''.join(literal))
+        return self.finish()
+
+    def _mark(self, kind, position=None):
+        """
+        Records that the code generated next belongs to a construct of the
+        template, for the source map
+
+        :param kind:
+            The type of tree node, or None for code that belongs to no
+            construct
+
+        :param position:
+            Where the construct starts in the source the tree was parsed from
+
+        :return:
+            The index of the construct
+        """
+
+        construct = None
+        if kind is not None:
+            construct = len(self.constructs)
+            self.constructs.append((kind, position))
+        self._marks.append((len(self._result), construct))
+        return construct
+
+    def _lookup(self, segments):
+        """
+        Generates the lookup of a path in the context, doing at compile time
+        what resolve() would do for each segment on every render
+
+        A single name is looked up with Scope.get(), as the context of the
+        generated functions is always a Scope. Longer paths get a function
+        of their own, with code for each segment that handles the common
+        case inline and leaves the rest to resolve_segment().
+
+        :param segments:
+            A list of path segments as returned by _compile_pathseg()
+
+        :return:
+            A Python expression as a unicode string
+        """
+
+        # The @../index syntax: a segment starting with @@ moves one of its
+        # @ to the next segment
+        effective = []
+        carryover = False
+        for segment in segments:
+            if carryover:
+                carryover = False
+                segment = u'@%s' % segment
+            if segment[0:2] == u'@@':
+                segment = segment[1:]
+                carryover = True
+            effective.append(segment)
+
+        if len(effective) == 1:
+            return self._scope_read(u'context', effective[0])
+
+        key = tuple(effective)
+        name = self.paths.get(key)
+        if name is not None:
+            return u"%s(context)" % name
+
+        name = self.paths[key] = 'path_%d' % (len(self.paths) + 1)
+        lines = [u"def %s(value):\n" % name]
+        first = True
+        for segment in effective:
+            if segment == u'':
+                continue
+            if first:
+                lines.append(u"    value = %s\n" % self._scope_read(u'value', segment))
+                first = False
+            elif segment in _scope_fields:
+                field = _scope_fields[segment]
+                if segment in (u'@_parent', u'@root'):
+                    test = u"type(value) is Scope"
+                else:
+                    test = u"type(value) is Scope and value.%s is not None" % field
+                lines.append(
+                    u"    value = value.%s if %s else resolve_segment(value, u'%s')\n" % (field, test, segment))
+            elif segment == u'length':
+                # resolve() stops at the length of a list
+                lines.append(
+                    u"    if type(value) is list or type(value) is tuple:\n"
+                    u"        return len(value)\n"
+                    u"    value = resolve_segment(value, u'length')\n")
+            elif _digits_re.match(segment):
+                lines.append(
+                    u"    if type(value) is list or type(value) is tuple:\n"
+                    u"        value = value[%s] if %s < len(value) else {}\n"
+                    u"    else:\n"
+                    u"        value = resolve_segment(value, u'%s')\n" % (int(segment), int(segment), segment))
+            else:
+                lines.append(
+                    u"    if type(value) is dict and u'%s' in value:\n"
+                    u"        value = value[u'%s']\n"
+                    u"    else:\n"
+                    u"        value = resolve_segment(value, u'%s')\n" % (segment, segment, segment))
+        lines.append(u"    return value\n")
+        self.stack[0][1][name] = FunctionContainer(name, u''.join(lines))
+        return u"%s(context)" % name
+
+    def _scope_read(self, scope, segment):
+        """
+        Generates the lookup of one segment in a Scope, reading the fields of
+        the data variables and "this" directly, as Scope.get() would after
+        comparing the name with each of them
+
+        :param scope:
+            The name of the variable holding the Scope
+
+        :param segment:
+            A path segment, after the @../ handling of _lookup()
+
+        :return:
+            A Python expression as a unicode string
+        """
+
+        if segment in (u'', u'this'):
+            return u"%s.context" % scope
+        field = _scope_fields.get(segment)
+        if field in ('parent', 'root'):
+            return u"%s.%s" % (scope, field)
+        if field is not None:
+            # Scope.get() only returns the fields that were set
+            return u"(%s.%s if %s.%s is not None else %s.get(u'%s'))" % (
+                scope, field, scope, field, scope, segment)
+        if segment[0:1] == u'@':
+            return u"%s.get(u'%s')" % (scope, segment)
+        return u"resolve_name(%s, u'%s')" % (scope, segment)
+
+    def _compile_pathseg(self, segment):
+        if segment in ('/', '.', '', 'this'):
+            return u''
+        return segment
+
+    def _compile_path(self, path):
+        segments = [self._compile_pathseg(segment) for segment in path[1]]
+        if len(segments) == 1:
+            return ("simple", segments[0])
+        return ("complex", self._lookup(segments))
+
+    def _compile_complexarg(self, arg):
+        kind = arg[0]
+        if kind == 'path':
+            return self._lookup([self._compile_pathseg(segment) for segment in arg[1]])
+        if kind == 'subexpr':
+            name = u''.join(arg[1][1])
+            arguments = self._compile_args(arg[2])
+            call = u'resolve_subexpr(helpers, "' + name + '", context' + (u', ' + u', '.join(arguments) if arguments else u'') + u')'
+            if self.mode == 'async':
+                return u'(await await_value(%s))' % call
+            return call
+        return str_class(arg[1])
+
+    def _compile_args(self, arguments):
+        output = []
+        for arg in arguments:
+            if arg[0] == 'kwparam':
+                output.append(str_class(arg[1]) + u'=' + self._compile_complexarg(arg[2]))
+            else:
+                output.append(self._compile_complexarg(arg))
+        return output
+
+    def _check_known(self, symbol, arguments):
+        """
+        :return:
+            True if symbol is a known helper, False if it is only looked up
+            in the context and None if it is not known to be either
+        """
+
+        if symbol in self.known_helpers:
+            return True
+        if not self.known_helpers_only:
+            return None
+        if arguments:
+            raise PybarsError("You specified knownHelpersOnly, but used the unknown helper %s" % symbol)
+        return False
+
+    def _call_block_helper(self, symbol, arguments):
+        call = self.arguments_to_call(arguments)
+        known = self._check_known(symbol, arguments)
+        if known:
+            self._result.grow(u"    value = helpers[u'%s'](context, options%s\n" % (symbol, call))
+        elif known is False:
+            self._result.grow(
+                u"    value = helpers['blockHelperMissing'](context, options, %s)\n" % self._lookup([symbol]))
+        else:
+            self._result.grow([
+                u"    value = helper = helpers.get(u'%s')\n" % symbol,
+                u"    if value is None:\n"
+                u"        value = %s\n" % self._lookup([symbol]),
+                u"    if helper and hasattr(helper, '__call__'):\n"
+                u"        value = helper(context, options%s\n" % call,
+                u"    else:\n"
+                u"        value = helpers['blockHelperMissing'](context, options, value)\n"
+                ])
+        if self.mode == 'async':
+            self._result.grow(u"    value = await resolve_output(value)\n")
+        self._add_output(u"value or ''")
 
     def add_block(self, symbol, arguments, nested, alt_nested):
         name = nested.name
@@ -584,36 +2182,203 @@ class CodeBuilder:
             alt_name = alt_nested.name
             self._locals[alt_name] = alt_nested
 
-        call = self.arguments_to_call(arguments)
-        self._result.grow([
-            u"    options = {'fn': %s}\n" % self._wrap_nested(name),
-            u"    options['helpers'] = helpers\n"
-            u"    options['partials'] = partials\n"
-            u"    options['root'] = root\n"
-            ])
-        if alt_nested:
-            self._result.grow([
-                u"    options['inverse'] = ",
-                self._wrap_nested(alt_name),
-                u"\n"
-                ])
+        self._result.grow(u"    options = %s(%s, %s, helpers, partials, root)\n" % (
+            self._options_class, name, alt_name if alt_nested else None))
+        self._call_block_helper(symbol, arguments)
+
+    def _return_constant(self, constant):
+        # Blocks returning constants are only called through the options of
+        # block helpers, so they stay plain functions in every mode
+        if self.mode == 'stream' and len(self.stack) == 1:
+            self._result.grow(u"    yield %s\n" % repr(constant))
+        elif self.encoding is not None and len(self.stack) == 1:
+            self._result.grow(u"    return %s\n" % repr(constant.encode(self.encoding)))
         else:
-            self._result.grow([
-                u"    options['inverse'] = lambda this: None\n"
-                ])
+            self._result.grow(u"    return %s\n" % repr(constant))
+
+    def _add_output(self, expression, indent=u"    "):
+        """
+        Adds a value to the result - a unicode string, or anything a
+        strlist can grow by
+        """
+
+        if self.mode == 'stream':
+            self._result.grow(u"%syield %s\n" % (indent, expression))
+        else:
+            self._result.grow(u"%sresult.grow(%s)\n" % (indent, expression))
+
+    def _add_value(self, should_escape):
+        """
+        Adds the value computed last to the result, escaped or not
+        """
+
+        if self.encoding is not None:
+            self._result.grow(u"    result.append(encode_value(value, %s, %r))\n" % (
+                should_escape, str(self.encoding)))
+        else:
+            self._add_output(u"prepare(value, %s)" % should_escape)
+
+    def _add_text(self, text, indent=u"    "):
+        if self.mode == 'stream':
+            self._result.grow(u"%syield %s\n" % (indent, repr(text)))
+        elif self.encoding is not None:
+            # The text is encoded once, as the template compiles
+            self._result.grow(u"%sresult.append(%s)\n" % (indent, repr(text.encode(self.encoding))))
+        else:
+            self._result.grow(u"%sresult.append(%s)\n" % (indent, repr(text)))
+
+    def _add_call(self, call, indent=u"    "):
+        """
+        Adds the output of a call to a function generated for the same mode
+        """
+
+        if self.mode == 'render':
+            # Generated functions only ever return flat strlists
+            self._result.grow(u"%sresult.extend(%s)\n" % (indent, call))
+        elif self.mode == 'async':
+            self._result.grow(u"%sresult.extend(await %s)\n" % (indent, call))
+        elif _yield_from:
+            self._result.grow(u"%syield from %s\n" % (indent, call))
+        else:
+            self._result.grow(u"%sfor piece in %s:\n%s    yield piece\n" % (indent, call, indent))
+
+    def _await_value(self, indent=u"    ", iterables=False):
+        """
+        Awaits the value computed last in async mode, if it is awaitable,
+        leaving other values to the generated code without a call
+
+        :param iterables:
+            If async iterables should also be collected into lists, for the
+            value of a block
+        """
+
+        if self.mode != 'async':
+            return
+        if iterables:
+            self._result.grow(
+                u"%sif hasattr(value, '__await__') or hasattr(value, '__aiter__'):\n"
+                u"%s    value = await await_value(value)\n" % (indent, indent))
+        else:
+            self._result.grow(u"%sif hasattr(value, '__await__'):\n%s    value = await value\n" % (indent, indent))
+
+    def _grow_nested(self, nested, this, indent):
+        """
+        Adds the output of a nested function to the result, without calling
+        it when it returns a constant
+
+        :return:
+            False if no code was needed as the function returns nothing
+        """
+
+        if nested.constant is None:
+            self._add_call(u"%s(%s, helpers, partials, root)" % (nested.name, this), indent)
+        elif nested.constant:
+            self._add_text(nested.constant, indent)
+        else:
+            return False
+        return True
+
+    def add_native_block(self, symbol, argument, nested, alt_nested, data=True):
+        """
+        Compiles a block of one of the built-in if, unless, each and with
+        helpers into a Python if or for statement that calls the nested
+        functions directly, falling back to a helper call when the helper
+        was replaced
+
+        :param argument:
+            The compiled argument of the block
+
+        :param data:
+            If the scopes of the items of an each block need the data
+            variables, see _uses_data()
+        """
+
+        # The generic code is generated first, for the locals and the
+        # fallback, and then indented into the else branch
+        result = self._result
+        self._result = strlist()
+        self.add_block(symbol, [argument], nested, alt_nested)
+        fallback = u''.join(self._result).splitlines(True)
+        self._result = result
+
+        if symbol in self.known_helpers:
+            guard = u"helpers[u'%s'] is _%s" % (symbol, symbol)
+        else:
+            guard = u"helpers.get(u'%s') is _%s" % (symbol, symbol)
         self._result.grow([
-            u"    value = helper = helpers.get(u'%s')\n" % symbol,
-            u"    if value is None:\n"
-            u"        value = resolve(context, u'%s')\n" % symbol,
-            u"    if helper and hasattr(helper, '__call__'):\n"
-            u"        value = helper(context, options%s\n" % call,
-            u"    else:\n"
-            u"        value = helpers['blockHelperMissing'](context, options, value)\n"
-            u"    result.grow(value or '')\n"
+            u"    if %s:\n" % guard,
+            u"        value = %s\n" % argument,
             ])
+        self._await_value(u"        ", True)
+
+        if symbol in ('if', 'unless'):
+            if symbol == 'if':
+                self._result.grow(
+                    u"        if hasattr(value, '__call__'):\n"
+                    u"            value = value(context)\n")
+                self._await_value(u"            ")
+                self._result.grow(u"        if value:\n")
+            else:
+                self._result.grow(u"        if not value:\n")
+            if not self._grow_nested(nested, u"context", u"            "):
+                self._result.grow(u"            pass\n")
+            if alt_nested and alt_nested.constant != u'':
+                self._result.grow(u"        else:\n")
+                self._grow_nested(alt_nested, u"context", u"            ")
+
+        elif symbol == 'with':
+            self._grow_nested(nested, u"value", u"        ")
+
+        else:
+            # The same steps as _each(), without the data variables when
+            # the block does not use them
+            self._result.grow(u"        items = each_items(value, %s)\n" % data)
+            if alt_nested and alt_nested.constant != u'':
+                self._result.grow(u"        if items is None:\n")
+                self._grow_nested(alt_nested, u"context", u"            ")
+                self._result.grow(u"        else:\n")
+            else:
+                self._result.grow(u"        if items is not None:\n")
+            if nested.constant == u'':
+                self._result.grow(u"            pass\n")
+            elif nested.constant is not None:
+                self._result.grow(u"            for item in items:\n")
+                self._grow_nested(nested, None, u"                ")
+            elif self.mode == 'async':
+                # Items waiting for I/O render concurrently
+                self._add_call(
+                    u"each_async(%s, items, %s, context, helpers, partials, root)" % (nested.name, data),
+                    u"            ")
+            else:
+                # An item raising TypeError renders nothing, while errors
+                # from the iterator itself are raised
+                if data:
+                    self._result.grow(u"            for index, key, item, last in items:\n")
+                    scope = u"Scope(item, context, root, None, index, key, index == 0, last)"
+                else:
+                    self._result.grow(u"            for item in items:\n")
+                    scope = u"Scope(item, context, root)"
+                self._result.grow(u"                try:\n")
+                if self.mode == 'stream':
+                    # The output of an item is collected before it is
+                    # yielded, so that it is grown, and fails, here as in
+                    # render mode, rather than partly yielded
+                    self._result.grow(
+                        u"                    output = _collect(%s(%s, helpers, partials, root))\n"
+                        u"                except TypeError:\n"
+                        u"                    continue\n" % (nested.name, scope))
+                    self._add_call(u"output", u"                ")
+                else:
+                    self._grow_nested(nested, scope, u"                    ")
+                    self._result.grow(
+                        u"                except TypeError:\n"
+                        u"                    pass\n")
+
+        self._result.grow(u"    else:\n")
+        self._result.grow([u"    " + line for line in fallback])
 
     def add_literal(self, value):
-        self._result.grow(u"    result.append(%s)\n" % repr(value))
+        self._add_text(value)
 
     def _lookup_arg(self, arg):
         if not arg:
@@ -627,7 +2392,20 @@ class CodeBuilder:
             output = u', ' + output
         return output
 
-    def find_lookup(self, path, path_type, call):
+    def find_lookup(self, path, path_type, call, arguments=()):
+        if path_type == "simple":
+            known = self._check_known(path, arguments)
+        else:
+            known = None if not self.known_helpers_only or arguments else False
+        if known:
+            self._result.grow(u"    value = helpers[u'%s'](context%s\n" % (path, call))
+            return
+        if known is False:
+            if path_type == "simple":
+                path = self._lookup([path])
+            self._result.grow(u"    value = %s\n" % path)
+            return
+
         if path_type == "simple":  # simple names can reference helpers.
             # TODO: compile this whole expression in the grammar; for now,
             # fugly but only a compile time overhead.
@@ -636,7 +2414,7 @@ class CodeBuilder:
             self._result.grow([
                 u"    value = helpers.get(u'%s')\n" % realname,
                 u"    if value is None:\n"
-                u"        value = resolve(context, u'%s')\n" % path,
+                u"        value = %s\n" % self._lookup([path]),
                 ])
         else:
             realname = None
@@ -655,18 +2433,16 @@ class CodeBuilder:
     def add_escaped_expand(self, path_type_path, arguments):
         (path_type, path) = path_type_path
         call = self.arguments_to_call(arguments)
-        self.find_lookup(path, path_type, call)
-        self._result.grow([
-            u"    result.grow(prepare(value, True))\n"
-            ])
+        self.find_lookup(path, path_type, call, arguments)
+        self._await_value()
+        self._add_value(True)
 
     def add_expand(self, path_type_path, arguments):
         (path_type, path) = path_type_path
         call = self.arguments_to_call(arguments)
-        self.find_lookup(path, path_type, call)
-        self._result.grow([
-            u"    result.grow(prepare(value, False))\n"
-            ])
+        self.find_lookup(path, path_type, call, arguments)
+        self._await_value()
+        self._add_value(False)
 
     def _debug(self):
         self._result.grow(u"    import pdb;pdb.set_trace()\n")
@@ -679,58 +2455,51 @@ class CodeBuilder:
             alt_name = alt_nested.name
             self._locals[alt_name] = alt_nested
 
-        call = self.arguments_to_call(arguments)
-        self._result.grow([
-            u"    options = {'inverse': %s}\n" % self._wrap_nested(name),
-            u"    options['helpers'] = helpers\n"
-            u"    options['partials'] = partials\n"
-            u"    options['root'] = root\n"
-            ])
-        if alt_nested:
-            self._result.grow([
-                u"    options['fn'] = ",
-                self._wrap_nested(alt_name),
-                u"\n"
-                ])
-        else:
-            self._result.grow([
-                u"    options['fn'] = lambda this: None\n"
-                ])
-        self._result.grow([
-            u"    value = helper = helpers.get(u'%s')\n" % symbol,
-            u"    if value is None:\n"
-            u"        value = resolve(context, u'%s')\n" % symbol,
-            u"    if helper and hasattr(helper, '__call__'):\n"
-            u"        value = helper(context, options%s\n" % call,
-            u"    else:\n"
-            u"        value = helpers['blockHelperMissing'](context, options, value)\n"
-            u"    result.grow(value or '')\n"
-            ])
+        self._result.grow(u"    options = %s(%s, %s, helpers, partials, root)\n" % (
+            self._options_class, alt_name if alt_nested else None, name))
+        self._call_block_helper(symbol, arguments)
 
     def add_rawblock(self, symbol, arguments, raw):
+        # Helpers get the raw text itself from fn, not a strlist as from
+        # other blocks
         call = self.arguments_to_call(arguments)
         self._result.grow([
-            u"    options = {'fn': lambda this: %s}\n" % repr(raw),
-            u"    options['helpers'] = helpers\n"
-            u"    options['partials'] = partials\n"
-            u"    options['root'] = root\n"
-            u"    options['inverse'] = lambda this: None\n"
+            u"    options = %s(None, None, helpers, partials, root)\n" % self._options_class,
+            u"    options['fn'] = lambda this: %s\n" % repr(raw),
             u"    helper = helpers.get(u'%s')\n" % symbol,
             u"    if helper and hasattr(helper, '__call__'):\n"
             u"        value = helper(context, options%s\n" % call,
             u"    else:\n"
             u"        value = %s\n" % repr(raw),
-            u"    result.grow(value or '')\n"
             ])
+        if self.mode == 'async':
+            self._result.grow(u"    value = await resolve_output(value)\n")
+        self._add_output(u"value or ''")
 
     def _invoke_template(self, fn_name, this_name):
-        self._result.grow([
-            u"    result.grow(",
-            fn_name,
-            u"(",
-            this_name,
-            u", helpers=helpers, partials=partials, root=root))\n"
-            ])
+        # Compiled templates are called through _render(), skipping the merge
+        # of the helpers that render() does, or its variant for the mode
+        if self.mode == 'render':
+            self._result.grow(u"    inner_render = getattr(%s, '_pybars_render', None)\n" % fn_name)
+        else:
+            self._result.grow(u"    inner_render = template_variant(%s, %r)\n" % (fn_name, str(self.mode)))
+        self._result.grow(u"    if inner_render is None:\n")
+        if self.mode == 'async':
+            self._result.grow(
+                u"        value = %s(%s, helpers=helpers, partials=partials, root=root)\n" % (fn_name, this_name))
+            self._await_value(u"        ")
+            self._add_output(u"value", u"        ")
+        else:
+            self._add_output(
+                u"%s(%s, helpers=helpers, partials=partials, root=root)" % (fn_name, this_name), u"        ")
+        self._result.grow(u"    else:\n")
+        if self.mode == 'render':
+            self._add_output(u"inner_render(%s, helpers, partials, root)" % this_name, u"        ")
+        elif self.mode == 'async':
+            # _render() may return a constant rather than a strlist
+            self._add_output(u"await inner_render(%s, helpers, partials, root)" % this_name, u"        ")
+        else:
+            self._add_call(u"inner_render(%s, helpers, partials, root)" % this_name, u"        ")
 
     def add_partial(self, symbol, arguments):
         arg = ""
@@ -767,21 +2536,261 @@ class CodeBuilder:
         self._invoke_template("inner", "scope")
 
 
+# A line holding nothing but block, comment and else tags, which is matched
+# from its start, and the variants for the first and last lines
+_standalone_line_re = re.compile(
+    r'(?:[ \t]*{{(?:#[^{}]+|/[^{}]+|![^{}]+|else|else if [^{}]+)}}[ \t]*)+\r?\n')
+_standalone_first_line_re = re.compile(r'(?:[ \t]*{{(?:#[^{}]+|![^{}]+)}}[ \t]*)+\r?\n')
+_standalone_last_line_re = re.compile(r'\r?\n(?:[ \t]*{{(?:/[^{}]+|![^{}]+)}}[ \t]*)+$')
+
+# Where a change can start: the two whitespace control marks and the
+# newline before a line that may be standalone
+_change_re = re.compile(r'(~}})|({{~)|\n[ \t]*{{[#/!e]')
+
+_tag_re = re.compile(r'{{[^{}]*}}')
+
+
+def _standalone_tags(text):
+    """
+    :param text:
+        The text of a standalone line
+
+    :return:
+        The tags of the line, without the whitespace around them and
+        without a ~ before their closing braces
+    """
+
+    return u''.join(_tag_re.findall(text)).replace(u'~}}', u'}}')
+
+
+def _last_line_tags(source):
+    """
+    Finds the newline before the tags that end a template, if there are
+    any, by scanning backwards over them
+
+    :return:
+        The position of the newline, or of the carriage return before it, or
+        -1 - this is the only position the standalone tags of the last line
+        can start at, though they still need to be matched from there
+    """
+
+    end = len(source)
+    if source.endswith(u'\n'):
+        end -= 1
+    while True:
+        while end > 0 and source[end - 1] in u' \t':
+            end -= 1
+        if end < 2 or not source.startswith(u'}}', end - 2):
+            return -1
+        start = max(source.rfind(u'{', 0, end - 2), source.rfind(u'}', 0, end - 2))
+        if start < 1 or not source.startswith(u'{{', start - 1):
+            return -1
+        end = start - 1
+        position = end - 1
+        while position >= 0 and source[position] in u' \t':
+            position -= 1
+        if position >= 0 and source[position] == u'\n':
+            if position > 0 and source[position - 1] == u'\r':
+                return position - 1
+            return position
+
+
+def _whitespace_control(source):
+    """
+    Removes the whitespace that whitespace control marks and standalone
+    block tags ask for, keeping track of where the remaining text came from
+
+    The source is scanned once, only stopping where a change can start:
+
+     - ~}} and the whitespace after it become }}
+     - {{~ and the whitespace before it become {{
+     - a line holding nothing but {{#...}}, {{/...}}, {{!...}} or {{else}}
+       tags is reduced to the tags, including its newline - on the first
+       line only {{#...}} and {{!...}} count and on the last line only
+       {{/...}} and {{!...}}, which take the newline before them instead
+
+    :param source:
+        The template source as a unicode string
+
+    :return:
+        A tuple of the processed source and a list of (processed position,
+        source position) pairs, for _source_position()
+    """
+
+    # Each change is a (start, start of the text kept, end, replacement)
+    # tuple, found left to right without overlapping
+    changes = []
+    position = 0
+
+    match = _standalone_first_line_re.match(source)
+    if match is not None:
+        position = match.end()
+        changes.append((0, match.group(0).find(u'{{'), position, _standalone_tags(match.group(0))))
+
+    # The only place the tags of the last line can start
+    last_line = _last_line_tags(source)
+
+    match_line = _standalone_line_re.match
+    for candidate in _change_re.finditer(source):
+        kind = candidate.lastindex
+        start = mark = candidate.start()
+        if kind is None:
+            # The newline itself may end the previous change
+            start += 1
+        if start < position:
+            continue
+        if kind == 2:
+            while start > position and source[start - 1].isspace():
+                start -= 1
+
+        if position <= last_line < start:
+            match = _standalone_last_line_re.match(source, last_line)
+            last_line = -1
+            if match is not None:
+                text = match.group(0)
+                changes.append((match.start(), match.start() + text.find(u'{{'), match.end(), _standalone_tags(text)))
+                break
+
+        if kind == 1:
+            position = _spaces_re.match(source, mark + 3).end()
+            changes.append((start, start, position, u'}}'))
+        elif kind == 2:
+            position = mark + 3
+            changes.append((start, mark, position, u'{{'))
+        else:
+            match = match_line(source, start)
+            if match is not None:
+                text = match.group(0)
+                position = match.end()
+                changes.append((start, start + text.find(u'{{'), position, _standalone_tags(text)))
+    else:
+        if last_line >= position:
+            match = _standalone_last_line_re.match(source, last_line)
+            if match is not None:
+                text = match.group(0)
+                changes.append((last_line, last_line + text.find(u'{{'), match.end(), _standalone_tags(text)))
+
+    output = []
+    offsets = [(0, 0)]
+    output_length = 0
+    last = 0
+    for start, text_start, end, replacement in changes:
+        output.append(source[last:start])
+        output_length += start - last
+        offsets.append((output_length, text_start))
+        output.append(replacement)
+        output_length += len(replacement)
+        last = end
+        offsets.append((output_length, last))
+    output.append(source[last:])
+    return u''.join(output), offsets
+
+
+def _source_position(line_starts, offsets, position):
+    """
+    Converts a position in source processed by _whitespace_control() into a
+    line and column of the original source
+
+    :param line_starts:
+        A sorted list of the positions at which lines of the original source
+        start
+
+    :param offsets:
+        The list of offsets from _whitespace_control()
+
+    :param position:
+        A position in the processed source
+
+    :return:
+        A tuple of the 1-based line and column
+    """
+
+    index = bisect.bisect_right(offsets, (position, sys.maxsize)) - 1
+    processed, original = offsets[index]
+    original += position - processed
+    line = bisect.bisect_right(line_starts, original)
+    return line, original - line_starts[line - 1] + 1
+
+
+# Guards picking names for template modules in sys.modules
+_module_lock = threading.Lock()
+
+
+def _release_module(template):
+    """
+    Drops the module of a compiled template from sys.modules once the
+    template is no longer kept by a cache or reloader, so the module can
+    be garbage collected along with it
+
+    :param template:
+        The compiled template
+    """
+
+    module_name = getattr(template, '__module__', None)
+    if module_name and module_name.startswith('pybars._templates.'):
+        module = sys.modules.pop(module_name, None)
+        # Python 2 sets the globals of a module to None once nothing
+        # references the module, so the template keeps a reference
+        if module is not None and sys.version_info < (3,):
+            template._pybars_module = module
+
+
+def _module_filename(mod_name):
+    return '%s.py' % mod_name.replace('pybars.', '').replace('.', '/')
+
+
+def _compile_job(job):
+    """
+    Generates and compiles the code of one template for
+    Compiler.compile_many(), in a worker process
+
+    :param job:
+        A tuple of the Compiler class, the template name and source, the
+        filename to compile the code with and whether to profile it
+
+    :return:
+        A tuple of the render function name, the marshalled code object, the
+        size of the generated code and None, or of three Nones and the error
+        message if the template could not be compiled
+    """
+
+    compiler_class, name, source, filename, profile = job
+    try:
+        container = compiler_class()._generate_code(source, profile)
+        code = compile(container.full_code, filename, 'exec', dont_inherit=True)
+    except PybarsError as e:
+        return None, None, None, str(e)
+    except Exception as e:
+        # Such as a SyntaxError in the generated code - the exception itself
+        # may not survive being sent back from the worker
+        return None, None, None, '%s: %s' % (type(e).__name__, e)
+    return container.name, marshal.dumps(code), len(container.full_code), None
+
+
 class Compiler:
 
     """A handlebars template compiler.
 
-    The compiler is not threadsafe: you need one per thread because of the
-    state in CodeBuilder.
+    The compiler is threadsafe: each compilation uses its own CodeBuilder,
+    and template modules are named and registered under a lock.
     """
 
-    _handlebars = OMeta.makeGrammar(handlebars_grammar, {}, 'handlebars')
-    _builder = CodeBuilder()
-    _compiler = OMeta.makeGrammar(compile_grammar, {'builder': _builder})
+    def __init__(self, cache=None, profiler=None):
+        """
+        :param cache:
+            An optional pybars.TemplateCache - compile() returns the cached
+            template when it is given a source it has already compiled
+
+        :param profiler:
+            An optional pybars.Profiler - templates are compiled with code
+            that times each of their constructs, and added to the profiler.
+            The cache is not used.
+        """
 
-    def __init__(self):
         self._helpers = {}
         self.template_counter = 1
+        self.cache = cache
+        self.profiler = profiler
 
     def _extract_word(self, source, position):
         """
@@ -803,23 +2812,43 @@ class Compiler:
 
         return source[position - start_offset:position + end_offset]
 
-    def _generate_code(self, source):
+    def _generate_code(self, source, profile=None, knownHelpers=None, knownHelpersOnly=False, mode='render',
+                       encoding=None):
         """
         Common compilation code shared between precompile() and compile()
 
         :param source:
             The template source as a unicode string
 
+        :param profile:
+            If the code should be instrumented for profiling - defaults to
+            whether the compiler has a profiler
+
+        :param knownHelpers:
+            See compile()
+
+        :param knownHelpersOnly:
+            See compile()
+
+        :param mode:
+            See CodeBuilder
+
+        :param encoding:
+            See compile()
+
         :return:
-            A tuple of (function, source_code)
+            A FunctionContainer
         """
 
         if not isinstance(source, str_class):
             raise PybarsError("Template source must be a unicode string")
+        if profile is None:
+            profile = self.profiler is not None
 
-        source = self.whitespace_control(source)
+        original = source
+        source, offsets = _whitespace_control(source)
 
-        tree, (position, _) = self._handlebars(source).apply('template')
+        tree, position = Parser(source).parse()
 
         if debug:
             print('\nAST')
@@ -837,11 +2866,37 @@ class Compiler:
             word = self._extract_word(source, position)
             raise PybarsError("Error at character %s of line %s near %s" % (char_num, line_num, word))
 
-        # Ensure the builder is in a clean state - kinda gross
-        self._compiler.globals['builder']._reset()
-
-        output = self._compiler(tree).apply('compile')[0]
-        return output
+        builder = CodeBuilder(profile, knownHelpers, knownHelpersOnly, mode, encoding)
+        container = builder.compile(tree)
+        container.source = original
+        if knownHelpers is None and not knownHelpersOnly:
+            known = None
+        else:
+            names = sorted(builder.known_helpers | frozenset(_pybars_['helpers']))
+            known = dict((name, name in builder.known_helpers) for name in names)
+        container.options = (known, bool(knownHelpersOnly))
+
+        line_starts = [0]
+        line_starts.extend(match.end() for match in re.finditer(u'\n', original))
+        constructs = []
+        for kind, position in container.constructs:
+            if position is None:
+                line, column = None, None
+                text = u''
+            else:
+                line, column = _source_position(line_starts, offsets, position)
+                text = source[position:position + 60]
+                if text.startswith(u'{{'):
+                    closing = u'}}}' if text.startswith(u'{{{') else u'}}'
+                    end = text.find(closing)
+                    if end != -1:
+                        text = text[:end + len(closing)]
+                elif u'{{' in text:
+                    text = text[:text.find(u'{{')]
+                text = text.split(u'\n', 1)[0]
+            constructs.append((kind, line, column, text))
+        container.constructs = constructs
+        return container
 
     def whitespace_control(self, source):
         """
@@ -853,48 +2908,158 @@ class Compiler:
         :return:
             The processed template source as a unicode string
         """
-        cleanup_sub = re.compile(
-            # Clean-up whitespace control marks and spaces between blocks tags
-            r'(?<={{)~|~(?=}})|(?<=}})[ \t]+(?={{)').sub
-
-        return re.sub(
-            # Whitespace control using "~" mark
-            r'~}}\s*|\s*{{~|'
-
-            # Whitespace around alone blocks tags that in a line
-            r'(?<=\n)([ \t]*{{(#[^{}]+|/[^{}]+|![^{}]+|else|else if [^{}]+)}}[ \t]*)+\r?\n|'
 
-            # Whitespace aroud alone blocks tag on the first line
-            r'^([ \t]*{{(#[^{}]+|![^{}]+)}}[ \t]*)+\r?\n|'
+        return _whitespace_control(source)[0]
 
-            # Whitespace aroud alone blocks tag on the last line
-            r'\r?\n([ \t]*{{(/[^{}]+|![^{}]+)}}[ \t]*)+$',
-            lambda match: cleanup_sub('', match.group(0).strip()), source)
-
-    def precompile(self, source):
+    def precompile(self, source, knownHelpers=None, knownHelpersOnly=False, encoding=None):
         """
         Generates python source code that can be saved to a file for caching
 
         :param source:
             The template to generate source for - should be a unicode string
 
+        :param knownHelpers:
+            See compile()
+
+        :param knownHelpersOnly:
+            See compile()
+
+        :param encoding:
+            See compile()
+
         :return:
             Python code as a unicode string
         """
 
-        return self._generate_code(source).full_code
+        return self._generate_code(source, None, knownHelpers, knownHelpersOnly, encoding=encoding).full_code
 
-    def compile(self, source, path=None):
+    def compile(self, source, path=None, knownHelpers=None, knownHelpersOnly=False, encoding=None):
         """Compile source to a ready to run template.
 
         :param source:
             The template to compile - should be a unicode string
 
+        :param knownHelpers:
+            An iterable of the names of helpers that will always be passed
+            when the template renders, or a dict of names to booleans as in
+            Handlebars.js. Along with the built-in helpers these are called
+            directly, without looking for the name in the context.
+
+        :param knownHelpersOnly:
+            If True, names that are not known helpers are only looked up in
+            the context, and values found there are not called. Using such a
+            name with arguments raises a PybarsError.
+
+        :param encoding:
+            The name of an encoding, such as "utf-8", for the template to
+            return a byte string in. The text of the template is encoded as
+            it compiles, and only the values rendered into it are encoded
+            as it renders.
+
         :return:
             A template function ready to execute
         """
 
-        container = self._generate_code(source)
+        cache = self.cache if self.profiler is None else None
+        if cache is not None:
+            key = cache.key(source, knownHelpers, knownHelpersOnly, encoding)
+            template = cache.get(key)
+            if template is not None:
+                return template
+
+        container = self._generate_code(source, None, knownHelpers, knownHelpersOnly, encoding=encoding)
+        template = self._load_container(container, path)
+
+        if cache is not None:
+            cache.put(key, template, len(container.full_code))
+        if self.profiler is not None:
+            self.profiler.add(path or template.__module__, source, sys.modules[template.__module__])
+        return template
+
+    def compile_many(self, sources, workers=None):
+        """Compile a batch of templates, generating their code in a pool of
+        worker processes.
+
+        Parsing and code generation are CPU bound, so they run in the workers,
+        which send back marshalled code objects. This process only loads them.
+
+        :param sources:
+            A dict of template names to sources - the names are also used the
+            way compile() uses path
+
+        :param workers:
+            The number of worker processes - None for one per CPU, 0 or 1 to
+            compile in this process
+
+        :return:
+            A two-element tuple of a dict of names to template functions, and
+            a dict of names to the PybarsError raised compiling each template
+            that failed
+        """
+
+        cache = self.cache if self.profiler is None else None
+        templates = {}
+        errors = {}
+        jobs = []
+        modules = []
+
+        for name in sorted(sources):
+            source = sources[name]
+            if cache is not None:
+                template = cache.get(cache.key(source))
+                if template is not None:
+                    templates[name] = template
+                    continue
+            mod = self._reserve_module(name)
+            modules.append(mod)
+            jobs.append((type(self), name, source, _module_filename(mod.__name__), self.profiler is not None))
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(jobs))
+
+        try:
+            if workers > 1:
+                pool = multiprocessing.Pool(workers)
+                try:
+                    results = pool.map(_compile_job, jobs, max(1, len(jobs) // (workers * 4)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = map(_compile_job, jobs)
+
+            for (_, name, source, filename, _), mod, (function_name, data, size, error) in zip(jobs, modules, results):
+                if error is not None:
+                    sys.modules.pop(mod.__name__, None)
+                    errors[name] = PybarsError(error)
+                    continue
+                template = self._load(function_name, marshal.loads(data), mod, filename)
+                if cache is not None:
+                    cache.put(cache.key(source), template, size)
+                if self.profiler is not None:
+                    self.profiler.add(name, source, mod)
+                templates[name] = template
+        except BaseException:
+            # None of the templates reach the caller, so none of the names
+            # reserved for them stay taken
+            for mod in modules:
+                sys.modules.pop(mod.__name__, None)
+            raise
+
+        return templates, errors
+
+    def _reserve_module(self, path):
+        """
+        Registers an empty module for a template under an unused name, so
+        that concurrent compilations never pick the same one
+
+        :param path:
+            The path passed to compile(), or None
+
+        :return:
+            A ModuleType within pybars._templates
+        """
 
         def make_module_name(name, suffix=None):
             output = 'pybars._templates.%s' % name
@@ -902,28 +3067,92 @@ class Compiler:
                 output += '_%s' % suffix
             return output
 
-        if not path:
-            path = '_template'
-            generate_name = True
-        else:
-            path = path.replace('\\', '/')
-            path = path.replace('/', '_')
-            mod_name = make_module_name(path)
-            generate_name = mod_name in sys.modules
-
-        if generate_name:
-            mod_name = make_module_name(path, self.template_counter)
-            while mod_name in sys.modules:
-                self.template_counter += 1
+        with _module_lock:
+            if not path:
+                path = '_template'
+                generate_name = True
+            else:
+                path = path.replace('\\', '/')
+                path = path.replace('/', '_')
+                mod_name = make_module_name(path)
+                generate_name = mod_name in sys.modules
+
+            if generate_name:
                 mod_name = make_module_name(path, self.template_counter)
+                while mod_name in sys.modules:
+                    self.template_counter += 1
+                    mod_name = make_module_name(path, self.template_counter)
+
+            mod = ModuleType(mod_name)
+            sys.modules[mod_name] = mod
+        return mod
+
+    def _load_container(self, container, path=None, function_name=None):
+        """
+        Compiles generated code and executes it in a new module
+
+        :param container:
+            The FunctionContainer from _generate_code()
 
-        mod = ModuleType(mod_name)
-        filename = '%s.py' % mod_name.replace('pybars.', '').replace('.', '/')
-        exec(compile(container.full_code, filename, 'exec', dont_inherit=True), mod.__dict__)
-        sys.modules[mod_name] = mod
+        :param path:
+            The path passed to compile(), or None
+
+        :param function_name:
+            The function to return, if not the one named by the container
+
+        :return:
+            The template function
+        """
+
+        mod = self._reserve_module(path)
+        filename = _module_filename(mod.__name__)
+        try:
+            code = compile(container.full_code, filename, 'exec', dont_inherit=True)
+        except Exception:
+            sys.modules.pop(mod.__name__, None)
+            raise
+        return self._load(function_name or container.name, code, mod, filename)
+
+    def _compile_variant(self, source, knownHelpers, knownHelpersOnly, mode):
+        """
+        Compiles a template in a mode other than "render", see
+        template_variant()
+
+        :return:
+            The _render() function of the mode
+        """
+
+        container = self._generate_code(source, False, knownHelpers, knownHelpersOnly, mode)
+        return self._load_container(container, function_name='_render')
+
+    def _load(self, function_name, code, mod, filename):
+        """
+        Executes the code of a template in its module
+
+        :param function_name:
+            The name of the render function defined by the code
+
+        :param code:
+            The code object of the template module
+
+        :param mod:
+            The module from _reserve_module()
+
+        :param filename:
+            The filename the code was compiled with
+
+        :return:
+            The template function
+        """
+
+        try:
+            exec(code, mod.__dict__)
+        except Exception:
+            sys.modules.pop(mod.__name__, None)
+            raise
         linecache.getlines(filename, mod.__dict__)
 
-        return mod.__dict__[container.name]
+        return mod.__dict__[function_name]
 
     def template(self, code):
         def _render(context, helpers=None, partials=None, root=None):
@@ -0,0 +1,230 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""An import hook that loads template files as modules."""
+
+import hashlib
+import marshal
+import os
+import sys
+
+import pybars
+from pybars._compiler import Compiler, PybarsError
+
+__all__ = [
+    'install_import_hook',
+    'uninstall_import_hook',
+    'TemplateFinder',
+    'TemplateLoader',
+    ]
+
+__metaclass__ = type
+
+
+# Bit 0 marks a hash-based pyc and bit 1 asks for the hash to be checked,
+# the same flags CPython writes for checked hash-based .pyc files
+_PYC_FLAGS = b'\x03\x00\x00\x00'
+
+
+def _source_hash(data):
+    """
+    Computes the 8 byte key stored in the header of a cached template
+
+    :param data:
+        A byte string of the template source
+
+    :return:
+        A byte string - the generated code depends on the pybars version, so
+        it is part of the hash
+    """
+
+    hasher = hashlib.sha1(pybars.__version__.encode('ascii') + b'\0')
+    hasher.update(data)
+    return hasher.digest()[:8]
+
+
+def _cache_path(path):
+    """
+    Works out where to cache the code object for a template
+
+    :param path:
+        The filesystem path of the template
+
+    :return:
+        A path inside the __pycache__ directory next to the template, or None
+        if bytecode should not be cached
+    """
+
+    cache_tag = getattr(getattr(sys, 'implementation', None), 'cache_tag', None)
+    if cache_tag is None or sys.dont_write_bytecode:
+        return None
+    head, tail = os.path.split(path)
+    # The extension is kept so that welcome.hbs and welcome.py do not share
+    # a cache file
+    return os.path.join(head, '__pycache__', '%s.%s.pyc' % (tail, cache_tag))
+
+
+class TemplateLoader:
+
+    """Loads a single template file as a module with a render() function."""
+
+    def __init__(self, fullname, path, compiler=None):
+        self.name = fullname
+        self.path = path
+        self.compiler = compiler or Compiler()
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+    def get_filename(self, fullname=None):
+        return self.path
+
+    def get_source(self, fullname=None):
+        with open(self.path, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def get_code(self, fullname=None):
+        """
+        Returns the code object for the template, from __pycache__ when the
+        cached copy was built from the same source
+
+        :param fullname:
+            The name of the module
+
+        :return:
+            A code object
+        """
+
+        import importlib.util
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        source_hash = _source_hash(data)
+        header = importlib.util.MAGIC_NUMBER + _PYC_FLAGS + source_hash
+
+        cache_path = _cache_path(self.path)
+        if cache_path is not None:
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = f.read()
+            except (IOError, OSError):
+                pass
+            else:
+                if cached[:len(header)] == header:
+                    try:
+                        return marshal.loads(cached[len(header):])
+                    except (EOFError, ValueError, TypeError):
+                        pass
+
+        code = compile(self.compiler.precompile(data.decode('utf-8')), self.path, 'exec', dont_inherit=True)
+
+        if cache_path is not None:
+            self._write_cache(cache_path, header + marshal.dumps(code))
+        return code
+
+    def _write_cache(self, cache_path, data):
+        # Write to a temporary file and rename it into place so that other
+        # processes never see a partially written file
+        temp_path = '%s.%s' % (cache_path, os.getpid())
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, cache_path)
+        except (IOError, OSError):
+            # Like the standard library, failing to cache is not an error
+            try:
+                os.unlink(temp_path)
+            except (IOError, OSError):
+                pass
+
+
+class TemplateFinder:
+
+    """A sys.meta_path finder for template files.
+
+    A module name such as templates.email.welcome is looked up as
+    welcome.hbs inside the templates.email package, or on sys.path for a top
+    level module. The finder goes after the standard ones, so a .py file with
+    the same name wins.
+    """
+
+    def __init__(self, extensions=('.hbs',), compiler=None):
+        """
+        :param extensions:
+            An iterable of file extensions to treat as templates
+
+        :param compiler:
+            The pybars.Compiler to compile templates with
+        """
+
+        self.extensions = tuple(extensions)
+        self.compiler = compiler
+
+    def find_spec(self, fullname, path=None, target=None):
+        import importlib.util
+
+        name = fullname.rpartition('.')[2]
+        for directory in (path if path is not None else sys.path):
+            if not isinstance(directory, str):
+                continue
+            for extension in self.extensions:
+                filename = os.path.join(directory or '.', name + extension)
+                if os.path.isfile(filename):
+                    loader = TemplateLoader(fullname, filename, self.compiler)
+                    spec = importlib.util.spec_from_file_location(fullname, filename, loader=loader)
+                    spec.cached = _cache_path(filename)
+                    return spec
+        return None
+
+    def invalidate_caches(self):
+        pass
+
+
+def install_import_hook(extensions=('.hbs',), compiler=None):
+    """
+    Allows template files to be imported as modules
+
+    :param extensions:
+        An iterable of file extensions to treat as templates
+
+    :param compiler:
+        The pybars.Compiler to compile templates with
+
+    :return:
+        The TemplateFinder that was added to sys.meta_path
+    """
+
+    if sys.version_info < (3, 4):
+        raise PybarsError('The import hook requires Python 3.4 or newer')
+
+    uninstall_import_hook()
+    finder = TemplateFinder(extensions, compiler)
+    sys.meta_path.append(finder)
+    return finder
+
+
+def uninstall_import_hook():
+    """
+    Removes any TemplateFinder from sys.meta_path
+    """
+
+    sys.meta_path[:] = [finder for finder in sys.meta_path if not isinstance(finder, TemplateFinder)]
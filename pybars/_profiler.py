@@ -0,0 +1,180 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Timing of template constructs and mapping generated code to templates."""
+
+import bisect
+import sys
+import time
+
+__all__ = [
+    'Profiler',
+    'source_location',
+    ]
+
+__metaclass__ = type
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def record(stats, index, start, clock=clock):
+    """
+    Called by profiled templates after each construct has rendered
+
+    :param stats:
+        The _pybars_profile list of the template module
+
+    :param index:
+        The index of the construct
+
+    :param start:
+        The clock() value from before the construct rendered
+    """
+
+    entry = stats[index]
+    entry[0] += 1
+    entry[1] += clock() - start
+
+
+def _module(template):
+    if hasattr(template, '_pybars_source_map'):
+        return template
+    return sys.modules[template.__module__]
+
+
+def source_location(template, lineno):
+    """
+    Finds the part of a template that a line of its generated code belongs
+    to, for instance to make sense of a traceback or a profile
+
+    :param template:
+        A compiled template function, or the module of one
+
+    :param lineno:
+        A line number in the generated code
+
+    :return:
+        A tuple of the line and column in the template, or None
+    """
+
+    source_map = _module(template)._pybars_source_map
+    index = bisect.bisect_right([line for line, _ in source_map], lineno) - 1
+    if index < 0:
+        return None
+    return source_map[index][1]
+
+
+class Profiler:
+
+    """Collects the time spent rendering each construct of some templates.
+
+    Templates compiled by a Compiler(profiler=...) time every block,
+    expansion and partial call. The time of a block includes everything
+    rendered inside of it.
+    """
+
+    def __init__(self):
+        self._templates = []
+
+    def add(self, name, source, template):
+        """
+        Adds a template that was compiled with profiling
+
+        :param name:
+            The name to report the template under
+
+        :param source:
+            The source of the template
+
+        :param template:
+            The compiled template function, or its module
+        """
+
+        self._templates.append((name, source, _module(template)))
+
+    def stats(self):
+        """
+        :return:
+            A list of (seconds, calls, name, line, column, kind, text) tuples
+            for each construct that rendered, the slowest first
+        """
+
+        rows = []
+        for name, _, module in self._templates:
+            for (kind, line, column, text), (calls, seconds) in zip(module._pybars_constructs, module._pybars_profile):
+                if calls:
+                    rows.append((seconds, calls, name, line, column, kind, text))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return rows
+
+    def report(self, limit=20):
+        """
+        Formats the slowest constructs as a table
+
+        :param limit:
+            The maximum number of rows, or None for all
+
+        :return:
+            A unicode string
+        """
+
+        lines = [u'%10s %8s %10s  %s' % (u'total ms', u'calls', u'per call', u'construct')]
+        for seconds, calls, name, line, column, kind, text in self.stats()[:limit]:
+            lines.append(u'%10.3f %8d %10.4f  %s:%s:%s %s %s' % (
+                seconds * 1000, calls, seconds * 1000 / calls, name, line, column, kind, text))
+        return u'\n'.join(lines) + u'\n'
+
+    def annotate(self, name):
+        """
+        Lists the source of a template with the time spent in the
+        constructs that start on each line
+
+        :param name:
+            The name the template was added under
+
+        :return:
+            A unicode string
+        """
+
+        for template_name, source, module in self._templates:
+            if template_name == name:
+                break
+        else:
+            raise KeyError(name)
+
+        per_line = {}
+        for (_, line, _, _), (calls, seconds) in zip(module._pybars_constructs, module._pybars_profile):
+            if calls and line is not None:
+                per_line[line] = per_line.get(line, 0.0) + seconds
+
+        output = []
+        for number, text in enumerate(source.split(u'\n'), 1):
+            if number in per_line:
+                output.append(u'%10.3f  %s' % (per_line[number] * 1000, text))
+            else:
+                output.append(u'%10s  %s' % (u'', text))
+        return u'\n'.join(output) + u'\n'
+
+    def reset(self):
+        """
+        Sets all of the collected times and counts back to zero
+        """
+
+        for _, _, module in self._templates:
+            for entry in module._pybars_profile:
+                entry[0] = 0
+                entry[1] = 0.0
@@ -0,0 +1,256 @@
+#
+# Copyright (c) 2015 Will Bond, Mjumbe Wawatu Ukweli, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""A directory of templates that is reloaded when files change."""
+
+import io
+import os
+import threading
+import time
+
+from pybars._build import _find_templates
+from pybars._compiler import _release_module, Compiler, PybarsError
+
+__all__ = [
+    'TemplateReloader',
+    ]
+
+__metaclass__ = type
+
+
+class TemplateReloader:
+
+    """Compiles a directory of templates and keeps them up to date.
+
+    Templates are named by their path relative to the directory, without the
+    extension, and are also available to each other as partials under those
+    names. The partials each template references by a literal name, such as
+    {{> header}}, are recorded so that a change can be traced to the
+    templates that include it.
+
+    Rescans compile into a new dict which then replaces the current one, so
+    renders never take a lock and never see a half-applied reload.
+    """
+
+    def __init__(self, directory, extensions=('.hbs', '.handlebars'), compiler=None, interval=1.0, on_change=None):
+        """
+        :param directory:
+            The directory containing the templates
+
+        :param extensions:
+            An iterable of file extensions to treat as templates
+
+        :param compiler:
+            The pybars.Compiler to compile templates with
+
+        :param interval:
+            The minimum number of seconds between two scans of the directory
+
+        :param on_change:
+            An optional callable, called after a reload with the set of names
+            of the templates that changed, were removed or depend on those
+        """
+
+        self.directory = directory
+        self.extensions = tuple(extensions)
+        self.compiler = compiler or Compiler()
+        self.interval = interval
+
+        self.templates = {}
+        self.dependencies = {}
+        self.errors = {}
+
+        self._stats = {}
+        self._last_scan = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._time = time.time
+
+        # The initial load is not reported as a change
+        self.on_change = None
+        self.reload()
+        self.on_change = on_change
+
+    def render(self, name, context, helpers=None):
+        """
+        Renders a template, with the other templates as its partials
+
+        :param name:
+            The template name
+
+        :param context:
+            The context to render with
+
+        :param helpers:
+            An optional dict of helpers
+
+        :return:
+            The output as a string
+        """
+
+        templates = self.templates
+        return templates[name](context, helpers=helpers, partials=templates)
+
+    def dependents(self, names):
+        """
+        Finds the templates that include any of the given ones as a partial,
+        directly or through other partials
+
+        :param names:
+            An iterable of template names
+
+        :return:
+            A set of template names, not including those passed in unless
+            they are part of a cycle
+        """
+
+        reverse = {}
+        for name, partials in self.dependencies.items():
+            for partial in partials:
+                reverse.setdefault(partial, set()).add(name)
+
+        found = set()
+        pending = list(names)
+        while pending:
+            for dependent in reverse.get(pending.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+        return found
+
+    def poll(self):
+        """
+        Reloads the templates unless the directory was scanned less than
+        interval seconds ago or another thread is already scanning it
+
+        :return:
+            The set of affected template names, or None if no scan was done
+        """
+
+        if self._last_scan is not None and self._time() - self._last_scan < self.interval:
+            return None
+        if not self._lock.acquire(False):
+            return None
+        try:
+            return self._reload()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        """
+        Scans the directory, recompiling templates whose files changed and
+        dropping those whose files were removed
+
+        :return:
+            A set of the names of the templates that changed or were removed,
+            plus their dependents
+        """
+
+        with self._lock:
+            return self._reload()
+
+    def _reload(self):
+        self._last_scan = self._time()
+
+        found = _find_templates(self.directory, self.extensions)
+        stats = {}
+        changed = set()
+        for name, path in found.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[name] = (path, st.st_mtime, st.st_size)
+            if self._stats.get(name) != stats[name]:
+                changed.add(name)
+        removed = set(self._stats) - set(stats)
+
+        if not changed and not removed:
+            return set()
+
+        templates = dict(self.templates)
+        dependencies = dict(self.dependencies)
+        errors = dict(self.errors)
+        replaced = []
+
+        for name in removed:
+            replaced.append(templates.pop(name, None))
+            dependencies.pop(name, None)
+            errors.pop(name, None)
+
+        for name in sorted(changed):
+            try:
+                with io.open(stats[name][0], 'r', encoding='utf-8') as f:
+                    source = f.read()
+                container = self.compiler._generate_code(source)
+            except (IOError, OSError, UnicodeDecodeError, PybarsError) as e:
+                # The previous version, if any, stays in use
+                errors[name] = e
+                continue
+            errors.pop(name, None)
+            replaced.append(templates.get(name))
+            templates[name] = self.compiler._load_container(container, name)
+            dependencies[name] = container.partials
+
+        # Partials are looked up by name when a template renders, so the
+        # dependents of a changed partial pick it up through the new dict
+        # without being recompiled
+        self.templates = templates
+        self.dependencies = dependencies
+        self.errors = errors
+        self._stats = stats
+
+        for template in replaced:
+            _release_module(template)
+
+        affected = changed | removed
+        affected |= self.dependents(affected)
+        if self.on_change is not None:
+            self.on_change(affected)
+        return affected
+
+    def start(self):
+        """
+        Starts a daemon thread that polls the directory every interval
+        seconds
+        """
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='pybars-reloader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the polling thread
+        """
+
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.reload()
+            except Exception:
+                # A broken reload must not stop later ones from happening
+                pass
@@ -39,7 +39,4 @@ setup(name='pybars3',
           'Programming Language :: Python :: 3.3',
           'Programming Language :: Python :: 3.4'
           ],
-      install_requires=[
-          'PyMeta3>=0.5.1',
-          ],
       )
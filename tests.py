@@ -1,7 +1,13 @@
 import sys
 import unittest
 
+from tests.test__async import TestAsync            # noqa: F401
+from tests.test__build import TestBuild            # noqa: F401
+from tests.test__cache import TestTemplateCache    # noqa: F401
 from tests.test__compiler import TestCompiler      # noqa: F401
+from tests.test__importer import TestImporter      # noqa: F401
+from tests.test__profiler import TestProfiler      # noqa: F401
+from tests.test__reloader import TestTemplateReloader  # noqa: F401
 from tests.test_acceptance import TestAcceptance   # noqa: F401
 
 if len(sys.argv) >= 2 and sys.argv[1] == '--debug':
@@ -0,0 +1,29 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Helpers for tests/test__async.py written with the syntax of Python 3.5
+and newer, which the Python 2 tests cannot import."""
+
+import asyncio
+
+
+async def timeout_or_done(this, item):
+    # Timeouts need the helper to run in a task of its own
+    try:
+        async with asyncio.timeout(0.01):
+            await asyncio.sleep(0.05)
+    except TimeoutError:
+        return u'timeout %d' % item
+    return u'done'
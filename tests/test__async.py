@@ -0,0 +1,208 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Tests for rendering templates asynchronously."""
+
+import sys
+import unittest
+
+from unittest import TestCase
+
+from pybars import Compiler, PybarsError
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+def run(awaitable):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable)
+    finally:
+        loop.close()
+
+
+def later(value):
+    """
+    :return:
+        A coroutine returning value after giving way to other tasks
+    """
+
+    return asyncio.sleep(0, result=value)
+
+
+class Rows(object):
+
+    """An async iterable of rows, as from a database driver."""
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = asyncio.Future()
+        if self.rows:
+            future.set_result(self.rows.pop(0))
+        else:
+            future.set_exception(StopAsyncIteration())
+        return future
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'rendering asynchronously requires Python 3.5')
+class TestAsync(TestCase):
+
+    def test_render_async(self):
+        compiler = Compiler()
+        template = compiler.compile(u"{{#each rows}}<td>{{name}}</td>{{/each}}{{> footer}}")
+        footer = compiler.compile(u"<p>{{title}}</p>")
+        context = {'rows': [{'name': u'a'}, {'name': u'<b>'}], 'title': u'T'}
+
+        expected = template(context, partials={'footer': footer})
+        self.assertEqual(u"<td>a</td><td>&lt;b&gt;</td><p>T</p>", expected)
+        self.assertEqual(expected, run(template.render_async(context, partials={'footer': footer})))
+        self.assertEqual(u"text", run(compiler.compile(u"text").render_async({})))
+
+        template = compiler.compile(u"{{#each rows}}<td>{{name}}</td>{{/each}}", encoding='utf-8')
+        self.assertEqual(b"<td>a</td><td>&lt;b&gt;</td>", run(template.render_async(context)))
+
+    def test_awaitable_values(self):
+        template = Compiler().compile(
+            u"{{title}} {{avatar id}} {{shout (avatar id)}}{{#each rows}},{{name}}{{/each}}"
+            u"{{#if admin}} admin{{/if}}{{#each stream}}/{{.}}{{/each}}")
+        helpers = {
+            'avatar': lambda this, id: later(u'<img %s>' % id),
+            'shout': lambda this, value: value.upper(),
+        }
+        context = {
+            'title': lambda this: later(u'T'),
+            'id': 7,
+            'rows': later([{'name': later(u'a')}, {'name': u'b'}]),
+            'admin': later(True),
+            'stream': Rows([1, 2]),
+        }
+        self.assertEqual(
+            u"T &lt;img 7&gt; &lt;IMG 7&gt;,a,b admin/1/2",
+            run(template.render_async(context, helpers=helpers)))
+
+    def test_block_helpers(self):
+        template = Compiler().compile(
+            u"{{#list people}}{{name}}{{/list}} {{#form}}{{title}}{{/form}} {{#first people}}{{name}}{{/first}}"
+            u"{{#tag}}{{/tag}}")
+
+        def list_(this, options, items):
+            result = [u'<ul>']
+            for thing in items:
+                result = result + [u'<li>'] + options['fn'](thing) + [u'</li>']
+            return result + [u'</ul>']
+
+        def form(this, options):
+            # Helpers that need the text of a block await it
+            result = asyncio.Future()
+            output = asyncio.ensure_future(options['fn'](this))
+            output.add_done_callback(lambda done: result.set_result(u'<form>%s</form>' % done.result()))
+            return result
+
+        helpers = {
+            'list': list_,
+            'form': form,
+            'first': lambda this, options, items: later(options['fn'](items[0])),
+            'tag': lambda this, options: [u'<b>', asyncio.ensure_future(later(u'!')), u'</b>'],
+        }
+        # Callables give a new coroutine whenever the template uses them
+        context = {'people': [{'name': lambda this: later(u'Alan')}, {'name': u'Yehuda'}], 'title': lambda this: later(u'T')}
+        self.assertEqual(
+            u"<ul><li>Alan</li><li>Yehuda</li></ul> <form>T</form> Alan<b>!</b>",
+            run(template.render_async(context, helpers=helpers)))
+
+        def format_(this, options):
+            return u'%s' % options['fn'](this)
+
+        # Synchronous helpers can format the output of blocks that do not
+        # wait, but not of those that do
+        template = Compiler().compile(u"{{#format}}{{name}}{{/format}}")
+        self.assertEqual(u"Yehuda", run(template.render_async({'name': u'Yehuda'}, helpers={'format': format_})))
+        with self.assertRaises(PybarsError):
+            run(template.render_async({'name': later(u'Alan')}, helpers={'format': format_}))
+
+    def test_each_concurrency(self):
+        template = Compiler().compile(u"{{#each items}}{{fetch this}}{{/each}}")
+        log = []
+
+        def fetch(this, item):
+            log.append((u'start', item))
+            future = asyncio.ensure_future(later(item))
+            future.add_done_callback(lambda done: log.append((u'end', item)))
+            return future
+
+        output = run(template.render_async({'items': list(range(200))}, helpers={'fetch': fetch}))
+        self.assertEqual(u''.join(str(i) for i in range(200)), output)
+        # The items wait for their helpers at the same time, a bounded
+        # number at once
+        self.assertEqual([(u'start', 0), (u'start', 1)], log[:2])
+        self.assertTrue(log.index((u'end', 0)) < log.index((u'start', 199)))
+
+        def maybe_fail(this, item):
+            if item % 2:
+                raise TypeError()
+            return later(item)
+
+        # Items raising TypeError render nothing, as when rendering
+        # synchronously
+        template = Compiler().compile(u"{{#each items}}[{{fail this}}]{{/each}}")
+        helpers = {'fail': maybe_fail}
+        self.assertEqual(u"[0][2]", run(template.render_async({'items': [0, 1, 2, 3]}, helpers=helpers)))
+
+    @unittest.skipIf(sys.version_info < (3, 11), 'asyncio.timeout() requires Python 3.11')
+    def test_each_tasks(self):
+        from tests._async_helpers import timeout_or_done
+
+        template = Compiler().compile(u"{{#each items}}[{{slow this}}]{{/each}}")
+        self.assertEqual(
+            u"[timeout 1][timeout 2]",
+            run(template.render_async({'items': [1, 2]}, helpers={'slow': timeout_or_done})))
+
+        # Items that do not wait render in the task of the template
+        tasks = []
+
+        def current(this, item):
+            tasks.append(asyncio.current_task())
+            return item
+
+        template = Compiler().compile(u"{{#each items}}{{current this}}{{/each}}")
+        self.assertEqual(u"123", run(template.render_async({'items': [1, 2, 3]}, helpers={'current': current})))
+        self.assertEqual(1, len(set(tasks)))
+
+    def test_partials(self):
+        compiler = Compiler()
+        template = compiler.compile(u"{{#each rows}}{{> row}}{{/each}}{{> static}}{{> function}}")
+        partials = {
+            'row': compiler.compile(u"<td>{{avatar id}}</td>"),
+            'static': compiler.compile(u"."),
+            'function': lambda this, helpers, partials, root: later(u'!'),
+        }
+        helpers = {'avatar': lambda this, id: later(u'%d' % id)}
+        self.assertEqual(
+            u"<td>1</td><td>2</td>.!",
+            run(template.render_async({'rows': [{'id': 1}, {'id': 2}]}, helpers=helpers, partials=partials)))
+
+    def test_known_helpers(self):
+        template = Compiler().compile(
+            u"{{#each rows}}{{avatar this}}{{/each}}", knownHelpers=['avatar'], knownHelpersOnly=True)
+        helpers = {'avatar': lambda this, id: later(u'<%d>' % id)}
+        self.assertEqual(u"&lt;1&gt;&lt;2&gt;", run(template.render_async({'rows': [1, 2]}, helpers=helpers)))
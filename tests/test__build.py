@@ -0,0 +1,120 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Tests for the ahead-of-time template build."""
+
+import importlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from unittest import TestCase
+
+from pybars import PybarsError, build
+from pybars.__main__ import main
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'the tests use importlib from Python 3.4')
+class TestBuild(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'templates')
+        self.output = os.path.join(self.root, 'out', 'pybars_test_build')
+        sys.path.insert(0, os.path.join(self.root, 'out'))
+
+    def tearDown(self):
+        sys.path.remove(os.path.join(self.root, 'out'))
+        for name in list(sys.modules):
+            if name.startswith('pybars_test_build'):
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def write(self, name, source):
+        path = os.path.join(self.source, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(source)
+
+    def load(self):
+        for name in list(sys.modules):
+            if name.startswith('pybars_test_build'):
+                del sys.modules[name]
+        importlib.invalidate_caches()
+        return importlib.import_module('pybars_test_build').templates
+
+    def test_build(self):
+        self.write('email/welcome.hbs', u"Hi {{name}}! {{> email/footer}}")
+        self.write('email/footer.handlebars', u"-- {{sender}}")
+        self.write('readme.txt', u"not a template")
+
+        result = build(self.source, self.output)
+        self.assertEqual(['email/footer', 'email/welcome'], result['built'])
+
+        templates = self.load()
+        self.assertEqual(['email/footer', 'email/welcome'], sorted(templates))
+        self.assertEqual(
+            u"Hi Ahmed! -- Will",
+            templates['email/welcome']({'name': 'Ahmed', 'sender': 'Will'}, partials=templates))
+
+        import importlib.util
+
+        for filename in os.listdir(self.output):
+            if filename.endswith('.py'):
+                self.assertTrue(os.path.exists(importlib.util.cache_from_source(os.path.join(self.output, filename))))
+
+    def test_incremental(self):
+        self.write('a.hbs', u"a")
+        self.write('b.hbs', u"b")
+        self.write('c.hbs', u"c")
+        build(self.source, self.output)
+
+        self.write('b.hbs', u"B")
+        os.unlink(os.path.join(self.source, 'c.hbs'))
+        result = build(self.source, self.output)
+        self.assertEqual(['b'], result['built'])
+        self.assertEqual(['a'], result['unchanged'])
+        self.assertEqual(['c'], result['removed'])
+
+        templates = self.load()
+        self.assertEqual(u"B", templates['b']({}))
+        self.assertNotIn('c', templates)
+        self.assertEqual(
+            ['__init__.py', '__pycache__', '_pybars_build.json'],
+            sorted(f for f in os.listdir(self.output) if not f.startswith('t_')))
+        self.assertEqual(2, len([f for f in os.listdir(self.output) if f.startswith('t_')]))
+
+    def test_error(self):
+        self.write('bad.hbs', u"{{#if}")
+        with self.assertRaises(PybarsError) as cm:
+            build(self.source, self.output)
+        self.assertIn('bad.hbs', str(cm.exception))
+
+    def test_duplicate_names(self):
+        self.write('a.hbs', u"a")
+        self.write('a.handlebars', u"A")
+        with self.assertRaises(PybarsError) as cm:
+            build(self.source, self.output)
+        self.assertIn(os.path.join(self.source, 'a.hbs'), str(cm.exception))
+        self.assertIn(os.path.join(self.source, 'a.handlebars'), str(cm.exception))
+
+    def test_main(self):
+        self.write('a.hbs', u"a")
+        self.assertEqual(0, main(['build', self.source, '-o', self.output, '-e', '.txt']))
+        self.assertEqual([], list(self.load()))
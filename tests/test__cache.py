@@ -0,0 +1,103 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Tests for the compiled template cache."""
+
+import sys
+
+from unittest import TestCase
+
+from pybars import Compiler, TemplateCache
+
+
+class TestTemplateCache(TestCase):
+
+    def test_hit(self):
+        cache = TemplateCache()
+        compiler = Compiler(cache=cache)
+
+        template = compiler.compile(u"Hi {{name}}!")
+        self.assertIs(template, compiler.compile(u"Hi {{name}}!"))
+        self.assertIsNot(template, compiler.compile(u"Bye {{name}}!"))
+
+        self.assertEqual(u"Hi Ahmed!", template({'name': 'Ahmed'}))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(2, len(cache))
+
+    def test_shared_between_compilers(self):
+        cache = TemplateCache()
+
+        template = Compiler(cache=cache).compile(u"{{a}}")
+        self.assertIs(template, Compiler(cache=cache).compile(u"{{a}}"))
+
+    def test_max_entries(self):
+        cache = TemplateCache(max_entries=2)
+        compiler = Compiler(cache=cache)
+
+        first = compiler.compile(u"1")
+        compiler.compile(u"2")
+        compiler.compile(u"1")
+        compiler.compile(u"3")
+
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertIn(cache.digest(u"1"), cache)
+        self.assertNotIn(cache.digest(u"2"), cache)
+        self.assertIs(first, compiler.compile(u"1"))
+
+    def test_max_bytes(self):
+        cache = TemplateCache(max_entries=None, max_bytes=1)
+        compiler = Compiler(cache=cache)
+
+        template = compiler.compile(u"{{a}}")
+
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.nbytes)
+        self.assertEqual(1, cache.evictions)
+        self.assertNotIn(template.__module__, sys.modules)
+        self.assertEqual(u"b", template({'a': 'b'}))
+
+    def test_ttl(self):
+        cache = TemplateCache(ttl=60)
+        compiler = Compiler(cache=cache)
+        now = [1000.0]
+        cache._time = lambda: now[0]
+
+        template = compiler.compile(u"{{a}}")
+        now[0] += 30
+        self.assertIs(template, compiler.compile(u"{{a}}"))
+        now[0] += 31
+        self.assertIsNot(template, compiler.compile(u"{{a}}"))
+        self.assertEqual(1, cache.evictions)
+
+    def test_invalidate(self):
+        cache = TemplateCache()
+        compiler = Compiler(cache=cache)
+
+        template = compiler.compile(u"{{a}}")
+        self.assertTrue(cache.invalidate(u"{{a}}"))
+        self.assertFalse(cache.invalidate(u"{{a}}"))
+        self.assertIsNot(template, compiler.compile(u"{{a}}"))
+
+        # With the options the template was compiled with
+        compiler.compile(u"{{up a}}", knownHelpers=['up'], knownHelpersOnly=True, encoding='utf-8')
+        self.assertFalse(cache.invalidate(u"{{up a}}", ['up']))
+        self.assertTrue(cache.invalidate(u"{{up a}}", ['up'], True, 'utf-8'))
+        self.assertNotIn(cache.key(u"{{up a}}", ['up'], True, 'utf-8'), cache)
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.nbytes)
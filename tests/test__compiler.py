@@ -21,17 +21,22 @@ except NameError:
     # Python 3 support
     str_class = str
 
+import io
 import sys
+import threading
+import unittest
 
+from collections import OrderedDict, namedtuple
 from unittest import TestCase
 
-from pybars import Compiler
+from pybars import Compiler, PybarsError, strlist
+from pybars._compiler import Parser, _pybars_
 
 
 def render(source, context, helpers=None, partials=None, knownHelpers=None,
-           knownHelpersOnly=False):
+           knownHelpersOnly=False, chunk_size=None):
     compiler = Compiler()
-    template = compiler.compile(source)
+    template = compiler.compile(source, knownHelpers=knownHelpers, knownHelpersOnly=knownHelpersOnly)
     # For real use, partials is a dict of compiled templates; but for testing
     # we compile just-in-time.
     if not partials:
@@ -39,6 +44,8 @@ def render(source, context, helpers=None, partials=None, knownHelpers=None,
     else:
         real_partials = dict((key, compiler.compile(value))
             for key, value in list(partials.items()))
+    if chunk_size is not None:
+        return u''.join(template.stream(context, helpers=helpers, partials=real_partials, chunk_size=chunk_size))
     return str_class(template(context, helpers=helpers, partials=real_partials))
 
 
@@ -134,3 +141,635 @@ class TestCompiler(TestCase):
         # recompile and check that a new path is used
         self.assertEqual(result, compiler.compile(template, path=path)(context))
         self.assertTrue(sys.modules.get('pybars._templates._project_widgets_templates_1') is not None)
+
+    def test_parser_tree(self):
+        source = u"Hi {{name}}\n  {{#each items key=\"v\"}}{{{../x}}}{{else}}{{> p id=b.c}}{{/each}}"
+        tree, position = Parser(source).parse()
+
+        self.assertEqual(len(source), position)
+        self.assertEqual([
+            'template',
+            ('literal', u'Hi '),
+            ('escapedexpand', ('path', [u'name']), []),
+            ('newline', u'\n'),
+            ('whitespace', u'  '),
+            ('block', u'each', [('path', [u'items']), ('kwparam', u'key', ('literalparam', u'"v"'))],
+                ['template', ('expand', ('path', [u'@_parent', u'x']), [])],
+                ['template', ('partial', ('literalparam', u'"p"'), [('kwparam', u'id', ('path', [u'b', u'', u'c']))])]),
+        ], tree)
+
+    def test_parser_error_position(self):
+        tree, position = Parser(u"{{foo}} {{bar}").parse()
+
+        self.assertEqual(13, position)
+
+    def test_whitespace_control(self):
+        whitespace_control = Compiler().whitespace_control
+        cases = [
+            (u"a {{~b~}} \n c", u"a{{b}}c"),
+            (u"{{#if a}}\r\n x\n  {{else}}  \n y\n{{/if}}", u"{{#if a}} x\n{{else}} y{{/if}}"),
+            (u"{{#a}}\n{{/a}}\r\n\r", u"{{#a}}{{/a}}\r"),
+            (u"!c ~}}\r\n{{/each}}", u"!c }}{{/each}}"),
+            (u"x\n {{! c ~}} {{/a}} \n", u"x{{! c }}{{/a}}\n"),
+            (u"x {{#a}}\n", u"x {{#a}}\n"),
+        ]
+        for source, expected in cases:
+            self.assertEqual(expected, whitespace_control(source))
+
+        # Long runs of whitespace used to take quadratic time
+        self.assertEqual(u"{{x}}", whitespace_control(u" \n" * 50000 + u"{{~x}}"))
+        self.assertEqual(u" " * 100000 + u"x", whitespace_control(u" " * 100000 + u"x"))
+
+    def test_literals(self):
+        compiler = Compiler()
+
+        # The block holds text alone and so returns a constant
+        source = u"<p>\n  {{! note }}\n  {{#if a}}\n  yes\n  {{/if}}\n</p>\n"
+        code = compiler.precompile(source)
+        self.assertEqual(1, code.count(u"result = strlist()"))
+        self.assertEqual(u"<p>\n  yes\n</p>\n", compiler.compile(source)({'a': True}))
+
+        code = compiler.precompile(u"a\n {{! note }} b{{x}}c\n d")
+        self.assertEqual(2, code.count(u"result.append("))
+
+        template = compiler.compile(u"static\n{{! note }}  text")
+        self.assertEqual(u"static\n  text", template({}))
+        self.assertEqual(str_class, type(template({})))
+        self.assertEqual(u"", compiler.compile(u"{{! note }}")({}))
+
+    def test_known_helpers(self):
+        compiler = Compiler()
+        helpers = {'upper': lambda this, value: value.upper()}
+        source = u"{{upper name}} {{#if name}}{{name}}{{/if}}{{^items}}none{{/items}} {{lambda}}"
+        context = {'name': u'ahmed', 'items': [], 'lambda': lambda this: u'called'}
+
+        code = compiler.precompile(source, knownHelpers=['upper'], knownHelpersOnly=True)
+        self.assertNotIn(u"helpers.get(", code)
+        self.assertIn(u"value = resolve_name(context, u'lambda')\n    result.grow(prepare(value, True))", code)
+        self.assertIn(u"helpers[u'upper'](context, resolve_name(context, u'name'))", code)
+
+        template = compiler.compile(source, knownHelpers=['upper'], knownHelpersOnly=True)
+        # Values from the context are not called
+        output = str_class(template(context, helpers=helpers))
+        self.assertTrue(output.startswith(u"AHMED ahmednone &lt;function"))
+
+        template = compiler.compile(source, knownHelpers={'upper': True, 'if': False})
+        self.assertEqual(u"AHMED ahmednone called", template(context, helpers=helpers))
+
+        with self.assertRaises(PybarsError) as cm:
+            compiler.compile(u"{{upper name}}", knownHelpersOnly=True)
+        self.assertEqual("You specified knownHelpersOnly, but used the unknown helper upper", str(cm.exception))
+
+    def test_partial_entry_point(self):
+        compiler = Compiler()
+        row = compiler.compile(u"<{{name}}{{mark}}>")
+        self.assertTrue(hasattr(row, '_pybars_render'))
+
+        def plain(context, helpers=None, partials=None, root=None):
+            return [u"(", row(context, helpers=helpers, partials=partials, root=root), u")"]
+
+        template = compiler.compile(u"{{#each rows}}{{> row}}{{> plain}}{{/each}}")
+        output = template(
+            {'rows': [{'name': u'a'}, {'name': u'b'}]},
+            helpers={'mark': lambda this: u'!'},
+            partials={'row': row, 'plain': plain})
+        self.assertEqual(u"<a!>(<a!>)<b!>(<b!>)", output)
+
+    def test_bind(self):
+        compiler = Compiler()
+        helpers = {'shout': lambda this, value: value.upper()}
+        partials = {'footer': compiler.compile(u"-- {{shout sender}}")}
+        template = compiler.compile(u"{{shout name}} {{> footer}}")
+
+        bound = template.bind(helpers=helpers, partials=partials)
+        context = {'name': u'ahmed', 'sender': u'will'}
+        self.assertEqual(u"AHMED -- WILL", bound(context))
+        self.assertEqual(str_class, type(bound(context)))
+
+        # The helpers and partials were copied when binding
+        helpers['shout'] = lambda this, value: value
+        del partials['footer']
+        self.assertEqual(u"AHMED -- WILL", bound(context))
+        rebound = template.bind(helpers=helpers, partials={'footer': compiler.compile(u"--")})
+        self.assertEqual(u"ahmed --", rebound(context))
+
+        self.assertEqual(u"static", compiler.compile(u"static").bind()({}))
+
+    def test_native_blocks(self):
+        from pybars._compiler import _each, _if, _unless, _with
+
+        source = (
+            u"{{#each items}}{{@index}}{{#if @first}}first{{/if}}:{{name}}"
+            u"{{#unless @last}},{{else}}.{{/unless}}{{/each}}"
+            u"{{#each map}}[{{@key}}={{this}}]{{/each}}"
+            u"{{#each empty}}x{{else}}empty{{/each}}{{#each missing}}x{{/each}}"
+            u"{{#with person}}{{name}} {{../title}}{{/with}}"
+            u"{{#if check}}yes{{else}}no{{/if}}{{#if empty}}{{else}}{{/if}}")
+        context = {
+            'items': [{'name': u'a'}, {'name': u'b'}],
+            'map': {'k': u'v'},
+            'empty': [],
+            'person': {'name': u'Will'},
+            'title': u'Dr',
+            'check': lambda this: False,
+        }
+        expected = u"0first:a,1:b.[k=v]emptyWill no"
+        template = Compiler().compile(source)
+        self.assertEqual(expected, template(context))
+
+        # Replaced helpers are called instead, which here gives the same
+        # output through the generic code
+        helpers = {
+            'each': lambda *args: _each(*args),
+            'if': lambda *args: _if(*args),
+            'unless': lambda *args: _unless(*args),
+            'with': lambda *args: _with(*args),
+        }
+        self.assertEqual(expected, template(context, helpers=helpers))
+        self.assertEqual(
+            u"yes", Compiler().compile(u"{{#if check}}yes{{/if}}")({'check': False}, helpers={
+                'if': lambda this, options, value: options['fn'](this)}))
+
+    def test_options(self):
+        seen = {}
+
+        def block(this, options, value):
+            seen['keys'] = sorted(options)
+            seen['missing'] = options.get('hash')
+            seen['root'] = options['root']
+            return [options['fn'](value), options['inverse'](this) or u'']
+
+        source = u"{{#block a}}<{{b}}>{{else}}-{{/block}}{{#block a}}{{/block}}{{{{block a}}}}{{x}}{{{{/block}}}}"
+        context = {'a': {'b': u'B'}}
+        output = Compiler().compile(source)(context, helpers={'block': block})
+
+        self.assertEqual(u"<B>-{{x}}", output)
+        self.assertEqual(['fn', 'helpers', 'inverse', 'partials', 'root'], seen['keys'])
+        self.assertEqual(None, seen['missing'])
+        self.assertEqual(context, seen['root'])
+
+        # Blocks without expressions give block helpers a strlist too
+        def para(this, options):
+            return strlist([u'<p>']) + options['fn'](this) + options['inverse'](this) + strlist([u'</p>'])
+
+        source = u"{{#para}}static{{else}}!{{/para}}"
+        helpers = {'para': para}
+        compiler = Compiler()
+        self.assertEqual(u"<p>static!</p>", compiler.compile(source)({}, helpers=helpers))
+        self.assertEqual(u"<p>static!</p>", u''.join(compiler.compile(source).stream({}, helpers=helpers)))
+        self.assertEqual(b"<p>static!</p>", compiler.compile(source, encoding='utf-8')({}, helpers=helpers))
+
+        # Helpers may change the options as they could when they were a dict
+        def change(this, options):
+            options['hash'] = u'!'
+            options['fn'] = lambda this: u'fn'
+            del options['inverse']
+            seen['keys'] = sorted(options)
+            seen['missing'] = options.get('inverse')
+            seen['copy'] = options.copy()
+            return options['fn'](this) + options['hash']
+
+        output = Compiler().compile(u"{{#each l}}{{#change}}x{{/change}}{{/each}}")({'l': [1]}, helpers={'change': change})
+        self.assertEqual(u"fn!", output)
+        self.assertEqual(['fn', 'hash', 'helpers', 'partials', 'root'], seen['keys'])
+        self.assertEqual(None, seen['missing'])
+        self.assertEqual(dict, type(seen['copy']))
+        self.assertEqual(['fn', 'hash', 'helpers', 'partials', 'root'], sorted(seen['copy']))
+        self.assertEqual(u'!', seen['copy']['hash'])
+
+    def test_path_lookups(self):
+        compiler = Compiler()
+        source = u"{{a.b}} {{a.b}} {{l.1.c}} {{l.length}} {{l.length.x}} {{l.9}} {{s.0}} {{#each l}}{{../n.x}}{{/each}}"
+        code = compiler.precompile(source)
+        self.assertEqual(1, code.count(u"def path_1(value):"))
+        self.assertEqual(2, code.count(u"path_1(context)"))
+        self.assertNotIn(u"resolve(", code.split(u"\n_pybars_constructs")[0].split(u"\n\n", 1)[1])
+
+        class Named(object):
+            x = u'attr'
+
+        context = {'a': {'b': u'B'}, 'l': [{}, {'c': u'C'}], 's': u'str', 'n': Named()}
+        # Out of range indexes give an empty dict, as resolve() does
+        self.assertEqual(u"B B C 2 2 {}  attrattr", compiler.compile(source)(context))
+
+    def test_data_lookups(self):
+        compiler = Compiler()
+        source = u"{{#each l}}{{@index}}{{@first}}{{name}}{{this.name}}{{@root.t}}{{../t}}{{@../index}};{{/each}}{{@index}}"
+        code = compiler.precompile(source)
+        self.assertNotIn(u"context.get(u'@index')", code.replace(u"is not None else context.get(u'@index')", u""))
+        self.assertIn(u"resolve_name(context, u'name')", code)
+        self.assertIn(u"value = value.parent\n", code)
+        self.assertIn(u"value = value.root\n", code)
+
+        template = compiler.compile(source)
+        context = {'l': [{'name': u'a'}, {'name': u'b'}], 't': u'T'}
+        self.assertEqual(u"0truea" u"aTT;1falsebbTT;", template(context))
+        # Data variables that are not set fall back to the context
+        context['@index'] = u'top'
+        self.assertEqual(u"0truea" u"aTTtop;1falsebbTTtop;top", template(context))
+
+    def test_each_lazy(self):
+        compiler = Compiler()
+        fetched = []
+
+        def rows(count):
+            for i in range(count):
+                fetched.append(i)
+                yield {'name': u'row %d' % i}
+
+        def ahead(this):
+            # How many rows were fetched beyond the current one
+            return str_class(len(fetched) - 1 - int(this.get('name')[4:]))
+
+        template = compiler.compile(u"{{#each rows}}{{name}}:{{ahead}}{{#if @last}}!{{/if}},{{else}}none{{/each}}")
+        self.assertEqual(u"row 0:1,row 1:1,row 2:0!,", template({'rows': rows(3)}, helpers={'ahead': ahead}))
+        self.assertEqual(u"none", template({'rows': rows(0)}))
+        plain = compiler.compile(u"{{#each rows}}{{name}},{{/each}}")
+        self.assertEqual(u"row 0,row 1,", plain({'rows': rows(2)}))
+        self.assertEqual(u"0:a1:b", compiler.compile(u"{{#each rows}}{{@index}}:{{.}}{{/each}}")({'rows': iter(u'ab')}))
+        self.assertEqual(u"-", compiler.compile(u"{{#each rows}}x{{else}}-{{/each}}")({'rows': 5}))
+
+        class Cursor(object):
+            def keys(self):
+                return ['a', 'b']
+
+            def __iter__(self):
+                return iter(self.keys())
+
+            def __getitem__(self, key):
+                return key.upper()
+
+        template = compiler.compile(u"{{#each rows}}{{@key}}={{.}}{{#unless @last}},{{/unless}}{{/each}}")
+        self.assertEqual(u"a=A,b=B", template({'rows': Cursor()}))
+        self.assertEqual(u"AB", compiler.compile(u"{{#each rows}}{{.}}{{/each}}")({'rows': Cursor()}))
+
+    def test_stream(self):
+        compiler = Compiler()
+        fetched = []
+
+        def rows():
+            for i in range(1000):
+                fetched.append(i)
+                yield {'name': u'row %d' % i}
+
+        row = compiler.compile(u"<td>{{name}}</td>")
+        template = compiler.compile(
+            u"<h1>{{title}}</h1>{{#with page}}{{#each rows}}<tr>{{> row}}</tr>{{/each}}{{/with}}"
+            u"{{#upper}}end{{/upper}}")
+        helpers = {'upper': lambda this, options: str_class(options['fn'](this)).upper()}
+        context = {'title': u'T', 'page': {'rows': rows()}}
+
+        chunks = template.stream(context, helpers=helpers, partials={'row': row}, chunk_size=100)
+        first = next(chunks)
+        # Output starts before the rows are all fetched
+        self.assertTrue(len(first) >= 100)
+        self.assertTrue(len(fetched) < 10)
+        rest = list(chunks)
+        self.assertEqual(1000, len(fetched))
+        self.assertTrue(all(len(chunk) >= 100 for chunk in rest[:-1]))
+
+        context['page']['rows'] = [{'name': u'row %d' % i} for i in range(1000)]
+        expected = template(context, helpers=helpers, partials={'row': row})
+        self.assertEqual(expected, first + u''.join(rest))
+        self.assertTrue(expected.endswith(u"</tr>END"))
+        pieces = list(template.stream(context, helpers=helpers, partials={'row': row}, chunk_size=0))
+        self.assertEqual([u'<h1>', u'T', u'</h1>', u'<tr>', u'<td>'], pieces[:5])
+
+        # Templates loaded from precompiled code stream too
+        code = compiler.precompile(u"{{#each l}}{{.}}{{/each}}")
+        namespace = {}
+        exec(code, namespace)
+        self.assertEqual([u'1', u'2'], list(namespace['render'].stream({'l': [1, 2]}, chunk_size=0)))
+        self.assertEqual([], list(compiler.compile(u"{{#if x}}{{/if}}").stream({})))
+
+    def test_stream_acceptance(self):
+        from tests.test_acceptance import TestAcceptance
+
+        class TestStreamAcceptance(TestAcceptance):
+
+            """The acceptance tests, checking that streaming gives the output
+            of rendering, whether in pieces or chunks."""
+
+            # Counts the calls of the log helper of a single render
+            test_log = None
+
+            def assertRender(self, template, context, result, helpers=None, partials=None, error=None, **kwargs):
+                try:
+                    expected = render(template, context, helpers=helpers, partials=partials, **kwargs)
+                except PybarsError:
+                    return
+                for chunk_size in (0, 64):
+                    self.assertEqual(expected, render(
+                        template, context, helpers=helpers, partials=partials, chunk_size=chunk_size, **kwargs))
+
+            def test_each_item_output_errors(self):
+                # Items whose output a strlist cannot grow by render nothing
+                helpers = {'count': lambda this, options, value: value if value % 2 else str_class(value)}
+                for source in (u"{{#each items}}[{{#count this}}{{/count}}]{{/each}}",
+                               u"{{#each items}}[{{{{count this}}}}{{{{/count}}}}]{{/each}}"):
+                    self.assertEqual(u"[2][4]", render(source, {'items': [1, 2, 3, 4]}, helpers=helpers))
+                    self.assertRender(source, {'items': [1, 2, 3, 4]}, u"[2][4]", helpers=helpers)
+
+        result = unittest.TestResult()
+        unittest.TestLoader().loadTestsFromTestCase(TestStreamAcceptance).run(result)
+        self.assertEqual([], [str(test) for test, _ in result.failures + result.errors])
+        self.assertTrue(result.testsRun > 100)
+
+    def test_render_to(self):
+        compiler = Compiler()
+        template = compiler.compile(u"<ul>{{#each rows}}<li>{{> row}}</li>{{/each}}</ul>{{#upper}}end{{/upper}}")
+        partials = {'row': compiler.compile(u"{{name}}")}
+        helpers = {'upper': lambda this, options: str_class(options['fn'](this)).upper()}
+        context = {'rows': [{'name': u'row %d' % i} for i in range(100)]}
+        expected = template(context, helpers=helpers, partials=partials)
+
+        class Sink(object):
+            def __init__(self):
+                self.writes = []
+
+            def write(self, text):
+                self.writes.append(text)
+
+        sink = Sink()
+        self.assertEqual(
+            len(expected), template.render_to(sink, context, helpers=helpers, partials=partials, buffer_size=100))
+        self.assertEqual(expected, u''.join(sink.writes))
+        self.assertTrue(all(len(text) >= 100 for text in sink.writes[:-1]))
+
+        # Unbuffered, the output of each construct is written as it renders
+        sink = Sink()
+        template.render_to(sink, context, helpers=helpers, partials=partials, buffer_size=0)
+        self.assertEqual([u'<ul>', u'<li>', u'row 0', u'</li>'], sink.writes[:4])
+        self.assertEqual(expected, u''.join(sink.writes))
+
+        output = io.StringIO()
+        template.render_to(output, context, helpers=helpers, partials=partials)
+        self.assertEqual(expected, output.getvalue())
+
+    def test_encoding(self):
+        from pybars._compiler import byteslist_class
+
+        compiler = Compiler()
+        source = u"<p>\u00e9t\u00e9 {{name}}</p>{{#each rows}}<i>{{.}}</i>{{/each}}{{#list rows}}[{{.}}]{{/list}}{{> row}}"
+        template = compiler.compile(source, encoding='utf-8')
+        partials = {'row': compiler.compile(u"<b>{{name}}</b>")}
+
+        def list_(this, options, items):
+            # Block helpers get text, as from templates returning text
+            result = [u'<ul>']
+            for thing in items:
+                result = result + options['fn'](thing)
+            return result + [u'</ul>']
+
+        helpers = {'list': list_}
+        context = {'name': u'\u20ac', 'rows': [1, 2]}
+        expected = compiler.compile(source)(context, helpers=helpers, partials=partials).encode('utf-8')
+        self.assertEqual(expected, template(context, helpers=helpers, partials=partials))
+        self.assertEqual(expected, template.bind(helpers, partials)(context))
+        self.assertEqual(b"\xc3\xa9", compiler.compile(u"\u00e9", encoding='utf-8')({}))
+
+        # The text is encoded as the template compiles
+        code = compiler.precompile(u"\u00e9t\u00e9 {{name}}", encoding='utf-8')
+        self.assertIn(repr(u"\u00e9t\u00e9 ".encode('utf-8')), code)
+
+        # Templates returning bytes and text use each other as partials
+        partials = {'row': compiler.compile(u"<b>{{name}}</b>", encoding='utf-16-le')}
+        self.assertEqual(expected, template(context, helpers=helpers, partials=partials))
+        text = compiler.compile(u"{{> row}}")
+        self.assertEqual(u"<b>\u20ac</b>", text(context, partials={'row': compiler.compile(
+            u"<b>{{name}}</b>", encoding='utf-16-le')}))
+        with self.assertRaises(PybarsError):
+            compiler.compile(u"{{name}}", encoding='utf-16')
+
+        output = byteslist_class('utf-8')()
+        output.grow([u'\u00e9', b'!', [u'?']])
+        self.assertEqual([b'\xc3\xa9', b'!', b'?'], output)
+        self.assertEqual(u"\u00e9!?", str_class(output))
+
+        self.assertEqual([expected], list(template.stream(context, helpers=helpers, partials=partials)))
+        sink = bytearray()
+        self.assertEqual(len(expected), template.render_to(sink, context, helpers=helpers, partials=partials))
+        self.assertEqual(expected, sink)
+        buffer = bytearray(len(expected) + 10)
+        self.assertEqual(
+            len(expected), template.render_to(memoryview(buffer), context, helpers=helpers, partials=partials))
+        self.assertEqual(expected, buffer[:len(expected)])
+        with self.assertRaises(PybarsError):
+            template.render_to(memoryview(bytearray(10)), context, helpers=helpers, partials=partials)
+
+    def test_scope(self):
+        from pybars import Scope
+
+        scope = Scope({'a': 1}, None, {}, None, 2, u'k', False, True)
+        self.assertFalse(hasattr(scope, '__dict__'))
+        self.assertEqual((1, 2, u'k', False, True), tuple(
+            scope.get(name) for name in ('a', '@index', '@key', '@first', '@last')))
+
+        seen = []
+
+        def keep(this):
+            seen.append(this)
+            return u''
+
+        template = Compiler().compile(u"{{#each items}}{{keep}}{{@key}}{{/each}}")
+        template({'items': OrderedDict([('x', 1), ('y', 2)])}, helpers={'keep': keep})
+        # Every item has a Scope of its own, so helpers may keep them
+        self.assertEqual([(1, u'x', 0), (2, u'y', 1)], [(scope.context, scope.key, scope.index) for scope in seen])
+
+    def test_each(self):
+        compiler = Compiler()
+        self.assertIn(u"each_items(value, False)", compiler.precompile(
+            u"{{#each l}}{{name}} {{b.c}}{{/each}}", knownHelpersOnly=True))
+        for source in (
+                u"{{#each l}}{{@index}}{{/each}}",
+                u"{{#each l}}{{#if a}}{{b.c}}{{/if}}{{/each}}",
+                u"{{#each l}}{{lookup this '@key'}}{{/each}}",
+                u"{{#each l}}{{h (h @first)}}{{/each}}",
+                u"{{#each l}}{{h}}{{/each}}",
+                u"{{#each l}}{{> p}}{{/each}}"):
+            self.assertIn(u"each_items(value, True)", compiler.precompile(source, knownHelpers=['h'], knownHelpersOnly=True))
+        # Without knownHelpersOnly any name may be a helper or a callable
+        # reading the data variables from this
+        self.assertIn(u"each_items(value, True)", compiler.precompile(u"{{#each l}}{{name}}{{/each}}"))
+        stripe = {'stripe': lambda this: u'odd' if this.get('@index') % 2 else u'even'}
+        self.assertEqual(u"even odd even ", compiler.compile(u"{{#each l}}{{stripe}} {{/each}}")(
+            {'l': [1, 2, 3]}, helpers=stripe))
+        self.assertEqual(u"even odd even ", compiler.compile(u"{{#each l}}{{stripe}} {{/each}}")(
+            {'l': [stripe] * 3}))
+
+        class Keyed(object):
+            def __init__(self, items):
+                self.items = items
+
+            def keys(self):
+                return [key for key, _ in self.items]
+
+            def __iter__(self):
+                return iter(self.keys())
+
+            def __len__(self):
+                return len(self.items)
+
+            def __getitem__(self, key):
+                return dict(self.items)[key]
+
+        def fail(this):
+            if this.get('this') == 2:
+                raise TypeError()
+            return u'ok'
+
+        helpers = {'fail': fail}
+        for source, context, expected in (
+                (u"{{#each l}}{{.}}{{/each}}", [1, 2], u"12"),
+                (u"{{#each l}}{{@index}}{{@key}}{{.}}{{#if @last}}!{{/if}}{{/each}}", {'a': 1, 'b': 2}, u"0a11b2!"),
+                (u"{{#each l}}{{@key}}{{.}},{{/each}}", Keyed([('x', 1), ('y', 2)]), u"x1,y2,"),
+                (u"{{#each l}}{{.}}{{/each}}", Keyed([('x', 1), ('y', 2)]), u"12"),
+                (u"{{#each l}}-{{/each}}", (1, 2, 3), u"---"),
+                (u"{{#each l}}{{/each}}{{^each l}}-{{/each}}", [1], u""),
+                (u"{{#each l}}x{{else}}none{{/each}}", 5, u"none"),
+                (u"{{#each l}}[{{fail}}]{{/each}}", [1, 2, 3], u"[ok][ok]"),
+                (u"{{#each l}}[{{@index}}{{fail}}]{{/each}}", [1, 2, 3], u"[0ok][2ok]"),
+                ):
+            self.assertEqual(expected, compiler.compile(source)({'l': context}, helpers=helpers))
+            # The same through _each(), as a helper that is not the built-in
+            helpers_each = dict(helpers, each=lambda *args: _pybars_['helpers']['each'](*args))
+            self.assertEqual(expected, compiler.compile(source)({'l': context}, helpers=helpers_each))
+
+        class Broken(object):
+            def __len__(self):
+                return 1
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                raise TypeError('broken')
+
+            next = __next__
+
+        # Only the items raising TypeError render nothing, not the iterator
+        for source in (u"{{#each l}}{{.}}{{/each}}", u"{{#each l}}{{@index}}{{/each}}"):
+            with self.assertRaises(TypeError):
+                compiler.compile(source)({'l': Broken()})
+            with self.assertRaises(TypeError):
+                compiler.compile(source)({'l': Broken()}, helpers=helpers_each)
+
+    def test_pick(self):
+        from pybars._compiler import _ATTRIBUTES, _ITEMS, _NUMBERED, _item_access, pick
+
+        class Row(object):
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+        class Getter(object):
+            def get(self, name):
+                return u'get ' + name
+
+        self.assertEqual(u'a', pick(Row(name=u'a'), 'name'))
+        # The cached strategy falls back for instances missing the attribute
+        self.assertEqual(u'x', pick(Row(), 'name', u'x'))
+        self.assertEqual(_ATTRIBUTES, _item_access[Row])
+        self.assertEqual(u'get name', pick(Getter(), 'name'))
+        self.assertEqual(u'b', pick({'name': u'b'}, 'name'))
+        self.assertEqual(None, pick({}, 'name'))
+        self.assertEqual(u'c', pick([u'c'], 0))
+        self.assertEqual(_ITEMS, _item_access[dict])
+
+        # Types whose item access rejects strings get attribute lookups for
+        # names, after the first, and item access for indexes
+        Point = namedtuple('Point', 'x y')
+        self.assertEqual(1, pick(Point(1, 2), 'x'))
+        self.assertEqual(_NUMBERED, _item_access[Point])
+        self.assertEqual(2, pick(Point(1, 2), 'y'))
+        self.assertEqual(2, pick(Point(1, 2), 1))
+        self.assertEqual(None, pick(Point(1, 2), 'z'))
+
+        class Picky(object):
+            # Rejects some keys with TypeError, as some mappings do
+            def __getitem__(self, name):
+                if name.startswith('_'):
+                    raise TypeError(name)
+                return u'item ' + name
+
+        picky = Picky()
+        self.assertEqual(None, pick(picky, '_private'))
+        self.assertEqual(_ITEMS, _item_access[Picky])
+        self.assertEqual(u'item name', pick(picky, 'name'))
+
+        rows = [Row(name=u'a'), Row(other=1), Row(name=u'c')]
+        template = Compiler().compile(u"{{#each rows}}[{{name}}]{{/each}}")
+        self.assertEqual(u"[a][][c]", template({'rows': rows}))
+
+    def test_compile_many(self):
+        sources = {
+            'list': u"{{#each items}}<{{this}}>{{/each}}",
+            'greeting': u"Hi {{name}}{{> list}}",
+            'broken': u"{{#if}",
+            }
+
+        for workers in (0, 2):
+            templates, errors = Compiler().compile_many(sources, workers=workers)
+
+            self.assertEqual(['greeting', 'list'], sorted(templates))
+            self.assertEqual(
+                u"Hi Ahmed<1><2>",
+                str_class(templates['greeting']({'name': 'Ahmed', 'items': [1, 2]}, partials=templates)))
+            self.assertEqual(['broken'], list(errors))
+            self.assertIn("line 1 near {{#if}", str(errors['broken']))
+            self.assertTrue(sys.modules.get(templates['list'].__module__) is not None)
+
+            # Generated code that Python rejects fails that template alone
+            templates, errors = Compiler().compile_many({'quote': u"{{[a'b]}}", 'list': sources['list']}, workers=workers)
+            self.assertEqual(['list'], list(templates))
+            self.assertIn("SyntaxError", str(errors['quote']))
+
+        class Failing(Compiler):
+            def _load(self, function_name, code, mod, filename):
+                if 'greeting' in mod.__name__:
+                    raise RuntimeError()
+                return Compiler._load(self, function_name, code, mod, filename)
+
+        before = set(sys.modules)
+        with self.assertRaises(RuntimeError):
+            Failing().compile_many(sources, workers=0)
+        # The modules reserved for the batch are released
+        self.assertEqual(set(), set(sys.modules) - before)
+
+    def test_threaded_compile(self):
+        compiler = Compiler()
+        start = threading.Event()
+        failures = []
+        modules = set()
+
+        def work(thread):
+            start.wait()
+            for i in range(20):
+                # Every template has nested blocks so that the generated
+                # function names of concurrent compilations would clash
+                source = u"%d:{{#each items}}{{#if this}}[%d-%d {{this}}]{{else}}%d{{/if}}{{/each}}" % (
+                    thread, thread, i, i)
+                template = compiler.compile(source, path='threaded/%d' % (i % 3))
+                modules.add(template.__module__)
+                expected = u"%d:[%d-%d a]%d" % (thread, thread, i, i)
+                output = str_class(template({'items': ['a', '']}))
+                if output != expected:
+                    failures.append((expected, output))
+
+        # Switch threads as often as possible to make interleaving likely
+        interval = getattr(sys, 'getswitchinterval', None)
+        if interval:
+            interval = interval()
+            sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=work, args=(t,)) for t in range(16)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            if interval:
+                sys.setswitchinterval(interval)
+
+        self.assertEqual([], failures)
+        self.assertEqual(16 * 20, len(modules))
@@ -0,0 +1,127 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Tests for the template import hook."""
+
+import importlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from unittest import TestCase
+
+import pybars
+from pybars import Compiler
+from pybars._importer import TemplateFinder
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'the import hook requires Python 3.4')
+class TestImporter(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.package = os.path.join(self.root, 'pybars_test_templates')
+        os.mkdir(self.package)
+        io.open(os.path.join(self.package, '__init__.py'), 'w').close()
+
+        # The environment may disable bytecode caching, which is under test
+        self.dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+
+        sys.path.insert(0, self.root)
+        self.finder = pybars.install_import_hook()
+
+    def tearDown(self):
+        pybars.uninstall_import_hook()
+        sys.dont_write_bytecode = self.dont_write_bytecode
+        sys.path.remove(self.root)
+        for name in list(sys.modules):
+            if name.startswith('pybars_test_templates'):
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def write(self, name, source):
+        with io.open(os.path.join(self.package, name), 'w', encoding='utf-8') as f:
+            f.write(source)
+
+    def load(self, name):
+        sys.modules.pop('pybars_test_templates.' + name, None)
+        importlib.invalidate_caches()
+        return importlib.import_module('pybars_test_templates.' + name)
+
+    def test_import(self):
+        self.write('welcome.hbs', u"Hi {{name}}!")
+        module = self.load('welcome')
+
+        self.assertEqual(u"Hi Ahmed!", module.render({'name': 'Ahmed'}))
+        self.assertEqual(os.path.join(self.package, 'welcome.hbs'), module.__file__)
+        self.assertTrue(os.path.isfile(module.__cached__))
+
+    def test_install_replaces_finder(self):
+        finder = pybars.install_import_hook(extensions=['.handlebars'])
+        self.assertEqual(1, len([f for f in sys.meta_path if isinstance(f, TemplateFinder)]))
+        self.assertIn(finder, sys.meta_path)
+        self.assertNotIn(self.finder, sys.meta_path)
+
+        self.write('other.handlebars', u"{{a}}")
+        self.assertEqual(u"1", self.load('other').render({'a': 1}))
+
+    def test_python_module_wins(self):
+        self.write('shadowed.hbs', u"template")
+        self.write('shadowed.py', u"render = None\n")
+        self.assertIsNone(self.load('shadowed').render)
+
+    def test_cached_code_is_reused(self):
+        self.write('cached.hbs', u"{{#each items}}{{this}}{{/each}}")
+        self.assertEqual(u"12", self.load('cached').render({'items': [1, 2]}))
+
+        original = Compiler.precompile
+
+        def fail(self, source):
+            raise AssertionError('template was recompiled')
+
+        Compiler.precompile = fail
+        try:
+            self.assertEqual(u"34", self.load('cached').render({'items': [3, 4]}))
+        finally:
+            Compiler.precompile = original
+
+    def test_source_change_invalidates_cache(self):
+        self.write('changed.hbs', u"old {{a}}")
+        self.assertEqual(u"old 1", self.load('changed').render({'a': 1}))
+
+        # The cache is keyed on a hash of the source rather than the mtime,
+        # so an edit within the same second is still picked up
+        self.write('changed.hbs', u"new {{a}}")
+        self.assertEqual(u"new 1", self.load('changed').render({'a': 1}))
+
+    def test_corrupt_cache_is_ignored(self):
+        self.write('corrupt.hbs', u"{{a}}")
+        module = self.load('corrupt')
+        with open(module.__cached__, 'r+b') as f:
+            f.truncate(20)
+
+        self.assertEqual(u"1", self.load('corrupt').render({'a': 1}))
+
+    def test_dont_write_bytecode(self):
+        self.write('nocache.hbs', u"{{a}}")
+        sys.dont_write_bytecode = True
+        module = self.load('nocache')
+
+        self.assertEqual(u"1", module.render({'a': 1}))
+        self.assertFalse(os.path.exists(os.path.join(self.package, '__pycache__')))
@@ -0,0 +1,75 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Tests for template source maps and the profiler."""
+
+import sys
+import traceback
+
+from unittest import TestCase
+
+from pybars import Compiler, Profiler, source_location
+
+
+class TestProfiler(TestCase):
+
+    def test_source_location(self):
+        source = u"Hi {{name}}\n  {{#each items}}\n    {{~fail this}}\n  {{/each}}\n"
+
+        def fail(this, value):
+            raise ValueError(value)
+
+        template = Compiler().compile(source)
+        try:
+            template({'name': 'Ahmed', 'items': [1]}, helpers={'fail': fail})
+        except ValueError:
+            frames = traceback.extract_tb(sys.exc_info()[2])
+        lineno = [frame[1] for frame in frames if frame[2] == 'block_1'][-1]
+
+        self.assertEqual((3, 5), source_location(template, lineno))
+
+        module = sys.modules[template.__module__]
+        self.assertEqual(('escapedexpand', 1, 4, u'{{name}}'), module._pybars_constructs[1])
+        self.assertEqual(('block', 2, 3, u'{{#each items}}'), module._pybars_constructs[3])
+        self.assertIsNone(source_location(template, 1))
+
+    def test_profiler(self):
+        profiler = Profiler()
+        compiler = Compiler(profiler=profiler)
+        page = compiler.compile(
+            u"{{title}}\n{{#each items}}<{{this}}>{{/each}}{{> footer}}", path='page.hbs')
+        footer = compiler.compile(u"{{{sig}}}", path='footer.hbs')
+
+        for _ in range(2):
+            output = page({'title': 'T', 'items': [1, 2, 3], 'sig': '&'}, partials={'footer': footer})
+            self.assertEqual(u"T\n<1><2><3>&", output)
+
+        stats = dict(((name, line, column, kind, text), calls) for _, calls, name, line, column, kind, text in profiler.stats())
+        self.assertEqual({
+            ('page.hbs', 1, 1, 'escapedexpand', u'{{title}}'): 2,
+            ('page.hbs', 2, 1, 'block', u'{{#each items}}'): 2,
+            ('page.hbs', 2, 17, 'escapedexpand', u'{{this}}'): 6,
+            ('page.hbs', 2, 35, 'partial', u'{{> footer}}'): 2,
+            ('footer.hbs', 1, 1, 'expand', u'{{{sig}}}'): 2,
+            }, stats)
+
+        self.assertIn(u'page.hbs:2:1 block {{#each items}}', profiler.report())
+        self.assertEqual(3, len(profiler.report(limit=2).splitlines()))
+        annotated = profiler.annotate('page.hbs').splitlines()
+        self.assertTrue(annotated[1].endswith(u'  {{#each items}}<{{this}}>{{/each}}{{> footer}}'))
+        self.assertNotEqual(u'', annotated[1][:10].strip())
+
+        profiler.reset()
+        self.assertEqual([], profiler.stats())
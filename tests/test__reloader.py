@@ -0,0 +1,172 @@
+# Copyright (c) 2015 Will Bond, 2012 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# GNU Lesser General Public License version 3 (see the file LICENSE).
+
+"""Tests for reloading a directory of templates."""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+from unittest import TestCase
+
+from pybars import PybarsError, TemplateReloader
+
+
+class TestTemplateReloader(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.mtime = 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        path = os.path.join(self.directory, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        # Give each write a distinct mtime rather than relying on the
+        # resolution of the filesystem
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+
+    def reloader(self, **kwargs):
+        reloader = TemplateReloader(self.directory, **kwargs)
+        reloader._time = lambda: self.now
+        reloader._last_scan = self.now
+        return reloader
+
+    def test_render(self):
+        self.write('page.hbs', u"{{> layout/header}}<p>{{body}}</p>")
+        self.write('layout/header.hbs', u"<h1>{{title}}</h1>")
+        reloader = self.reloader()
+
+        self.assertEqual(
+            u"<h1>Hi</h1><p>there</p>",
+            str(reloader.render('page', {'title': 'Hi', 'body': 'there'})))
+        self.assertEqual({'layout/header'}, reloader.dependencies['page'])
+        self.assertEqual(set(), reloader.dependencies['layout/header'])
+
+    def test_reload_follows_dependencies(self):
+        self.write('header.hbs', u"A")
+        self.write('page.hbs', u"{{> header}}!")
+        self.write('site.hbs', u"[{{> page}}]")
+        self.write('other.hbs', u"other")
+        changes = []
+        reloader = self.reloader(on_change=changes.append)
+        page = reloader.templates['page']
+        other = reloader.templates['other']
+
+        self.assertEqual(set(), reloader.reload())
+
+        self.write('header.hbs', u"B")
+        self.assertEqual({'header', 'page', 'site'}, reloader.reload())
+        self.assertEqual([{'header', 'page', 'site'}], changes)
+        self.assertEqual(u"[B!]", str(reloader.render('site', {})))
+
+        # Only the changed template was recompiled and the old module dropped
+        self.assertIs(page, reloader.templates['page'])
+        self.assertIs(other, reloader.templates['other'])
+
+    def test_remove(self):
+        self.write('header.hbs', u"A")
+        self.write('page.hbs', u"{{> header}}")
+        reloader = self.reloader()
+        module = reloader.templates['header'].__module__
+        self.assertIn(module, sys.modules)
+
+        os.unlink(os.path.join(self.directory, 'header.hbs'))
+        self.assertEqual({'header', 'page'}, reloader.reload())
+        self.assertNotIn('header', reloader.templates)
+        self.assertNotIn(module, sys.modules)
+        self.assertRaises(PybarsError, reloader.render, 'page', {})
+
+    def test_replaced_template_still_renders(self):
+        self.write('page.hbs', u"{{a}}")
+        reloader = self.reloader()
+        page = reloader.templates['page']
+
+        self.write('page.hbs', u"new")
+        self.assertEqual({'page'}, reloader.reload())
+        self.assertNotIn(page.__module__, sys.modules)
+        self.assertEqual(u"b", page({'a': 'b'}))
+
+    def test_error_keeps_previous_version(self):
+        self.write('page.hbs', u"good")
+        reloader = self.reloader()
+
+        self.write('page.hbs', u"{{#if}")
+        self.assertEqual({'page'}, reloader.reload())
+        self.assertIsInstance(reloader.errors['page'], PybarsError)
+        self.assertEqual(u"good", str(reloader.render('page', {})))
+
+        self.write('page.hbs', u"fixed")
+        reloader.reload()
+        self.assertEqual({}, reloader.errors)
+        self.assertEqual(u"fixed", str(reloader.render('page', {})))
+
+    def test_duplicate_names(self):
+        self.write('page.hbs', u"good")
+        reloader = self.reloader()
+
+        # The templates in use stay as they were
+        self.write('page.handlebars', u"other")
+        self.assertRaises(PybarsError, reloader.reload)
+        self.assertEqual(u"good", str(reloader.render('page', {})))
+
+    def test_poll_is_throttled(self):
+        self.write('page.hbs', u"1")
+        reloader = self.reloader(interval=5)
+
+        self.write('page.hbs', u"2")
+        self.now += 1
+        self.assertIsNone(reloader.poll())
+        self.assertEqual(u"1", str(reloader.render('page', {})))
+
+        self.now += 5
+        self.assertEqual({'page'}, reloader.poll())
+        self.assertEqual(u"2", str(reloader.render('page', {})))
+
+    def test_poll_does_not_wait_for_a_scan(self):
+        self.write('page.hbs', u"1")
+        reloader = self.reloader(interval=0)
+
+        with reloader._lock:
+            self.write('page.hbs', u"2")
+            self.assertIsNone(reloader.poll())
+            self.assertEqual(u"1", str(reloader.render('page', {})))
+        self.assertEqual({'page'}, reloader.poll())
+
+    def test_thread(self):
+        self.write('page.hbs', u"1")
+        changes = []
+        reloader = TemplateReloader(self.directory, interval=0.01, on_change=changes.append)
+        reloader.start()
+        try:
+            self.write('page.hbs', u"2")
+            for _ in range(500):
+                if changes:
+                    break
+                reloader._stop.wait(0.01)
+        finally:
+            reloader.stop()
+
+        self.assertEqual([{'page'}], changes)
+        self.assertEqual(u"2", str(reloader.render('page', {})))